@@ -1,5 +1,9 @@
 '''Tools for constructing a JSON-API from sqlalchemy models in Pyramid.'''
+import base64
+import csv
+import io
 import json
+import logging
 import transaction
 import sqlalchemy
 from pyramid.view import (
@@ -7,7 +11,8 @@ from pyramid.view import (
     notfound_view_config,
     forbidden_view_config
 )
-from pyramid.renderers import JSON
+from pyramid.renderers import JSON, render
+from pyramid.response import Response
 from pyramid.httpexceptions import (
     exception_response,
     HTTPException,
@@ -30,20 +35,45 @@ import psycopg2
 import functools
 import types
 import importlib
-from collections import deque
-
-from sqlalchemy.orm import load_only
+import queue
+import select
+import threading
+import time
+from collections import deque, OrderedDict
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import load_only, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy.orm.relationships import RelationshipProperty
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
+try:
+    from zope.sqlalchemy import mark_changed
+except ImportError:
+    # Only needed to commit writes made without the ORM under pyramid_tm.
+    mark_changed = None
 
 __version__ = 0.3
 
+log = logging.getLogger(__name__)
+
 ONETOMANY = sqlalchemy.orm.interfaces.ONETOMANY
 MANYTOMANY = sqlalchemy.orm.interfaces.MANYTOMANY
 MANYTOONE = sqlalchemy.orm.interfaces.MANYTOONE
 
+COUNT_STRATEGIES = ('exact', 'window', 'estimate', 'capped', 'none')
+AGGREGATE_FUNCTIONS = ('sum', 'avg', 'min', 'max')
+BUCKET_UNITS = ('second', 'minute', 'hour', 'day', 'week', 'month', 'year')
+SAMPLE_METHODS = ('system', 'bernoulli')
+# Sample this many times as many items as asked for, then pick from those.
+SAMPLE_OVERSAMPLING = 2
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
 view_classes = {}
 
 
@@ -137,6 +167,65 @@ def create_jsonapi(
             renderer='json'
         )
 
+    # Subscription streams.
+    if settings.get('pyramid_jsonapi.subscriptions', 'false') == 'true':
+        broker = settings.get(
+            'pyramid_jsonapi.subscriptions.broker', 'local'
+        )
+        if broker == 'local':
+            subscriptions.broker = LocalBroker()
+        elif broker == 'postgresql':
+            subscriptions.broker = PostgresBroker(settings.get(
+                'pyramid_jsonapi.subscriptions.broker.url',
+                settings.get('sqlalchemy.url')
+            ))
+        else:
+            # Dotted name of a broker factory.
+            subscriptions.broker = config.maybe_dotted(broker)(settings)
+        subscriptions.heartbeat = float(settings.get(
+            'pyramid_jsonapi.subscriptions.heartbeat', 15
+        ))
+        subscriptions.install()
+
+    # Change log for the @changes feeds.
+    if settings.get('pyramid_jsonapi.changes', 'false') == 'true':
+        change_log.install()
+
+    # Server side prepared statements for the hot single item and related
+    # queries.
+    if settings.get(
+        'pyramid_jsonapi.prepared_statements', 'false'
+    ) == 'true':
+        prepared_statements.threshold = int(settings.get(
+            'pyramid_jsonapi.prepared_statements.threshold', 2
+        ))
+        prepared_statements.size = int(settings.get(
+            'pyramid_jsonapi.prepared_statements.size', 50
+        ))
+        prepared_statements.install()
+
+    # Atomic operations endpoint.
+    if settings.get('pyramid_jsonapi.operations', 'false') == 'true':
+        OperationsView.get_dbsession = get_dbsession
+        OperationsView.max_operations = int(settings.get(
+            'pyramid_jsonapi.operations.max_operations', 100
+        ))
+        prefix = settings.get(
+            'pyramid_jsonapi.route_name_prefix', 'pyramid_jsonapi'
+        )
+        route_name = ':'.join(filter(None, (prefix, 'operations')))
+        config.add_route(
+            route_name,
+            '/'.join(filter(None, (
+                settings.get('pyramid_jsonapi.route_pattern_prefix', ''),
+                'operations'
+            )))
+        )
+        config.add_view(
+            OperationsView, attr='post', request_method='POST',
+            route_name=route_name, renderer='json'
+        )
+
     # Loop through the models list. Create resource endpoints for these and
     # any relationships found.
     for model_class in model_list:
@@ -196,6 +285,118 @@ def create_resource(
         int(settings.get('pyramid_jsonapi.paging.default_limit', 10))
     view.max_limit =\
         int(settings.get('pyramid_jsonapi.paging.max_limit', 100))
+    view.max_offset = settings.get('pyramid_jsonapi.paging.max_offset')
+    if view.max_offset is not None:
+        view.max_offset = int(view.max_offset)
+    view.count_strategy = settings.get(
+        'pyramid_jsonapi.count.strategy.{}'.format(view.collection_name),
+        settings.get('pyramid_jsonapi.count.strategy', 'exact')
+    )
+    if view.count_strategy not in COUNT_STRATEGIES:
+        raise Exception(
+            'Unknown count strategy {} for collection {}.'.format(
+                view.count_strategy, view.collection_name
+            )
+        )
+    view.count_cap = int(settings.get('pyramid_jsonapi.count.cap', 1000))
+    view.max_aggregate_groups = int(
+        settings.get('pyramid_jsonapi.aggregate.max_groups', 1000)
+    )
+    view.sample_method = settings.get(
+        'pyramid_jsonapi.sample.method', 'system'
+    )
+    if view.sample_method not in SAMPLE_METHODS:
+        raise Exception(
+            'Unknown sample method {}.'.format(view.sample_method)
+        )
+    view.search_columns = tuple(
+        name for name in settings.get(
+            'pyramid_jsonapi.search.{}'.format(view.collection_name), ''
+        ).split(',') if name
+    )
+    for name in view.search_columns:
+        if name not in view.attributes:
+            raise Exception(
+                'Search column {} is not an attribute of collection '
+                '{}.'.format(name, view.collection_name)
+            )
+    view.search_config = settings.get(
+        'pyramid_jsonapi.search.config', 'english'
+    )
+    if not re.match(r'^\w+$', view.search_config):
+        raise Exception(
+            'Bad text search config {}.'.format(view.search_config)
+        )
+    if settings.get('pyramid_jsonapi.count.cache', 'false') == 'true':
+        count_cache.ttl = float(
+            settings.get('pyramid_jsonapi.count.cache.ttl', 60)
+        )
+        count_cache.size = int(
+            settings.get('pyramid_jsonapi.count.cache.size', 1000)
+        )
+        count_cache.install()
+        view.count_cache = count_cache
+    view.prepare_statements = settings.get(
+        'pyramid_jsonapi.prepared_statements', 'false'
+    ) == 'true'
+    if settings.get('pyramid_jsonapi.statement_cache', 'false') == 'true':
+        view.statement_cache = StatementCache(
+            int(settings.get('pyramid_jsonapi.statement_cache.size', 100))
+        )
+    view.export_chunk_size = int(
+        settings.get('pyramid_jsonapi.export.chunk_size', 1000)
+    )
+    view.bulk_max_items = int(
+        settings.get('pyramid_jsonapi.bulk.max_items', 0)
+    )
+    view.bulk_chunk_size = int(
+        settings.get('pyramid_jsonapi.bulk.chunk_size', 1000)
+    )
+    view.direct_delete = settings.get(
+        'pyramid_jsonapi.delete.direct', 'false'
+    ) == 'true'
+    view.bulk_filter_writes = settings.get(
+        'pyramid_jsonapi.bulk.filter_writes', 'false'
+    ) == 'true'
+    view.import_chunk_size = int(
+        settings.get('pyramid_jsonapi.import.chunk_size', 1000)
+    )
+    view.import_max_errors = int(
+        settings.get('pyramid_jsonapi.import.max_errors', 100)
+    )
+
+    # export (before the item route, which would also match)
+    config.add_route(view.export_route_name, view.export_route_pattern)
+    config.add_view(
+        view, attr='export', request_method='GET',
+        route_name=view.export_route_name
+    )
+
+    # import (also before the item route)
+    if settings.get('pyramid_jsonapi.import', 'false') == 'true':
+        config.add_route(view.import_route_name, view.import_route_pattern)
+        config.add_view(
+            view, attr='import_', request_method='POST',
+            route_name=view.import_route_name, renderer='json'
+        )
+
+    # subscription stream (also before the item route)
+    if settings.get('pyramid_jsonapi.subscriptions', 'false') == 'true':
+        config.add_route(
+            view.subscribe_route_name, view.subscribe_route_pattern
+        )
+        config.add_view(
+            view, attr='subscribe', request_method='GET',
+            route_name=view.subscribe_route_name
+        )
+
+    # change feed (also before the item route)
+    if settings.get('pyramid_jsonapi.changes', 'false') == 'true':
+        config.add_route(view.changes_route_name, view.changes_route_pattern)
+        config.add_view(
+            view, attr='changes', request_method='GET',
+            route_name=view.changes_route_name, renderer='json'
+        )
 
     # individual item
     config.add_route(view.item_route_name, view.item_route_pattern)
@@ -227,6 +428,17 @@ def create_resource(
         view, attr='collection_post', request_method='POST',
         route_name=view.collection_route_name, renderer='json'
     )
+    if view.bulk_filter_writes:
+        # PATCH
+        config.add_view(
+            view, attr='collection_patch', request_method='PATCH',
+            route_name=view.collection_route_name, renderer='json'
+        )
+        # DELETE
+        config.add_view(
+            view, attr='collection_delete', request_method='DELETE',
+            route_name=view.collection_route_name, renderer='json'
+        )
 
     # related
     config.add_route(view.related_route_name, view.related_route_pattern)
@@ -323,6 +535,26 @@ def collection_view_factory(
         collection_name
     )
 
+    CollectionView.export_route_name =\
+        CollectionView.collection_route_name + ':export'
+    CollectionView.export_route_pattern =\
+        CollectionView.collection_route_pattern + '/@export'
+
+    CollectionView.import_route_name =\
+        CollectionView.collection_route_name + ':import'
+    CollectionView.import_route_pattern =\
+        CollectionView.collection_route_pattern + '/@import'
+
+    CollectionView.changes_route_name =\
+        CollectionView.collection_route_name + ':changes'
+    CollectionView.changes_route_pattern =\
+        CollectionView.collection_route_pattern + '/@changes'
+
+    CollectionView.subscribe_route_name =\
+        CollectionView.collection_route_name + ':subscribe'
+    CollectionView.subscribe_route_pattern =\
+        CollectionView.collection_route_pattern + '/@subscribe'
+
     CollectionView.item_route_name =\
         CollectionView.collection_route_name + ':item'
     CollectionView.item_route_pattern =\
@@ -356,6 +588,13 @@ def collection_view_factory(
         if expose_fields is None or key in expose_fields:
             rels[key] = rel
     CollectionView.relationships = rels
+    # Joins from an item of this collection to its related items, built once
+    # from the full join conditions of each relationship.
+    related_joins = {}
+    for key in rels:
+        parent = sqlalchemy.orm.aliased(model, name='jsonapi_parent')
+        related_joins[key] = (parent, getattr(parent, key))
+    CollectionView.related_joins = related_joins
     fields.update(rels)
     CollectionView.fields = fields
 
@@ -369,6 +608,8 @@ def collection_view_factory(
         'before_delete': deque(),               # args: item(sqlalchemy)
         'after_collection_get': deque(),        # args: document(dict)
         'before_collection_post': deque(),      # args: object(dict)
+        'before_collection_patch': deque(),     # args: partial_object(dict)
+        'before_collection_delete': deque(),    # args: query(sqlalchemy)
         'after_related_get': deque(),           # args: document(dict)
         'after_relationships_get': deque(),     # args: document(dict)
         'before_relationships_post': deque(),   # args: object(dict)
@@ -386,6 +627,29 @@ class CollectionViewBase:
     Arguments:
         request (pyramid.request): passed by framework.
     '''
+    # StatementCache used by collection_get (None if disabled).
+    statement_cache = None
+    # Whether to tag hot queries for server side preparation.
+    prepare_statements = False
+    # CountCache for exact totals (None if disabled).
+    count_cache = None
+    # Attributes covered by full text search indexes.
+    search_columns = ()
+    # PostgreSQL text search configuration.
+    search_config = 'english'
+    # Most resources accepted by one bulk create (0 to disable bulk create).
+    bulk_max_items = 0
+    # Rows per INSERT statement for bulk create.
+    bulk_chunk_size = 1000
+    # Whether DELETE bypasses the ORM, leaving related rows to the schema.
+    direct_delete = False
+    # Whether PATCH and DELETE of the collection with filters are allowed.
+    bulk_filter_writes = False
+    # Rows checked and written together by import.
+    import_chunk_size = 1000
+    # Most failed rows described in an import summary.
+    import_max_errors = 100
+
     def __init__(self, request):
         self.request = request
         self.views = {}
@@ -444,6 +708,13 @@ class CollectionViewBase:
             # Update the dictionary with the reults of the wrapped method.
             ret.update(f(self, *args))
 
+            # No Content responses have no body (or content type) at all.
+            if self.request.response.status_code == 204:
+                response = self.request.response
+                response.content_type = None
+                response.body = b''
+                return response
+
             # Include a self link unless the method is PATCH.
             if self.request.method != 'PATCH':
                 selfie = {'self': self.request.url}
@@ -467,6 +738,8 @@ class CollectionViewBase:
                         k: None for k in self.requested_include_names()
                     }
                 }
+                if self.statement_cache is not None:
+                    debug['statement_cache'] = self.statement_cache.info()
                 ret['meta'].update({'debug': debug})
 
             return ret
@@ -524,6 +797,10 @@ class CollectionViewBase:
 
         Update an existing item from a partially defined representation.
 
+        If only attributes are changed and the model allows
+        :py:attr:`direct_writes`, the item is updated with a single
+        ``UPDATE`` statement without being loaded first.
+
         **URL (matchdict) Parameters**
 
             **id** (*str*): resource id
@@ -532,6 +809,11 @@ class CollectionViewBase:
 
             **Partial resource object** (*json*)
 
+        **Request Headers**
+
+            **Prefer:** ``return=minimal`` to get an empty ``204 No Content``
+            response instead.
+
         Returns:
             dict: dict in the form:
 
@@ -592,12 +874,6 @@ class CollectionViewBase:
                     }
                 }' Content-Type:application/vnd.api+json
         '''
-        if not self.object_exists(self.request.matchdict['id']):
-            raise HTTPNotFound(
-                'Cannot PATCH a non existent resource ({}/{})'.format(
-                    self.collection_name, self.request.matchdict['id']
-                )
-            )
         DBSession = self.get_dbsession()
         data = self.request.json_body['data']
         req_id = self.request.matchdict['id']
@@ -617,59 +893,56 @@ class CollectionViewBase:
         for callback in self.callbacks['before_patch']:
             data = callback(self, data)
         atts = data.get('attributes', {})
-        atts[self.key_column.name] = req_id
-        item = DBSession.merge(self.model(**atts))
-
         rels = data.get('relationships', {})
-        for relname, data in rels.items():
-            if relname not in self.relationships:
+        if not rels and self.direct_writes and\
+                atts.keys() <= self.attributes.keys():
+            # Only attributes: no need to load the item.
+            self.direct_update(req_id, atts)
+        else:
+            atts[self.key_column.name] = req_id
+            item = DBSession.merge(self.model(**atts))
+            if sqlalchemy.inspect(item).pending:
+                # merge() loads the existing row: if there wasn't one it has
+                # made a new object instead.
+                DBSession.expunge(item)
                 raise HTTPNotFound(
-                    'Collection {} has no relationship {}'.format(
-                        self.collection_name, relname
+                    'Cannot PATCH a non existent resource ({}/{})'.format(
+                        self.collection_name, req_id
                     )
                 )
-            rel = self.relationships[relname]
-            rel_class = rel.mapper.class_
-            rel_view = self.view_instance(rel_class)
-            if data is None:
-                setattr(item, relname, None)
-            elif isinstance(data, dict):
-                if data.get('type') != rel_view.collection_name:
-                    raise HTTPConflict(
-                        'Type {} does not match relationship type {}'.format(
-                            data.get('type', None), rel_view.collection_name
+
+            refs = []
+            for relname, data in rels.items():
+                if relname not in self.relationships:
+                    raise HTTPNotFound(
+                        'Collection {} has no relationship {}'.format(
+                            self.collection_name, relname
                         )
                     )
-                if data.get('id') is None:
-                    raise HTTPBadRequest(
-                        'An id is required in a resource identifier.'
+                rel_view = self.view_instance(
+                    self.relationships[relname].mapper.class_
+                )
+                if isinstance(data, dict):
+                    refs.append((rel_view, data))
+                elif isinstance(data, list):
+                    refs.extend(
+                        (rel_view, res_ident) for res_ident in data
                     )
-                rel_item = DBSession.query(
-                    rel_class
-                ).options(
-                    load_only(rel_view.key_column.name)
-                ).get(data['id'])
-                if not rel_item:
-                    raise HTTPNotFound('{}/{} not found'.format(
-                        rel_view.collection_name, data['id']
-                    ))
-                setattr(item, relname, rel_item)
-            elif isinstance(data, list):
-                rel_items = []
-                for res_ident in data:
-                    rel_item = DBSession.query(
-                        rel_class
-                    ).options(
-                        load_only(rel_view.key_column.name)
-                    ).get(res_ident['id'])
-                    if not rel_item:
-                        raise HTTPNotFound('{}/{} not found'.format(
-                            rel_view.collection_name, res_ident['id']
-                        ))
-                    rel_items.append(rel_item)
-                setattr(item, relname, rel_items)
+            rel_items = iter(self.resolve_identifiers(refs))
+            for relname, data in rels.items():
+                if data is None:
+                    setattr(item, relname, None)
+                elif isinstance(data, dict):
+                    setattr(item, relname, next(rel_items))
+                elif isinstance(data, list):
+                    setattr(item, relname, [next(rel_items) for _ in data])
 
-        DBSession.flush()
+            DBSession.flush()
+        if self.prefer_minimal:
+            self.request.response.status_code = 204
+            self.request.response.headers['Preference-Applied'] =\
+                'return=minimal'
+            return {}
         return {
             'meta': {
                 'updated': {
@@ -688,6 +961,9 @@ class CollectionViewBase:
 
         Delete the referenced item from the collection.
 
+        If ``pyramid_jsonapi.delete.direct`` is set, the item is deleted with
+        one ``DELETE`` statement (see :py:func:`delete_direct`).
+
         **URL (matchdict) Parameters**
 
             **id** (*str*): resource id
@@ -706,6 +982,11 @@ class CollectionViewBase:
                 http DELETE http://localhost:6543/people/1
         '''
         DBSession = self.get_dbsession()
+        mapper = sqlalchemy.inspect(self.model).mapper
+        if self.direct_delete and len(mapper.tables) == 1 and not (
+            mapper.dispatch.before_delete or mapper.dispatch.after_delete
+        ):
+            return self.delete_direct(self.request.matchdict['id'])
         item = DBSession.query(
             self.model
         ).options(
@@ -729,6 +1010,299 @@ class CollectionViewBase:
         else:
             return {'data': None}
 
+    def delete_direct(self, obj_id):
+        '''Delete an item with a single ``DELETE`` statement.
+
+        The ORM isn't told about the item's relationships, so related rows
+        are left to the schema: foreign keys need ``ON DELETE`` rules (and
+        relationships ``passive_deletes``) to cascade or nullify, otherwise
+        the delete fails. Deleting an item with many children then never
+        loads them. If there are ``before_delete`` callbacks the item is
+        loaded first so that they can be called with it.
+
+        Parameters:
+            obj_id (str): id of the item.
+
+        Returns:
+            dict: Resource Identifier for the deleted object, or
+            ``{"data": None}`` if there was no such item.
+
+        Raises:
+            HTTPFailedDependency: if the database refuses the delete.
+        '''
+        DBSession = self.get_dbsession()
+        if self.callbacks['before_delete']:
+            item = DBSession.query(
+                self.model
+            ).options(
+                load_only(self.key_column.name)
+            ).get(obj_id)
+            if item is None:
+                return {'data': None}
+            for callback in self.callbacks['before_delete']:
+                callback(self, item)
+        try:
+            DBSession.flush()
+            deleted = DBSession.execute(
+                self.key_column.table.delete().where(
+                    self.key_column == obj_id
+                )
+            ).rowcount > 0
+        except sqlalchemy.exc.IntegrityError as e:
+            raise HTTPFailedDependency(str(e))
+        if not deleted:
+            return {'data': None}
+        for obj in self.session_items(obj_id):
+            DBSession.expunge(obj)
+        record_changes(DBSession, [{
+            'collection': self.collection_name,
+            'item_id': str(obj_id),
+            'op': 'delete',
+        }])
+        return {'data': self.serialise_resource_identifier(obj_id)}
+
+    @jsonapi_view
+    def collection_patch(self):
+        '''Handle PATCH requests for the collection: update filtered items.
+
+        Set the same attributes on every item matching the ``filter``
+        parameters with one ``UPDATE`` statement. Items are never loaded.
+        Only available if ``pyramid_jsonapi.bulk.filter_writes`` is set.
+
+        **Query Parameters**
+
+            **filter[...]:** as for :py:func:`collection_get` (at least one
+            is required).
+
+            **confirm:** must be ``true``.
+
+            **return:** ``identifiers`` to list the updated items.
+
+        **Request Body**
+
+            **Partial resource object** (*json*) with no id, in the form
+            ``{"data": {"type": <collection>, "attributes": {...}}}``.
+
+        Returns:
+            dict: dict in the form:
+
+            .. parsed-literal::
+
+                {
+                    "meta": {"results": {"updated": <number of items>}},
+                    "data": [ identifiers ] (with return=identifiers)
+                }
+
+        Raises:
+            HTTPBadRequest: if there is no filter or confirmation, or an
+            attribute doesn't exist.
+
+            HTTPConflict: if the type is wrong.
+
+            HTTPForbidden: if the collection has ``before_patch`` callbacks,
+            which this would bypass.
+
+        Example:
+            Unpublish all of the posts by person 1:
+
+            .. parsed-literal::
+
+                http PATCH 'http://localhost:6543/posts?filter[author_id:eq]=1&confirm=true' data:='
+                {
+                    "type": "posts",
+                    "attributes": {"published_at": null}
+                }' Content-Type:application/vnd.api+json
+        '''
+        DBSession = self.get_dbsession()
+        ids = self.filtered_write_query('before_patch')
+        data = self.request.json_body['data']
+        if not isinstance(data, dict) or\
+                data.get('type') != self.collection_name:
+            raise HTTPConflict(
+                "Unsupported type '{}'".format(
+                    data.get('type') if isinstance(data, dict) else None
+                )
+            )
+        for callback in self.callbacks['before_collection_patch']:
+            data = callback(self, data)
+        atts = data.get('attributes', {})
+        for name in atts:
+            if name not in self.attributes:
+                raise HTTPBadRequest(
+                    'No attribute {} in collection {}'.format(
+                        name, self.collection_name
+                    )
+                )
+        if not atts:
+            raise HTTPBadRequest('No attributes to update.')
+        where = self.key_column.in_(ids.statement.correlate(None))
+        stmt = self.key_column.table.update().where(where).values({
+            self.attributes[name]: value for name, value in atts.items()
+        })
+        updated = self.filtered_write(stmt, where, 'update')
+        if not isinstance(updated, int):
+            for obj in self.loaded_items(updated):
+                DBSession.expire(obj)
+        return self.filtered_write_return('updated', updated)
+
+    @jsonapi_view
+    def collection_delete(self):
+        '''Handle DELETE requests for the collection: delete filtered items.
+
+        Delete every item matching the ``filter`` parameters with one
+        ``DELETE`` statement. Items are never loaded, so related rows are left
+        to the schema's ``ON DELETE`` rules. Only available if
+        ``pyramid_jsonapi.bulk.filter_writes`` is set.
+
+        **Query Parameters**
+
+            **filter[...]:** as for :py:func:`collection_get` (at least one
+            is required).
+
+            **confirm:** must be ``true``.
+
+            **return:** ``identifiers`` to list the deleted items.
+
+        Returns:
+            dict: dict in the form:
+
+            .. parsed-literal::
+
+                {
+                    "meta": {"results": {"deleted": <number of items>}},
+                    "data": [ identifiers ] (with return=identifiers)
+                }
+
+        Raises:
+            HTTPBadRequest: if there is no filter or confirmation.
+
+            HTTPForbidden: if the collection has ``before_delete`` callbacks,
+            which this would bypass.
+
+            HTTPFailedDependency: if the database refuses the delete.
+
+        Example:
+            Delete all comments containing 'spam':
+
+            .. parsed-literal::
+
+                http DELETE 'http://localhost:6543/comments?filter[content:contains]=spam&confirm=true'
+        '''
+        DBSession = self.get_dbsession()
+        ids = self.filtered_write_query('before_delete')
+        for callback in self.callbacks['before_collection_delete']:
+            ids = callback(self, ids)
+        where = self.key_column.in_(ids.statement.correlate(None))
+        stmt = self.key_column.table.delete().where(where)
+        try:
+            deleted = self.filtered_write(stmt, where, 'delete')
+        except sqlalchemy.exc.IntegrityError as e:
+            raise HTTPFailedDependency(str(e))
+        if not isinstance(deleted, int):
+            for obj in self.loaded_items(deleted):
+                DBSession.expunge(obj)
+        return self.filtered_write_return('deleted', deleted)
+
+    def filtered_write_query(self, callback_name):
+        '''Check a filtered write request and query the ids it affects.
+
+        Parameters:
+            callback_name (str): per item callbacks which the write would
+                bypass.
+
+        Returns:
+            sqlalchemy.orm.query.Query: query for the ids of the filtered
+            items.
+
+        Raises:
+            HTTPBadRequest: if filtered writes are disabled, or there is no
+            filter or ``confirm=true`` parameter.
+
+            HTTPForbidden: if there are callback_name callbacks.
+        '''
+        if not self.bulk_filter_writes:
+            raise HTTPBadRequest('Filtered writes are not enabled.')
+        if self.callbacks[callback_name]:
+            raise HTTPForbidden(
+                'Collection {} has {} callbacks: write items one at a '
+                'time.'.format(self.collection_name, callback_name)
+            )
+        if not self.collection_query_info(self.request)['_filters']:
+            raise HTTPBadRequest('Filtered writes need at least one filter.')
+        if self.request.params.get('confirm') != 'true':
+            raise HTTPBadRequest('Filtered writes need confirm=true.')
+        if self.request.params.get('return', 'count') not in (
+            'count', 'identifiers'
+        ):
+            raise HTTPBadRequest('return must be one of count, identifiers')
+        key = getattr(self.model, self.key_column.name)
+        return self.query_add_filtering(self.get_dbsession().query(key))
+
+    def filtered_write(self, stmt, where, op):
+        '''Execute a filtered ``UPDATE`` or ``DELETE``.
+
+        The ids of the affected items are only fetched if they're wanted (by
+        the request, the change log or subscriptions, or because items of
+        the collection are loaded into the session and may need expiring):
+        with ``RETURNING`` on PostgreSQL, otherwise by a query before the
+        write.
+
+        Parameters:
+            stmt: update or delete statement.
+            where: the statement's where clause.
+            op (str): ``update`` or ``delete`` for the change log.
+
+        Returns:
+            int or list: ids of the affected items if fetched, else the
+            number of them.
+        '''
+        DBSession = self.get_dbsession()
+        if self.request.params.get('return') != 'identifiers' and\
+                not change_log.installed and not subscriptions.installed and\
+                not self.loaded_items():
+            return DBSession.execute(stmt).rowcount
+        if DBSession.get_bind().dialect.name == 'postgresql':
+            item_ids = [
+                row[0] for row in
+                DBSession.execute(stmt.returning(self.key_column))
+            ]
+        else:
+            item_ids = [
+                row[0] for row in DBSession.execute(
+                    sqlalchemy.select([self.key_column]).where(where)
+                )
+            ]
+            DBSession.execute(stmt)
+        record_changes(DBSession, [
+            {
+                'collection': self.collection_name,
+                'item_id': str(item_id),
+                'op': op,
+            }
+            for item_id in item_ids
+        ])
+        return item_ids
+
+    def filtered_write_return(self, name, affected):
+        '''Response document for a filtered write.
+
+        Parameters:
+            name (str): ``updated`` or ``deleted``.
+            affected (int or list): from :py:func:`filtered_write`.
+
+        Returns:
+            dict: document with the count and (if requested) identifiers.
+        '''
+        if isinstance(affected, int):
+            return {'meta': {'results': {name: affected}}}
+        ret = {'meta': {'results': {name: len(affected)}}}
+        if self.request.params.get('return') == 'identifiers':
+            ret['data'] = [
+                self.serialise_resource_identifier(item_id)
+                for item_id in affected
+            ]
+        return ret
+
     @jsonapi_view
     def collection_get(self):
         '''Handle GET requests for the collection.
@@ -751,8 +1325,23 @@ class CollectionViewBase:
 
             **page[offset]:** starting index for current page.
 
+            **page[after]:** cursor: return the page after this one (keyset
+            pagination). An empty value starts at the beginning.
+
+            **page[before]:** cursor: return the page before this one (keyset
+            pagination). An empty value ends at the end.
+
+            **page[count]:** how to count the available results: ``exact``,
+            ``estimate``, ``capped`` or ``none``.
+
             **filter[<attribute>:<op>]:** filter operation.
 
+            **filter[q]:** full text search over the collection's search
+            columns.
+
+            **aggregate[<function>]:** return aggregates instead of resources
+            (see :py:func:`collection_aggregate`).
+
         Returns:
             dict: dict in the form:
 
@@ -783,57 +1372,857 @@ class CollectionViewBase:
                 http GET http://localhost:6543/people?page[limit]=2&page[offset]=2&sort=-name&include=posts
         '''
         DBSession = self.get_dbsession()
+        qinfo = self.collection_query_info(self.request)
 
-        # Set up the query
-        q = DBSession.query(
-            self.model
-        ).options(
-            load_only(*self.allowed_requested_query_columns.keys())
+        if qinfo['_aggregate']:
+            return self.collection_aggregate()
+
+        searching = any(
+            finfo['op'] == 'search' for finfo in qinfo['_filters'].values()
         )
-        q = self.query_add_sorting(q)
-        q = self.query_add_filtering(q)
-        qinfo = self.collection_query_info(self.request)
-        try:
-            count = q.count()
-        except sqlalchemy.exc.ProgrammingError as e:
-            raise HTTPBadRequest(
-                "Could not use operator '{}' with field '{}'".format(
-                    op, prop.name
-                )
+        sampling = 'sample' in qinfo['_page']
+        if self.statement_cache is not None and not self.keyset_paging and\
+                not searching and not sampling and\
+                qinfo['page[count]'] in ('exact', 'window', 'none'):
+            # Fetch the compiled statements for this query shape and bind
+            # this request's values.
+            q, q_count = self.cached_collection_queries()
+        else:
+            # Set up the query
+            q = DBSession.query(
+                self.model
+            ).options(
+                load_only(*self.allowed_requested_query_columns.keys())
             )
-        q = q.offset(qinfo['page[offset]'])
-        q = q.limit(qinfo['page[limit]'])
+            q = self.query_add_sorting(q)
+            q = self.query_add_filtering(q)
+            q_count = q
+            q = self.query_add_paging(q)
+        if sampling:
+            # Counting would read everything that sampling avoids reading.
+            count_info = {'available': None, 'count': 'none'}
+        else:
+            try:
+                count_info = self.query_count(q_count)
+            except sqlalchemy.exc.ProgrammingError as e:
+                raise HTTPBadRequest(
+                    "Could not use operator '{}' with field '{}'".format(
+                        op, prop.name
+                    )
+                )
 
-        ret = self.collection_return(q, count=count)
+        ret = self.collection_return(q, count_info=count_info)
+        if sampling:
+            size, percent, method = self.sample_params()
+            ret['meta']['results']['sample'] = {
+                'size': size,
+                'percent': percent,
+                'method': method,
+            }
 
         # Alter return dict with any callbacks.
         for callback in self.callbacks['after_collection_get']:
             ret = callback(self, ret)
         return ret
 
-    @jsonapi_view
-    def collection_post(self):
-        '''Handle POST requests for the collection.
+    def export(self):
+        '''Handle GET requests for a streamed export of the collection.
 
-        Create a new object in collection.
+        Stream every item matching the filters, in the requested order, as
+        newline delimited JSON or CSV. Unlike paging through
+        :py:func:`collection_get` this runs a single query (no count, no
+        offsets) on its own connection in a read only, repeatable read
+        transaction, so the export is a consistent snapshot. Rows are fetched
+        from a server side cursor ``pyramid_jsonapi.export.chunk_size`` at a
+        time and written out as they arrive, so memory use doesn't grow with
+        the size of the collection.
 
-        **Request Body**
+        Each item has its id, attributes and to-one relationships (those
+        needing no extra queries). ``after_serialise_object`` callbacks are
+        run, and items they mark as forbidden are left out.
 
-            **resource object** (*json*) in the form:
+        **Query Parameters**
 
-            .. parsed-literal::
+            **format:** ``ndjson`` (default) or ``csv``.
 
-                {
-                    "data": { resource object }
-                }
+            **fields[<collection>]:** comma separated list of fields
+            (attributes or relationships) to include.
+
+            **sort:** comma separated list of sort keys.
+
+            **filter[<attribute>:<op>]:** filter operation.
 
         Returns:
-            dict: dict in the form:
+            pyramid.response.Response: streaming response. With
+            ``format=ndjson`` each line is a resource object; with
+            ``format=csv`` the first line has the column names (``id``,
+            attributes, then to-one relationships).
+
+        Raises:
+            HTTPBadRequest
 
+        Example:
             .. parsed-literal::
 
-                {
-                    "data": { resource object },
+                http GET http://localhost:6543/posts/@export?format=csv&sort=published_at
+        '''
+        fmt = self.request.params.get('format', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            raise HTTPBadRequest(
+                'format must be one of {}'.format(', '.join(EXPORT_FORMATS))
+            )
+        q = self.get_dbsession().query(
+            self.model
+        ).options(
+            load_only(*self.allowed_requested_query_columns.keys())
+        )
+        q = self.query_add_sorting(q)
+        q = self.query_add_filtering(q)
+
+        conn = self.get_dbsession().get_bind().connect()
+        try:
+            conn.begin()
+            if conn.dialect.name == 'postgresql':
+                conn.execute(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY'
+                )
+            session = sqlalchemy.orm.Session(bind=conn)
+            # Runs the query: errors are reported before streaming starts.
+            items = iter(
+                q.with_session(session).yield_per(self.export_chunk_size)
+            )
+        except sqlalchemy.exc.ProgrammingError as e:
+            conn.close()
+            raise HTTPBadRequest('Could not export: {}'.format(e.orig))
+        except Exception:
+            conn.close()
+            raise
+
+        lines = getattr(self, 'export_{}'.format(fmt))(items)
+        return Response(
+            app_iter=ExportStream(lines, session, conn),
+            content_type=EXPORT_FORMATS[fmt],
+            charset='utf-8'
+        )
+
+    def export_resources(self, items):
+        '''Generate export resource objects for items.'''
+        attributes = [
+            key for key in self.requested_attributes
+            if key in self.allowed_fields
+        ]
+        to_one = [
+            (key, rel, self.view_instance(rel.mapper.class_))
+            for key, rel in self.requested_relationships.items()
+            if rel.direction is MANYTOONE and key in self.allowed_fields
+        ]
+        for item in items:
+            rels = {}
+            for key, rel, rel_view in to_one:
+                rel_id = getattr(item, rel.local_remote_pairs[0][0].name)
+                rels[key] = {
+                    'data': None if rel_id is None else
+                    rel_view.serialise_resource_identifier(rel_id)
+                }
+            resource = {
+                'id': str(item._jsonapi_id),
+                'type': self.collection_name,
+                'attributes': {key: getattr(item, key) for key in attributes},
+                'relationships': rels
+            }
+            for callback in self.callbacks['after_serialise_object']:
+                resource = callback(self, resource)
+            if resource.get('meta', {}).get('errors'):
+                continue
+            yield resource
+
+    def export_ndjson(self, items):
+        '''Generate NDJSON lines for items.'''
+        for resource in self.export_resources(items):
+            yield render('json', resource, request=self.request) + '\n'
+
+    def export_csv(self, items):
+        '''Generate CSV lines for items.'''
+        def text(value):
+            if value is None:
+                return ''
+            if hasattr(value, 'isoformat'):
+                return value.isoformat()
+            return value
+
+        attributes = [
+            key for key in self.requested_attributes
+            if key in self.allowed_fields
+        ]
+        to_one = [
+            key for key, rel in self.requested_relationships.items()
+            if rel.direction is MANYTOONE and key in self.allowed_fields
+        ]
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+
+        def line(row):
+            writer.writerow(row)
+            ret = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return ret
+
+        yield line(['id'] + attributes + to_one)
+        for resource in self.export_resources(items):
+            atts = resource.get('attributes', {})
+            rels = resource.get('relationships', {})
+            yield line(
+                [resource['id']] +
+                [text(atts.get(key)) for key in attributes] +
+                [
+                    text((rels.get(key, {}).get('data') or {}).get('id'))
+                    for key in to_one
+                ]
+            )
+
+    def import_(self):
+        '''Handle POST requests to import items into the collection.
+
+        Load items from newline delimited JSON or CSV in the same shapes
+        :py:func:`export` produces: a resource object per line, or CSV with a
+        header of ``id``, attribute names and to-one relationship names (an
+        empty value is null). The body is read as a stream and handled
+        ``pyramid_jsonapi.import.chunk_size`` rows at a time: each chunk's
+        rows are checked (fields, related items) and then written with
+        ``COPY ... FROM STDIN`` on PostgreSQL or an executemany ``INSERT``
+        elsewhere. If the database rejects a chunk it is rolled back and its
+        rows are retried one at a time so that only the bad rows are left
+        out.
+
+        The ORM and ``before_collection_post`` callbacks are bypassed, so
+        collections with such callbacks refuse imports.
+
+        **Query Parameters**
+
+            **format:** ``ndjson`` or ``csv`` (by default from the request's
+            content type).
+
+        Returns:
+            dict: a summary in ``meta.import``: the number of ``rows`` read,
+            how many were ``imported`` and how many ``failed``, the number of
+            ``chunks`` and ``errors`` with the ``line`` and ``detail`` of up to
+            ``pyramid_jsonapi.import.max_errors`` failed rows.
+
+        Raises:
+            HTTPBadRequest: if the format is unknown or a CSV header names
+            something which isn't a field.
+
+            HTTPForbidden: if the collection has ``before_collection_post``
+            callbacks.
+
+        Example:
+            .. parsed-literal::
+
+                http POST http://localhost:6543/posts/@import?format=csv < posts.csv
+        '''
+        if self.callbacks['before_collection_post']:
+            raise HTTPForbidden(
+                'Collection {} has before_collection_post callbacks: import '
+                'is not allowed.'.format(self.collection_name)
+            )
+        content_type = self.request.headers.get(
+            'content-type', ''
+        ).split(';')[0].strip()
+        # Not request.params, which would read a form encoded body.
+        fmt = self.request.GET.get('format') or {
+            ctype: name for name, ctype in EXPORT_FORMATS.items()
+        }.get(content_type, 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            raise HTTPBadRequest(
+                'format must be one of {}'.format(', '.join(EXPORT_FORMATS))
+            )
+        text = io.TextIOWrapper(
+            self.request.body_file, encoding='utf-8', newline=''
+        )
+        records = getattr(self, 'import_{}'.format(fmt))(text)
+        summary = {
+            'rows': 0, 'imported': 0, 'failed': 0, 'chunks': 0, 'errors': []
+        }
+
+        def fail(line, detail):
+            summary['failed'] += 1
+            if len(summary['errors']) < self.import_max_errors:
+                summary['errors'].append({'line': line, 'detail': detail})
+
+        chunk = []
+        for line, record in records:
+            summary['rows'] += 1
+            try:
+                chunk.append((line,) + self.import_row(record))
+            except ValueError as e:
+                fail(line, str(e))
+            if len(chunk) >= self.import_chunk_size:
+                self.import_chunk(chunk, summary, fail)
+                chunk = []
+        if chunk:
+            self.import_chunk(chunk, summary, fail)
+        self.request.response.content_type = 'application/vnd.api+json'
+        return {'meta': {'import': summary}}
+
+    @staticmethod
+    def import_ndjson(text):
+        '''Generate (line number, resource object) pairs from NDJSON.
+
+        A line which isn't JSON gives its ValueError in place of a resource
+        object.
+        '''
+        for line, content in enumerate(text, 1):
+            if not content.strip():
+                continue
+            try:
+                yield line, json.loads(content)
+            except ValueError as e:
+                yield line, e
+
+    def import_csv(self, text):
+        '''Generate (line number, resource object) pairs from CSV.'''
+        reader = csv.reader(text)
+        header = next(reader, [])
+        for name in header:
+            if name != 'id' and name not in self.attributes and\
+                    name not in self.relationships:
+                raise HTTPBadRequest(
+                    'No field {} in collection {}'.format(
+                        name, self.collection_name
+                    )
+                )
+        for values in reader:
+            values = [None if value == '' else value for value in values]
+            record = dict(zip(header, values))
+            resource = {
+                'type': self.collection_name,
+                'attributes': {
+                    name: value for name, value in record.items()
+                    if name in self.attributes
+                },
+                'relationships': {
+                    name: {
+                        'data': None if value is None else {
+                            'type': self.view_instance(
+                                self.relationships[name].mapper.class_
+                            ).collection_name,
+                            'id': value
+                        }
+                    }
+                    for name, value in record.items()
+                    if name in self.relationships
+                },
+            }
+            if record.get('id') is not None:
+                resource['id'] = record['id']
+            yield reader.line_num, resource
+
+    def import_row(self, resource):
+        '''Table row for an imported resource object.
+
+        Returns:
+            tuple: a dict mapping table columns to values (with to-one
+            relationships as foreign key values) and a dict mapping
+            relationship names to the related ids, to be checked.
+
+        Raises:
+            ValueError: if the resource object is bad.
+        '''
+        if isinstance(resource, ValueError):
+            raise ValueError('Bad JSON: {}'.format(resource))
+        if not isinstance(resource, dict):
+            raise ValueError('Not a resource object.')
+        if resource.get('type', self.collection_name) != self.collection_name:
+            raise ValueError(
+                "Unsupported type '{}'".format(resource.get('type'))
+            )
+        for member in ('attributes', 'relationships'):
+            if resource.get(member) is not None and\
+                    not isinstance(resource[member], dict):
+                raise ValueError('{} must be an object.'.format(member))
+        row = {}
+        refs = {}
+        for name, value in (resource.get('attributes') or {}).items():
+            if name not in self.attributes:
+                raise ValueError(
+                    'No attribute {} in collection {}'.format(
+                        name, self.collection_name
+                    )
+                )
+            row[self.attributes[name]] = value
+        if resource.get('id') is not None:
+            if self.request.registry.settings.get(
+                'pyramid_jsonapi.allow_client_ids', 'false'
+            ) != 'true':
+                raise ValueError('Client generated ids are not supported.')
+            row[self.key_column] = resource['id']
+        for relname, reldata in (resource.get('relationships') or {}).items():
+            rel = self.relationships.get(relname)
+            if rel is None or rel.direction is not MANYTOONE:
+                raise ValueError(
+                    'No to-one relationship {} in collection {}'.format(
+                        relname, self.collection_name
+                    )
+                )
+            rel_view = self.view_instance(rel.mapper.class_)
+            if len(rel.synchronize_pairs) != 1 or\
+                    rel.synchronize_pairs[0][0] is not rel_view.key_column:
+                raise ValueError(
+                    'Relationship {} cannot be imported.'.format(relname)
+                )
+            ((remote, local),) = rel.synchronize_pairs
+            if reldata is not None and not isinstance(reldata, dict):
+                raise ValueError(
+                    'Relationship {} must be an object.'.format(relname)
+                )
+            identifier = (reldata or {}).get('data')
+            if identifier is None:
+                row[local] = None
+                continue
+            if not isinstance(identifier, dict) or\
+                    identifier.get('type') != rel_view.collection_name or\
+                    identifier.get('id') is None:
+                raise ValueError(
+                    'Bad resource identifier for relationship {}'.format(
+                        relname
+                    )
+                )
+            row[local] = identifier['id']
+            refs[relname] = str(identifier['id'])
+        return row, refs
+
+    def import_chunk(self, chunk, summary, fail):
+        '''Check and write a chunk of imported rows.
+
+        Parameters:
+            chunk (list): (line number, row, related ids) tuples from
+                :py:func:`import_row`.
+            summary (dict): import summary to update.
+            fail (callable): called with a line number and message for each
+                row which can't be imported.
+        '''
+        summary['chunks'] += 1
+        # Leave out rows whose related items don't exist.
+        refs = {}
+        for line, row, rel_ids in chunk:
+            for relname, rel_id in rel_ids.items():
+                refs.setdefault(relname, set()).add(rel_id)
+        found = {
+            relname: self.view_instance(
+                self.relationships[relname].mapper.class_
+            ).existing_ids(ids)
+            for relname, ids in refs.items()
+        }
+        rows = []
+        for line, row, rel_ids in chunk:
+            missing = [
+                relname for relname, rel_id in rel_ids.items()
+                if rel_id not in found[relname]
+            ]
+            if missing:
+                fail(line, 'Related item not found for {}'.format(
+                    ', '.join(missing)
+                ))
+            else:
+                rows.append((line, row))
+
+        session = self.get_dbsession()
+        if isinstance(session, sqlalchemy.orm.scoped_session):
+            session = session()
+        savepoint = session.begin_nested()
+        try:
+            self.import_write([row for _, row in rows])
+            savepoint.commit()
+            summary['imported'] += len(rows)
+            return
+        except (DBAPIError, psycopg2.Error):
+            savepoint.rollback()
+        # Find the bad rows.
+        for line, row in rows:
+            savepoint = session.begin_nested()
+            try:
+                self.import_write([row])
+                savepoint.commit()
+                summary['imported'] += 1
+            except (DBAPIError, psycopg2.Error) as e:
+                savepoint.rollback()
+                fail(line, str(getattr(e, 'orig', e)).strip())
+
+    def import_write(self, rows):
+        '''Write imported rows to the collection's table.
+
+        On PostgreSQL rows are loaded with ``COPY ... FROM STDIN``, unless the
+        change log or subscriptions need the ids of rows which have none, or
+        a missing column has a client side default which isn't a plain value
+        (COPY only knows about server side defaults). Elsewhere they go
+        through :py:func:`bulk_insert`.
+
+        Parameters:
+            rows (list): dicts mapping table columns to values.
+        '''
+        DBSession = self.get_dbsession()
+        conn = DBSession.connection()
+        track = change_log.installed or subscriptions.installed
+        table = self.key_column.table
+        key = self.key_column
+        defaults = {
+            col: col.default for col in table.columns
+            if col.default is not None and any(col not in row for row in rows)
+        }
+        if conn.dialect.name == 'postgresql' and not (
+            track and any(key not in row for row in rows)
+        ) and all(default.is_scalar for default in defaults.values()):
+            groups = OrderedDict()
+            for row in rows:
+                row = dict(row)
+                for col, default in defaults.items():
+                    row.setdefault(col, default.arg)
+                groups.setdefault(tuple(sorted(row, key=lambda c: c.key)), [])\
+                    .append(row)
+            cursor = conn.connection.cursor()
+            try:
+                self.import_copy(cursor, table, groups)
+            finally:
+                cursor.close()
+            ids = [row.get(key) for row in rows]
+        else:
+            ids = self.bulk_insert(rows)
+        # Also tells the count cache, which never sees COPY.
+        record_changes(DBSession, [
+            {
+                'collection': self.collection_name,
+                'item_id': str(item_id),
+                'op': 'create',
+            }
+            for item_id in ids if item_id is not None
+        ], tables={table.name})
+
+    @staticmethod
+    def import_copy(cursor, table, groups):
+        '''Load rows into table with ``COPY ... FROM STDIN``.
+
+        Parameters:
+            cursor: psycopg2 cursor.
+            table: the collection's table.
+            groups (dict): lists of rows keyed by their tuple of columns.
+        '''
+        preparer = postgresql.dialect().identifier_preparer
+
+        def field(value):
+            # Unquoted empty fields are NULL, quoted ones empty strings.
+            if value is None:
+                return ''
+            if isinstance(value, (bool, int, float)):
+                return str(value)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            return '"{}"'.format(str(value).replace('"', '""'))
+
+        for columns, group in groups.items():
+            buf = io.StringIO()
+            for row in group:
+                buf.write(','.join(field(row[col]) for col in columns) + '\n')
+            buf.seek(0)
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                    preparer.format_table(table),
+                    ', '.join(preparer.quote(col.name) for col in columns)
+                ),
+                buf
+            )
+
+    def existing_ids(self, ids):
+        '''Which of ids belong to items in the collection.
+
+        Parameters:
+            ids (iterable): item ids (as strings).
+
+        Returns:
+            set: the ids (as strings) which were found.
+        '''
+        DBSession = self.get_dbsession()
+        ids = list(ids)
+        found = set()
+        for start in range(0, len(ids), self.import_chunk_size):
+            found.update(
+                str(item_id) for (item_id,) in DBSession.execute(
+                    sqlalchemy.select([self.key_column]).where(
+                        self.key_column.in_(
+                            ids[start:start + self.import_chunk_size]
+                        )
+                    )
+                )
+            )
+        return found
+
+    @jsonapi_view
+    def changes(self):
+        '''Handle GET requests for the collection's change feed.
+
+        Return the items created, updated or deleted since a sync token, and
+        a new token to use next time. Changes are recorded by
+        :py:class:`ChangeLog` as the write handlers flush, so the work done
+        is proportional to the number of changes, not to the size of the
+        collection. An item changed more than once is reported once, in its
+        current state (or as deleted).
+
+        **Query Parameters**
+
+            **since:** token from ``meta.changes.token`` of an earlier
+            response. Without it no changes are returned, only the current
+            token: fetch the collection and then follow changes from there.
+
+            **page[limit]:** maximum number of changes to read (default and
+            maximum ``pyramid_jsonapi.paging.max_limit``).
+
+            **include**, **fields[<collection>]:** as for
+            :py:func:`collection_get`, for the changed items.
+
+        Returns:
+            dict: dict in the form:
+
+            .. parsed-literal::
+
+                {
+                    "data": [ changed resource objects ],
+                    "included": [ optional included resource objects ],
+                    "links": {
+                        "self": url,
+                        "next": url for the changes after these
+                    },
+                    "meta": {
+                        "changes": {
+                            "token": new sync token,
+                            "more": true if there are more changes to fetch,
+                            "deleted": [ identifiers of deleted items ]
+                        }
+                    }
+                }
+
+        Raises:
+            HTTPBadRequest: if the token is bad.
+
+        Example:
+            .. parsed-literal::
+
+                http GET http://localhost:6543/posts/@changes?since=1234.56
+        '''
+        DBSession = self.get_dbsession()
+        conn = DBSession.connection()
+        since = self.request.params.get('since')
+        limit = min(
+            self.max_limit,
+            int(self.request.params.get('page[limit]', self.max_limit))
+        )
+        ret = {'data': [], 'meta': {'changes': {'deleted': []}}}
+        if since is None:
+            token = change_log.current_token(conn, self.collection_name)
+            more = False
+            rows = []
+        else:
+            try:
+                since = change_log.parse_token(since)
+            except ValueError:
+                raise HTTPBadRequest('Bad sync token {}.'.format(since))
+            rows = change_log.changes(
+                conn, self.collection_name, since, limit + 1
+            )
+            more = len(rows) > limit
+            rows = rows[:limit]
+            token = change_log.make_token(rows[-1]) if rows else\
+                self.request.params['since']
+
+        # The last change to each item decides how it is reported.
+        last_op = OrderedDict()
+        for row in rows:
+            last_op.pop(row['item_id'], None)
+            last_op[row['item_id']] = row['op']
+        changed_ids = [
+            item_id for item_id, op in last_op.items() if op != 'delete'
+        ]
+        found = set()
+        included = {}
+        if changed_ids:
+            q = DBSession.query(
+                self.model
+            ).options(
+                load_only(*self.allowed_requested_query_columns.keys())
+            ).filter(
+                self.model._jsonapi_id.in_(changed_ids)
+            ).order_by(self.model._jsonapi_id)
+            for item in q:
+                found.add(str(item._jsonapi_id))
+                ret['data'].append(self.serialise_db_item(item, included))
+        for item_id in last_op:
+            if item_id not in found:
+                # Deleted, or updated and then deleted.
+                ret['meta']['changes']['deleted'].append(
+                    self.serialise_resource_identifier(item_id)
+                )
+        if self.requested_include_names():
+            ret['included'] = [obj for obj in included.values()]
+
+        ret['meta']['changes']['token'] = token
+        ret['meta']['changes']['more'] = more
+        ret['links'] = {
+            'next': self.request.route_url(
+                self.changes_route_name,
+                _query=dict(self.request.params, since=token)
+            )
+        }
+        return ret
+
+    def subscribe(self):
+        '''Handle GET requests for a stream of changes to the collection.
+
+        Stream Server-Sent Events for each item created, updated or deleted
+        by a committed transaction, for as long as the client stays
+        connected. Each event is named for the operation (``create``,
+        ``update`` or ``delete``) and its data is the item's resource
+        identifier or, if requested, the resource object. Idle streams get a
+        keepalive comment every ``pyramid_jsonapi.subscriptions.heartbeat``
+        seconds. If the client falls too far behind, changes are dropped and
+        a ``reset`` event tells it to fetch the collection again.
+
+        **Query Parameters**
+
+            **filter[<attribute>:<op>]:** only send creates and updates for
+            items matching the filters (deletes are always sent).
+
+            **full:** ``true`` to send resource objects rather than
+            identifiers (``fields[<collection>]`` applies).
+
+        Returns:
+            pyramid.response.Response: ``text/event-stream`` response.
+
+        Example:
+            .. parsed-literal::
+
+                http --stream GET http://localhost:6543/posts/@subscribe?filter[author_id:eq]=1
+        '''
+        # Check the filters now, while errors can still be reported.
+        self.query_add_filtering(self.get_dbsession().query(self.model))
+        subscription = subscriptions.broker.subscribe(self.collection_name)
+        return Response(
+            app_iter=self.subscription_stream(subscription),
+            content_type='text/event-stream',
+            charset='utf-8',
+            cache_control='no-cache'
+        )
+
+    def subscription_stream(self, subscription):
+        '''Generate Server-Sent Events from a subscription.'''
+        event_id = 0
+        try:
+            # Tell the client the stream is open.
+            yield b': subscribed\n\n'
+            while True:
+                changes = subscription.get(timeout=subscriptions.heartbeat)
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    event_id += 1
+                    yield 'id: {}\nevent: reset\ndata: {{}}\n\n'.format(
+                        event_id
+                    ).encode('utf-8')
+                if changes is None:
+                    yield b': keepalive\n\n'
+                    continue
+                for op, data in self.subscription_events(changes):
+                    event_id += 1
+                    yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                        event_id, op,
+                        render('json', data, request=self.request)
+                    ).encode('utf-8')
+        finally:
+            subscription.close()
+
+    def subscription_events(self, changes):
+        '''(op, data) events to send for a batch of changes.
+
+        Created and updated items are checked against the request's filters
+        (and serialised, if requested) with one query in a transaction of
+        its own.
+        '''
+        full = self.request.params.get('full', 'false') == 'true'
+        ids = [c['id'] for c in changes if c['op'] != 'delete']
+        items = {}
+        if ids:
+            with transaction.manager:
+                q = self.get_dbsession().query(
+                    self.model
+                ).filter(self.model._jsonapi_id.in_(ids))
+                q = self.query_add_filtering(q)
+                if full:
+                    q = q.options(
+                        load_only(*self.allowed_requested_query_columns)
+                    )
+                    for item in q:
+                        items[str(item._jsonapi_id)] = self.serialise_db_item(
+                            item, {}
+                        )
+                else:
+                    q = q.options(load_only(self.key_column.name))
+                    for item in q:
+                        items[str(item._jsonapi_id)] =\
+                            self.serialise_resource_identifier(
+                                item._jsonapi_id
+                            )
+        for change in changes:
+            if change['op'] == 'delete':
+                yield 'delete', self.serialise_resource_identifier(
+                    change['id']
+                )
+            elif change['id'] in items:
+                data = items[change['id']]
+                if data.get('meta', {}).get('errors'):
+                    # Forbidden.
+                    continue
+                yield change['op'], data
+
+    @jsonapi_view
+    def collection_post(self):
+        '''Handle POST requests for the collection.
+
+        Create a new object in collection.
+
+        **Request Body**
+
+            **resource object** (*json*) in the form:
+
+            .. parsed-literal::
+
+                {
+                    "data": { resource object }
+                }
+
+            or an array of resource objects to create them all at once (see
+            :py:func:`collection_post_bulk`).
+
+        On PostgreSQL, if the model allows :py:attr:`direct_writes` and no
+        to-many relationships are set, the item is created with one
+        ``INSERT ... RETURNING`` statement which also reads back any server
+        generated values.
+
+        **Query Parameters**
+
+            **upsert:** ``true`` to update the item if one with the same id
+            already exists (see :py:func:`upsert_rows`). The response is then
+            ``200 OK`` rather than ``201 Created`` and the resource object's
+            ``meta.upsert`` says whether it was ``created`` or ``updated``.
+
+        **Request Headers**
+
+            **Prefer:** ``return=minimal`` to get only a resource identifier
+            for the new item back.
+
+        Returns:
+            dict: dict in the form:
+
+            .. parsed-literal::
+
+                {
+                    "data": { resource object },
                     "links": {
                         "self": self url,
                         maybe other links...
@@ -848,8 +2237,8 @@ class CollectionViewBase:
             HTTPConflict: if type is not present or is different from the
             collection name.
 
-            HTTPNotFound: if a non existent relationship is referenced in the
-            supplied resource object.
+            HTTPNotFound: if a non existent relationship or related item is
+            referenced in the supplied resource object.
 
             HTTPConflict: if creating the object would break a database
             constraint (most commonly if an id is supplied by the client and
@@ -871,6 +2260,8 @@ class CollectionViewBase:
         '''
         DBSession = self.get_dbsession()
         data = self.request.json_body['data']
+        if isinstance(data, list):
+            return self.collection_post_bulk(data)
 
         # Alter data with any callbacks.
         for callback in self.callbacks['before_collection_post']:
@@ -885,66 +2276,893 @@ class CollectionViewBase:
         datatype = data.get('type')
         if datatype != self.collection_name:
             raise HTTPConflict("Unsupported type '{}'".format(datatype))
+        upsert = self.upsert_requested([data])
         atts = data['attributes']
         if 'id' in data:
             atts['id'] = data['id']
-        item = self.model(**atts)
         mapper = sqlalchemy.inspect(self.model).mapper
-        with DBSession.no_autoflush:
-            for relname, reldata in data.get('relationships', {}).items():
-                try:
-                    rel = mapper.relationships[relname]
-                except KeyError:
-                    raise HTTPNotFound(
-                        'No relationship {} in collection {}'.format(
-                            relname,
-                            self.collection_name
-                        )
-                    )
-                rel_class = rel.mapper.class_
-                if rel.direction is ONETOMANY or rel.direction is MANYTOMANY:
-                    setattr(
-                        item, relname,
-                        [
-                            DBSession.query(rel_class).get(
-                                rel_identifier['id']
-                            )
-                            for rel_identifier in reldata['data']
-                        ]
-                    )
-                else:
-                    setattr(
-                        item,
+        rels = data.get('relationships', {})
+        refs = []
+        for relname, reldata in rels.items():
+            try:
+                rel = mapper.relationships[relname]
+            except KeyError:
+                raise HTTPNotFound(
+                    'No relationship {} in collection {}'.format(
                         relname,
-                        DBSession.query(rel_class).get(
-                            reldata['data']['id'])
-                        )
+                        self.collection_name
+                    )
+                )
+            rel_view = self.view_instance(rel.mapper.class_)
+            if rel.direction is ONETOMANY or rel.direction is MANYTOMANY:
+                refs.extend(
+                    (rel_view, rel_identifier)
+                    for rel_identifier in reldata['data']
+                )
+            elif reldata['data'] is not None:
+                refs.append((rel_view, reldata['data']))
+        # A new item's to-many relationships hold exactly what was asked for,
+        # so serialising it needn't query them.
+        related = {
+            key: [] for key, rel in self.relationships.items()
+            if rel.direction is ONETOMANY or rel.direction is MANYTOMANY
+        }
+        direct = upsert or (
+            self.direct_writes and
+            DBSession.get_bind().dialect.name == 'postgresql' and
+            atts.keys() - {'id'} <= self.attributes.keys() and
+            all(
+                mapper.relationships[relname].direction is MANYTOONE
+                for relname in rels
+            )
+        )
         try:
-            DBSession.add(item)
-            DBSession.flush()
+            with DBSession.no_autoflush:
+                rel_items = iter(self.resolve_identifiers(refs))
+                if direct:
+                    row = {
+                        self.attributes[name]: value
+                        for name, value in atts.items() if name != 'id'
+                    }
+                    if 'id' in data:
+                        row[self.key_column] = data['id']
+                    for relname, reldata in rels.items():
+                        rel = mapper.relationships[relname]
+                        rel_item = None
+                        if reldata['data'] is not None:
+                            rel_item = next(rel_items)
+                        for remote, local in rel.synchronize_pairs:
+                            row[local] = None
+                            if rel_item is not None:
+                                row[local] = getattr(
+                                    rel_item,
+                                    rel.mapper.get_property_by_column(
+                                        remote
+                                    ).key
+                                )
+                    if upsert:
+                        ((item_id, created),) = self.upsert_rows([row])
+                        record_changes(DBSession, [{
+                            'collection': self.collection_name,
+                            'item_id': str(item_id),
+                            'op': 'create' if created else 'update',
+                        }])
+                        item = self.load_items(
+                            [str(item_id)], full_object=True
+                        )[str(item_id)]
+                    else:
+                        item = self.direct_insert(row)
+                else:
+                    item = self.model(**atts)
+                    for relname, reldata in rels.items():
+                        rel = mapper.relationships[relname]
+                        if rel.direction is ONETOMANY or\
+                                rel.direction is MANYTOMANY:
+                            related[relname] = [
+                                next(rel_items) for _ in reldata['data']
+                            ]
+                            setattr(item, relname, related[relname])
+                        elif reldata['data'] is None:
+                            setattr(item, relname, None)
+                        else:
+                            setattr(item, relname, next(rel_items))
+                    DBSession.add(item)
+                    DBSession.flush()
         except sqlalchemy.exc.IntegrityError as e:
             raise HTTPConflict(e.args[0])
-        self.request.response.status_code = 201
-        self.request.response.headers['Location'] = self.request.route_url(
-            self.item_route_name,
-            **{'id': item._jsonapi_id}
-        )
-        return {
-            'data': self.serialise_db_item(item, {})
-        }
+        if upsert and not created:
+            self.request.response.status_code = 200
+            # An existing item keeps its to-many relationships.
+            related = {}
+        else:
+            self.request.response.status_code = 201
+            self.request.response.headers['Location'] =\
+                self.request.route_url(
+                    self.item_route_name,
+                    **{'id': item._jsonapi_id}
+                )
+        if self.prefer_minimal:
+            self.request.response.headers['Preference-Applied'] =\
+                'return=minimal'
+            ret = self.serialise_resource_identifier(item._jsonapi_id)
+        else:
+            ret = self.serialise_db_item(item, {}, related=related)
+        if upsert:
+            ret['meta'] = {'upsert': 'created' if created else 'updated'}
+        return {'data': ret}
+
+    def collection_post_bulk(self, data):
+        '''Create many objects in the collection from an array.
+
+        The whole array is checked before anything is written: if any
+        resource object is bad the response lists an error for each problem
+        (with a ``source.pointer`` into the array) and nothing is created.
+        Related items referenced by the array are looked up with one query
+        per related collection.
+
+        Items are then inserted ``bulk_chunk_size`` rows per statement
+        (returning the new ids on PostgreSQL), and to-many relationships are
+        set with one statement per item (or one for all rows of an
+        association table). The ORM is bypassed: model validators and
+        session events don't run, although the change log and subscriptions
+        are told about the new items. Everything happens in the request's
+        transaction, so either all items are created or none are.
+
+        Bulk create is only enabled if ``pyramid_jsonapi.bulk.max_items`` is
+        set: arrays longer than that are rejected.
 
-    @jsonapi_view
-    def related_get(self):
-        '''Handle GET requests for related URLs.
+        **Query Parameters**
 
-        Get object(s) related to a specified object.
+            **return:** ``objects`` (the default) to return resource objects
+            for the new items, or ``identifiers`` to return only resource
+            identifiers. ``identifiers`` is the default if the request has a
+            ``Prefer: return=minimal`` header.
 
-        **URL (matchdict) Parameters**
+            **upsert:** ``true`` to update items which already exist, as for
+            :py:func:`collection_post`.
 
-            **id** (*str*): resource id
-            **relname** (*str*): relationship name
+        Parameters:
+            data (list): resource objects.
 
-        **Query Parameters**
+        Returns:
+            dict: ``{"data": [ resource objects or identifiers ]}`` in the
+            order of the request, or ``{"errors": [ error objects ]}``.
+
+        Raises:
+            HTTPBadRequest: if bulk create isn't enabled or there are too many
+            items.
+
+            HTTPConflict: if creating the items would break a database
+            constraint.
+        '''
+        if not self.bulk_max_items:
+            raise HTTPBadRequest('Bulk create is not enabled.')
+        if len(data) > self.bulk_max_items:
+            raise HTTPBadRequest(
+                'At most {} items may be created at once.'.format(
+                    self.bulk_max_items
+                )
+            )
+        ret_format = self.request.params.get(
+            'return', 'identifiers' if self.prefer_minimal else 'objects'
+        )
+        if ret_format not in ('objects', 'identifiers'):
+            raise HTTPBadRequest(
+                'return must be one of objects, identifiers'
+            )
+        DBSession = self.get_dbsession()
+        allow_ids = self.request.registry.settings.get(
+            'pyramid_jsonapi.allow_client_ids', 'false'
+        ) == 'true'
+        errors = []
+
+        def error(exc_class, detail, pointer):
+            errors.append({
+                'code': str(exc_class.code),
+                'title': exc_class.title,
+                'detail': detail,
+                'source': {'pointer': pointer},
+            })
+
+        # Check everything and gather references to related items.
+        items = []
+        refs = {}
+        for i, item in enumerate(data):
+            pointer = '/data/{}'.format(i)
+            if not isinstance(item, dict):
+                error(HTTPBadRequest, 'Not a resource object.', pointer)
+                continue
+            for callback in self.callbacks['before_collection_post']:
+                item = callback(self, item)
+            items.append((i, item))
+            if 'id' in item and not allow_ids:
+                error(
+                    HTTPForbidden, 'Client generated ids are not supported.',
+                    pointer + '/id'
+                )
+            if item.get('type') != self.collection_name:
+                error(
+                    HTTPConflict,
+                    "Unsupported type '{}'".format(item.get('type')),
+                    pointer + '/type'
+                )
+            members = {}
+            for member in ('attributes', 'relationships'):
+                members[member] = item.get(member, {})
+                if not isinstance(members[member], dict):
+                    error(
+                        HTTPBadRequest,
+                        '{} must be an object.'.format(member),
+                        '{}/{}'.format(pointer, member)
+                    )
+                    members[member] = {}
+            for name in members['attributes']:
+                if name not in self.attributes:
+                    error(
+                        HTTPBadRequest,
+                        'No attribute {} in collection {}'.format(
+                            name, self.collection_name
+                        ),
+                        '{}/attributes/{}'.format(pointer, name)
+                    )
+            for relname, reldata in members['relationships'].items():
+                rel_pointer = '{}/relationships/{}'.format(pointer, relname)
+                if relname not in self.relationships:
+                    error(
+                        HTTPNotFound,
+                        'No relationship {} in collection {}'.format(
+                            relname, self.collection_name
+                        ),
+                        rel_pointer
+                    )
+                    continue
+                if not isinstance(reldata, dict) or 'data' not in reldata:
+                    error(
+                        HTTPBadRequest,
+                        'Relationship {} must be an object with '
+                        'data.'.format(relname),
+                        rel_pointer
+                    )
+                    continue
+                rel = self.relationships[relname]
+                rel_view = self.view_instance(rel.mapper.class_)
+                identifiers = reldata['data']
+                if rel.direction is MANYTOONE:
+                    if identifiers is None:
+                        continue
+                    if not isinstance(identifiers, dict):
+                        error(
+                            HTTPBadRequest,
+                            'Expected a resource identifier or null.',
+                            rel_pointer + '/data'
+                        )
+                        continue
+                    identifiers = [(rel_pointer + '/data', identifiers)]
+                else:
+                    if not isinstance(identifiers, list):
+                        error(
+                            HTTPBadRequest,
+                            'Expected an array of resource identifiers.',
+                            rel_pointer + '/data'
+                        )
+                        continue
+                    identifiers = [
+                        ('{}/data/{}'.format(rel_pointer, j), identifier)
+                        for j, identifier in enumerate(identifiers)
+                    ]
+                for ident_pointer, identifier in identifiers:
+                    if not isinstance(identifier, dict):
+                        error(
+                            HTTPBadRequest,
+                            'Expected a resource identifier.',
+                            ident_pointer
+                        )
+                    elif identifier.get('type') != rel_view.collection_name:
+                        error(
+                            HTTPConflict,
+                            'Type {} does not match relationship type '
+                            '{}'.format(
+                                identifier.get('type'),
+                                rel_view.collection_name
+                            ),
+                            ident_pointer + '/type'
+                        )
+                    elif identifier.get('id') is None:
+                        error(
+                            HTTPBadRequest,
+                            'An id is required in a resource identifier.',
+                            ident_pointer
+                        )
+                    else:
+                        refs.setdefault(rel_view, {}).setdefault(
+                            str(identifier['id']), []
+                        ).append(ident_pointer)
+
+        # Look up all the referenced items, one query per collection.
+        related = {}
+        for rel_view, ids in refs.items():
+            related[rel_view] = rel_view.load_items(ids)
+            for obj_id, pointers in ids.items():
+                if obj_id not in related[rel_view]:
+                    for pointer in pointers:
+                        error(
+                            HTTPNotFound,
+                            '{}/{} not found'.format(
+                                rel_view.collection_name, obj_id
+                            ),
+                            pointer
+                        )
+        if errors:
+            codes = {e['code'] for e in errors}
+            self.request.response.status_code =\
+                int(codes.pop()) if len(codes) == 1 else 400
+            return {'errors': errors}
+        upsert = self.upsert_requested([item for _, item in items])
+
+        # Rows for the collection's table, with to-one relationships as
+        # foreign key values.
+        rows = []
+        for i, item in items:
+            row = {
+                self.attributes[name]: value
+                for name, value in item.get('attributes', {}).items()
+            }
+            if 'id' in item:
+                row[self.key_column] = item['id']
+            for relname, reldata in item.get('relationships', {}).items():
+                rel = self.relationships[relname]
+                if rel.direction is not MANYTOONE:
+                    continue
+                rel_view = self.view_instance(rel.mapper.class_)
+                rel_item = None
+                if reldata['data'] is not None:
+                    rel_item = related[rel_view][str(reldata['data']['id'])]
+                for remote, local in rel.synchronize_pairs:
+                    row[local] = None if rel_item is None else getattr(
+                        rel_item, rel.mapper.get_property_by_column(remote).key
+                    )
+            rows.append(row)
+        try:
+            if upsert:
+                upserted = self.upsert_rows(rows)
+            else:
+                upserted = [
+                    (new_id, True) for new_id in self.bulk_insert(rows)
+                ]
+            new_ids = [new_id for new_id, _ in upserted]
+            changes = [
+                {
+                    'collection': self.collection_name,
+                    'item_id': str(new_id),
+                    'op': 'create' if created else 'update',
+                }
+                for new_id, created in upserted
+            ]
+            secondary_rows = {}
+            for (i, item), row, new_id in zip(items, rows, new_ids):
+                row[self.key_column] = new_id
+                for relname, reldata in item.get(
+                    'relationships', {}
+                ).items():
+                    rel = self.relationships[relname]
+                    if rel.direction is MANYTOONE or not reldata['data']:
+                        continue
+                    rel_view = self.view_instance(rel.mapper.class_)
+                    rel_items = [
+                        related[rel_view][str(identifier['id'])]
+                        for identifier in reldata['data']
+                    ]
+                    if rel.direction is ONETOMANY:
+                        # Point the related items at the new item.
+                        rel_ids = [obj._jsonapi_id for obj in rel_items]
+                        DBSession.execute(
+                            rel_view.key_column.table.update().where(
+                                rel_view.key_column.in_(rel_ids)
+                            ).values({
+                                remote.key: row.get(local)
+                                for local, remote in rel.synchronize_pairs
+                            })
+                        )
+                        changes.extend(
+                            {
+                                'collection': rel_view.collection_name,
+                                'item_id': str(rel_id),
+                                'op': 'update',
+                            }
+                            for rel_id in rel_ids
+                        )
+                    else:
+                        secondary_rows.setdefault(rel.secondary, []).extend(
+                            dict(
+                                {
+                                    secondary.key: row.get(local)
+                                    for local, secondary
+                                    in rel.synchronize_pairs
+                                },
+                                **{
+                                    secondary.key: getattr(
+                                        rel_item,
+                                        rel.mapper.get_property_by_column(
+                                            remote
+                                        ).key
+                                    )
+                                    for remote, secondary
+                                    in rel.secondary_synchronize_pairs
+                                }
+                            )
+                            for rel_item in rel_items
+                        )
+            for table, table_rows in secondary_rows.items():
+                DBSession.execute(table.insert(), table_rows)
+        except sqlalchemy.exc.IntegrityError as e:
+            raise HTTPConflict(e.args[0])
+        record_changes(DBSession, changes)
+
+        self.request.response.status_code = 201
+        if upsert and not any(created for _, created in upserted):
+            self.request.response.status_code = 200
+        if ret_format == 'identifiers':
+            if self.prefer_minimal:
+                self.request.response.headers['Preference-Applied'] =\
+                    'return=minimal'
+            ret = [
+                self.serialise_resource_identifier(new_id)
+                for new_id in new_ids
+            ]
+        else:
+            new_items = self.load_items(
+                [str(new_id) for new_id in new_ids], full_object=True
+            )
+            ret = [
+                self.serialise_db_item(new_items[str(new_id)], {})
+                for new_id in new_ids
+            ]
+        if upsert:
+            for obj, (_, created) in zip(ret, upserted):
+                obj['meta'] = {'upsert': 'created' if created else 'updated'}
+        return {'data': ret}
+
+    def bulk_insert(self, rows):
+        '''Insert rows into the collection's table, returning their ids.
+
+        Rows are inserted ``bulk_chunk_size`` at a time. Rows with the same
+        columns go in the same statements: an executemany if the ids are all
+        known, else (on PostgreSQL) a multi row ``INSERT ... RETURNING``.
+        Other databases insert rows without ids one at a time to find out the
+        new ids.
+
+        Parameters:
+            rows (list): dicts mapping table columns to values.
+
+        Returns:
+            list: ids of the new rows, in the same order as rows.
+        '''
+        DBSession = self.get_dbsession()
+        table = self.key_column.table
+        key = self.key_column
+        returning = DBSession.get_bind().dialect.name == 'postgresql'
+        groups = OrderedDict()
+        for i, row in enumerate(rows):
+            groups.setdefault(frozenset(row), []).append(i)
+        ids = [None] * len(rows)
+        for columns, indexes in groups.items():
+            for start in range(0, len(indexes), self.bulk_chunk_size):
+                chunk = indexes[start:start + self.bulk_chunk_size]
+                values = [
+                    {col.key: value for col, value in rows[i].items()}
+                    for i in chunk
+                ]
+                if key in columns:
+                    DBSession.execute(table.insert(), values)
+                    new_ids = [rows[i][key] for i in chunk]
+                elif returning and columns:
+                    new_ids = [
+                        row[0] for row in DBSession.execute(
+                            table.insert().values(values).returning(key)
+                        )
+                    ]
+                else:
+                    new_ids = [
+                        DBSession.execute(
+                            table.insert(), value
+                        ).inserted_primary_key[0]
+                        for value in values
+                    ]
+                for i, new_id in zip(chunk, new_ids):
+                    ids[i] = new_id
+        return ids
+
+    def upsert_requested(self, items):
+        '''Whether a POST should also update items which already exist.
+
+        **Query Parameters**
+
+            **upsert:** ``true`` to create or update the posted items.
+
+        Parameters:
+            items (list): posted resource objects.
+
+        Returns:
+            bool: True if an upsert was asked for (and is possible).
+
+        Raises:
+            HTTPBadRequest: if the model can't be written without the ORM
+            (see :py:func:`direct_writes`), or an item has no id or a
+            duplicate id, or sets a to-many relationship.
+
+            HTTPForbidden: if the collection has ``before_patch`` callbacks,
+            which updating items this way would bypass.
+        '''
+        if self.request.params.get('upsert', 'false') != 'true':
+            return False
+        if self.callbacks['before_patch']:
+            raise HTTPForbidden(
+                'Collection {} has before_patch callbacks: upsert is not '
+                'allowed.'.format(self.collection_name)
+            )
+        if not self.direct_writes:
+            # Upserts are written with core statements: validators, mapper
+            # events and version counters would silently be skipped.
+            raise HTTPBadRequest(
+                'Collection {} needs the ORM to write items: upsert is not '
+                'supported.'.format(self.collection_name)
+            )
+        seen = set()
+        for item in items:
+            if item.get('id') is None:
+                raise HTTPBadRequest('Upsert needs an id for every item.')
+            if str(item['id']) in seen:
+                raise HTTPBadRequest(
+                    'Item {} appears more than once.'.format(item['id'])
+                )
+            seen.add(str(item['id']))
+            for name in item.get('attributes', {}):
+                if name not in self.attributes:
+                    raise HTTPBadRequest(
+                        'No attribute {} in collection {}'.format(
+                            name, self.collection_name
+                        )
+                    )
+            for relname in item.get('relationships', {}):
+                rel = self.relationships.get(relname)
+                if rel is not None and rel.direction is not MANYTOONE:
+                    raise HTTPBadRequest(
+                        'Upsert cannot set to-many relationship {}.'.format(
+                            relname
+                        )
+                    )
+        return True
+
+    def upsert_rows(self, rows):
+        '''Insert rows, or update the existing rows with the same ids.
+
+        Only the columns present in a row are updated. On PostgreSQL each
+        ``bulk_chunk_size`` rows with the same columns are written by one
+        ``INSERT ... ON CONFLICT (id) DO UPDATE ... RETURNING`` statement,
+        which also reports which rows were new. Other databases look up
+        which ids exist, then update those rows and insert the others.
+
+        Parameters:
+            rows (list): dicts mapping table columns to values, all including
+                the key column.
+
+        Returns:
+            list: ``(id, created)`` tuples in the same order as rows.
+        '''
+        DBSession = self.get_dbsession()
+        table = self.key_column.table
+        key = self.key_column
+        created = {}
+        if DBSession.get_bind().dialect.name == 'postgresql':
+            groups = OrderedDict()
+            for row in rows:
+                groups.setdefault(frozenset(row), []).append(row)
+            for columns, group in groups.items():
+                for start in range(0, len(group), self.bulk_chunk_size):
+                    chunk = group[start:start + self.bulk_chunk_size]
+                    stmt = postgresql.insert(table).values([
+                        {col.key: value for col, value in row.items()}
+                        for row in chunk
+                    ])
+                    updates = {
+                        col.key: stmt.excluded[col.key]
+                        for col in columns if col is not key
+                    }
+                    if updates:
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=[key], set_=updates
+                        )
+                    else:
+                        stmt = stmt.on_conflict_do_nothing(
+                            index_elements=[key]
+                        )
+                    # xmax is only 0 for rows the statement inserted.
+                    stmt = stmt.returning(
+                        key, sqlalchemy.literal_column('xmax = 0')
+                    )
+                    created.update(
+                        (str(item_id), is_new)
+                        for item_id, is_new in DBSession.execute(stmt)
+                    )
+        else:
+            ids = [row[key] for row in rows]
+            existing = set()
+            for start in range(0, len(ids), self.bulk_chunk_size):
+                existing.update(
+                    str(item_id) for (item_id,) in DBSession.execute(
+                        sqlalchemy.select([key]).where(
+                            key.in_(ids[start:start + self.bulk_chunk_size])
+                        )
+                    )
+                )
+            inserts = [row for row in rows if str(row[key]) not in existing]
+            self.bulk_insert(inserts)
+            for row in rows:
+                if str(row[key]) not in existing:
+                    continue
+                values = {
+                    col: value for col, value in row.items() if col is not key
+                }
+                if values:
+                    DBSession.execute(
+                        table.update().where(key == row[key]).values(values)
+                    )
+            created = {
+                str(item_id): str(item_id) not in existing for item_id in ids
+            }
+        for row in rows:
+            for obj in self.session_items(row[key]):
+                DBSession.expire(obj)
+        return [
+            (row[key], bool(created.get(str(row[key])))) for row in rows
+        ]
+
+    @property
+    def prefer_minimal(self):
+        '''Whether the request asks for a minimal response.
+
+        **Request Headers**
+
+            **Prefer:** ``return=minimal`` (RFC 7240).
+
+        Returns:
+            bool: True if ``return=minimal`` is among the preferences.
+        '''
+        prefs = re.split(
+            r'\s*[,;]\s*', self.request.headers.get('prefer', '').strip()
+        )
+        return 'return=minimal' in prefs
+
+    @property
+    def direct_writes(self):
+        '''Whether single items may be written without the ORM.
+
+        Writing a row directly saves loading it first (PATCH) or reading
+        back server generated values afterwards (POST). That is only
+        equivalent to going through the ORM if the model maps plain columns
+        of one table, has no version counter and nothing listens for its
+        inserts, updates or attribute changes (which includes validators).
+
+        Returns:
+            bool: True if the model can be written directly.
+        '''
+        mapper = sqlalchemy.inspect(self.model).mapper
+        if len(mapper.tables) != 1 or mapper.version_id_col is not None:
+            return False
+        for event in (
+            'before_insert', 'after_insert', 'before_update', 'after_update'
+        ):
+            if getattr(mapper.dispatch, event):
+                return False
+        for prop in mapper.column_attrs:
+            if mapper.class_manager[prop.key].dispatch.set:
+                return False
+            for col in prop.columns:
+                if getattr(col, 'table', None) is not mapper.local_table:
+                    return False
+        return True
+
+    def direct_insert(self, row):
+        '''Insert one row with ``INSERT ... RETURNING`` (PostgreSQL only).
+
+        The returned values, including any generated by the server, are used
+        to build a persistent item in the session, so nothing needs to be
+        read back to serialise it.
+
+        Parameters:
+            row (dict): mapping of table columns to values.
+
+        Returns:
+            the new item.
+        '''
+        DBSession = self.get_dbsession()
+        mapper = sqlalchemy.inspect(self.model).mapper
+        table = self.key_column.table
+        values = DBSession.execute(
+            table.insert().values(row).returning(*table.columns)
+        ).first()
+        item = mapper.class_manager.new_instance()
+        for prop in mapper.column_attrs:
+            set_committed_value(item, prop.key, values[prop.columns[0]])
+        make_transient_to_detached(item)
+        DBSession.add(item)
+        record_changes(DBSession, [{
+            'collection': self.collection_name,
+            'item_id': str(item._jsonapi_id),
+            'op': 'create',
+        }])
+        return item
+
+    def direct_update(self, obj_id, atts):
+        '''Update attributes of one item with a single ``UPDATE``.
+
+        Whether the item exists is told by the number of rows updated, so it
+        is never loaded. Any copy of it already in the session is expired.
+
+        Parameters:
+            obj_id (str): id of the item.
+            atts (dict): mapping of attribute names to new values.
+
+        Raises:
+            HTTPNotFound: if there is no item with id obj_id.
+        '''
+        DBSession = self.get_dbsession()
+        if atts:
+            found = DBSession.execute(
+                self.key_column.table.update().where(
+                    self.key_column == obj_id
+                ).values({
+                    self.attributes[name]: value
+                    for name, value in atts.items()
+                })
+            ).rowcount > 0
+        else:
+            found = self.object_exists(obj_id)
+        if not found:
+            raise HTTPNotFound(
+                'Cannot PATCH a non existent resource ({}/{})'.format(
+                    self.collection_name, obj_id
+                )
+            )
+        if not atts:
+            return
+        for obj in self.session_items(obj_id):
+            DBSession.expire(obj)
+        record_changes(DBSession, [{
+            'collection': self.collection_name,
+            'item_id': str(obj_id),
+            'op': 'update',
+        }])
+
+    def session_items(self, obj_id):
+        '''Copies of an item already loaded into the session.
+
+        Parameters:
+            obj_id (str): id of the item.
+
+        Returns:
+            list: items of this collection in the session's identity map
+            with id obj_id.
+        '''
+        return self.loaded_items([obj_id])
+
+    def loaded_items(self, item_ids=None):
+        '''Items of this collection already loaded into the session.
+
+        Parameters:
+            item_ids (iterable): only items with these ids (default all).
+
+        Returns:
+            list: items in the session's identity map.
+        '''
+        if item_ids is not None:
+            item_ids = {str(item_id) for item_id in item_ids}
+        return [
+            obj for obj in self.get_dbsession().identity_map.values()
+            if isinstance(obj, self.model) and (
+                item_ids is None or str(obj._jsonapi_id) in item_ids
+            )
+        ]
+
+    def resolve_identifiers(self, refs):
+        '''Load the items referred to by resource identifiers.
+
+        The ids are gathered by collection and each collection's items are
+        loaded (key column only) with a single ``IN`` query (per
+        ``bulk_chunk_size`` ids). Every bad identifier is reported in one
+        error rather than stopping at the first.
+
+        Parameters:
+            refs (list): (view class, resource identifier) pairs, where the
+                identifier should refer to an item of the view's collection.
+
+        Returns:
+            list: items in the same order as refs.
+
+        Raises:
+            HTTPConflict: if any identifier's type is not the collection's.
+
+            HTTPBadRequest: if any identifier has no id.
+
+            HTTPNotFound: if any referenced item does not exist.
+        '''
+        wrong_types = [
+            "'{}' (expected '{}')".format(
+                identifier.get('type'), rel_view.collection_name
+            )
+            for rel_view, identifier in refs
+            if identifier.get('type') != rel_view.collection_name
+        ]
+        if wrong_types:
+            raise HTTPConflict(
+                'Resource identifier types do not match relationship '
+                'types: {}.'.format(', '.join(wrong_types))
+            )
+        if any(identifier.get('id') is None for _, identifier in refs):
+            raise HTTPBadRequest(
+                'An id is required in a resource identifier.'
+            )
+        ids = OrderedDict()
+        for rel_view, identifier in refs:
+            ids.setdefault(rel_view, OrderedDict())[str(identifier['id'])] =\
+                None
+        found = {
+            rel_view: rel_view.load_items(rel_ids)
+            for rel_view, rel_ids in ids.items()
+        }
+        missing = [
+            '{}/{}'.format(rel_view.collection_name, obj_id)
+            for rel_view, rel_ids in ids.items()
+            for obj_id in rel_ids
+            if obj_id not in found[rel_view]
+        ]
+        if missing:
+            raise HTTPNotFound('Not found: {}.'.format(', '.join(missing)))
+        return [
+            found[rel_view][str(identifier['id'])]
+            for rel_view, identifier in refs
+        ]
+
+    def load_items(self, ids, full_object=False):
+        '''Load items of the collection by id, with one query per chunk.
+
+        Parameters:
+            ids (iterable): ids (as strings) of the items to load.
+
+            full_object (bool): load all requested columns if ``True``, else
+                only the key column.
+
+        Returns:
+            dict: items found, by id (as a string).
+        '''
+        DBSession = self.get_dbsession()
+        if full_object:
+            columns = self.allowed_requested_query_columns.keys()
+        else:
+            columns = [self.key_column.name]
+        key = getattr(self.model, self.key_column.name)
+        ids = list(ids)
+        found = {}
+        for start in range(0, len(ids), self.bulk_chunk_size):
+            q = DBSession.query(self.model).options(
+                load_only(*columns)
+            ).filter(key.in_(ids[start:start + self.bulk_chunk_size]))
+            for item in q:
+                found[str(item._jsonapi_id)] = item
+        return found
+
+    @jsonapi_view
+    def related_get(self):
+        '''Handle GET requests for related URLs.
+
+        Get object(s) related to a specified object.
+
+        **URL (matchdict) Parameters**
+
+            **id** (*str*): resource id
+            **relname** (*str*): relationship name
+
+        **Query Parameters**
             **sort:** comma separated list of sort keys.
 
             **filter[<attribute>:<op>]:** filter operation.
@@ -979,9 +3197,10 @@ class CollectionViewBase:
                 }
 
         Raises:
-            HTTPNotFound: if `relname` is not found as a relationship.
+            HTTPNotFound: if `relname` is not found as a relationship or the
+            resource doesn't exist.
 
-            HTTPBadRequest: if a bad filter is used.
+            HTTPBadRequest: if a bad filter or ``page[sample]`` is used.
 
         Examples:
             Get the author of post 1:
@@ -1003,13 +3222,6 @@ class CollectionViewBase:
         rel_class = rel.mapper.class_
         rel_view = self.view_instance(rel_class)
 
-        # Check that the original resource exists.
-        if not self.object_exists(obj_id):
-            raise HTTPNotFound('Object {} not found in collection {}'.format(
-                obj_id,
-                self.collection_name
-            ))
-
         # Set up the query
         q = self.related_query(obj_id, rel)
 
@@ -1017,19 +3229,33 @@ class CollectionViewBase:
             q = rel_view.query_add_sorting(q)
             q = rel_view.query_add_filtering(q)
             qinfo = rel_view.collection_query_info(self.request)
+            if 'sample' in qinfo['_page']:
+                # Sampling works on the whole table.
+                raise HTTPBadRequest(
+                    'page[sample] is only supported on collections.'
+                )
             try:
-                count = q.count()
+                count_info = rel_view.query_count(q)
             except sqlalchemy.exc.ProgrammingError as e:
                 raise HTTPBadRequest(
                     "Could not use operator '{}' with field '{}'".format(
                         op, prop.name
                     )
                 )
-            q = q.offset(qinfo['page[offset]'])
-            q = q.limit(qinfo['page[limit]'])
-            ret = rel_view.collection_return(q, count=count)
+            q = rel_view.query_add_paging(q)
+            ret = rel_view.collection_return(q, count_info=count_info)
+            found = bool(ret['data'])
         else:
             ret = rel_view.single_return(q)
+            found = ret['data'] is not None
+
+        # The related query joins from the original resource, so only look
+        # for the resource itself if nothing was found.
+        if not found and not self.object_exists(obj_id):
+            raise HTTPNotFound('Object {} not found in collection {}'.format(
+                obj_id,
+                self.collection_name
+            ))
 
         # Alter return dict with any callbacks.
         for callback in self.callbacks['after_related_get']:
@@ -1082,7 +3308,7 @@ class CollectionViewBase:
                 }
 
         Raises:
-            HTTPBadRequest: if a bad filter is used.
+            HTTPBadRequest: if a bad filter or ``page[sample]`` is used.
 
         Examples:
             Get an identifer for the author of post 1:
@@ -1104,13 +3330,6 @@ class CollectionViewBase:
         rel_class = rel.mapper.class_
         rel_view = self.view_instance(rel_class)
 
-        # Check that the original resource exists.
-        if not self.object_exists(obj_id):
-            raise HTTPNotFound('Object {} not found in collection {}'.format(
-                obj_id,
-                self.collection_name
-            ))
-
         # Set up the query
         q = self.related_query(obj_id, rel, full_object=False)
 
@@ -1118,23 +3337,37 @@ class CollectionViewBase:
             q = rel_view.query_add_sorting(q)
             q = rel_view.query_add_filtering(q)
             qinfo = rel_view.collection_query_info(self.request)
+            if 'sample' in qinfo['_page']:
+                # Sampling works on the whole table.
+                raise HTTPBadRequest(
+                    'page[sample] is only supported on collections.'
+                )
             try:
-                count = q.count()
+                count_info = rel_view.query_count(q)
             except sqlalchemy.exc.ProgrammingError as e:
                 raise HTTPBadRequest(
                     "Could not use operator '{}' with field '{}'".format(
                         op, prop.name
                     )
                 )
-            q = q.offset(qinfo['page[offset]'])
-            q = q.limit(qinfo['page[limit]'])
+            q = rel_view.query_add_paging(q)
             ret = rel_view.collection_return(
                 q,
-                count=count,
+                count_info=count_info,
                 identifiers=True
             )
+            found = bool(ret['data'])
         else:
             ret = rel_view.single_return(q, identifier=True)
+            found = ret['data'] is not None
+
+        # The related query joins from the original resource, so only look
+        # for the resource itself if nothing was found.
+        if not found and not self.object_exists(obj_id):
+            raise HTTPNotFound('Object {} not found in collection {}'.format(
+                obj_id,
+                self.collection_name
+            ))
 
         # Alter return dict with any callbacks.
         for callback in self.callbacks['after_relationships_get']:
@@ -1183,6 +3416,8 @@ class CollectionViewBase:
             HTTPConflict: if a resource identifier is specified with a
             different type than that which the collection holds.
 
+            HTTPNotFound: if any of the specified resources don't exist.
+
             HTTPFailedDependency: if a database constraint would be broken by
             adding the specified resource to the relationship.
 
@@ -1218,16 +3453,26 @@ class CollectionViewBase:
         rel_class = rel.mapper.class_
         rel_view = self.view_instance(rel_class)
         obj = DBSession.query(self.model).get(obj_id)
-        items = []
-        for resid in data:
-            if resid['type'] != rel_view.collection_name:
-                raise HTTPConflict(
-                    "Resource identifier type '{}' " +
-                    "does not match relationship type '{}'.".format(
-                        resid['type'], rel_view.collection_name
-                    )
+        if obj is None:
+            raise HTTPNotFound('Object {} not found in collection {}'.format(
+                obj_id,
+                self.collection_name
+            ))
+        items = self.resolve_identifiers([(rel_view, resid) for resid in data])
+        if self.plain_secondary(rel):
+            # Add rows to the association table rather than loading the
+            # whole relationship to append to it.
+            try:
+                self.insert_associations(
+                    rel, self.association_rows(rel, obj, items)
                 )
-            items.append(DBSession.query(rel_class).get(resid['id']))
+            except sqlalchemy.exc.IntegrityError as e:
+                raise HTTPFailedDependency(str(e))
+            self.expire_related(
+                rel, obj, [item._jsonapi_id for item in items]
+            )
+            self.record_association_changes(rel, obj, items)
+            return {}
         getattr(obj, relname).extend(items)
         try:
             DBSession.flush()
@@ -1285,6 +3530,8 @@ class CollectionViewBase:
             HTTPConflict: if a resource identifier is specified with a
             different type than that which the collection holds.
 
+            HTTPNotFound: if any of the specified resources don't exist.
+
             HTTPFailedDependency: if a database constraint would be broken by
             adding the specified resource to the relationship.
 
@@ -1319,36 +3566,30 @@ class CollectionViewBase:
         rel_class = rel.mapper.class_
         rel_view = self.view_instance(rel_class)
         obj = DBSession.query(self.model).get(obj_id)
+        if obj is None:
+            raise HTTPNotFound('Object {} not found in collection {}'.format(
+                obj_id,
+                self.collection_name
+            ))
         if rel.direction is MANYTOONE:
             resid = data
             if resid is None:
                 setattr(obj, relname, None)
             else:
-                if resid['type'] != rel_view.collection_name:
-                    raise HTTPConflict(
-                        "Resource identifier type '{}' " +
-                        "does not match relationship type '{}'.".format(
-                            resid['type'],
-                            rel_view.collection_name
-                        )
-                    )
                 setattr(
                     obj,
                     relname,
-                    DBSession.query(rel_class).get(resid['id'])
+                    self.resolve_identifiers([(rel_view, resid)])[0]
                 )
             return {}
-        items = []
-        for resid in self.request.json_body['data']:
-            if resid['type'] != rel_view.collection_name:
-                raise HTTPConflict(
-                    "Resource identifier type '{}' " +
-                    "does not match relationship type '{}'.".format(
-                        resid['type'],
-                        rel_view.collection_name
-                    )
-                )
-            items.append(DBSession.query(rel_class).get(resid['id']))
+        items = self.resolve_identifiers(
+            [(rel_view, resid) for resid in self.request.json_body['data']]
+        )
+        try:
+            if self.replace_related(rel, obj, items):
+                return {}
+        except sqlalchemy.exc.IntegrityError as e:
+            raise HTTPFailedDependency(str(e))
         setattr(obj, relname, items)
         try:
             DBSession.flush()
@@ -1398,6 +3639,8 @@ class CollectionViewBase:
             HTTPConflict: if a resource identifier is specified with a
             different type than that which the collection holds.
 
+            HTTPNotFound: if any of the specified resources don't exist.
+
             HTTPFailedDependency: if a database constraint would be broken by
             adding the specified resource to the relationship.
 
@@ -1427,22 +3670,36 @@ class CollectionViewBase:
         rel_class = rel.mapper.class_
         rel_view = self.view_instance(rel_class)
         obj = DBSession.query(self.model).get(obj_id)
+        if obj is None:
+            raise HTTPNotFound('Object {} not found in collection {}'.format(
+                obj_id,
+                self.collection_name
+            ))
 
         # Call callbacks
         for callback in self.callbacks['before_relationships_delete']:
             callback(self, obj)
 
-        for resid in self.request.json_body['data']:
-            if resid['type'] != rel_view.collection_name:
-                raise HTTPConflict(
-                    "Resource identifier type '{}' " +
-                    "does not match relationship type '{}'.".format(
-                        resid['type'], rel_view.collection_name
-                    )
+        items = self.resolve_identifiers(
+            [(rel_view, resid) for resid in self.request.json_body['data']]
+        )
+        if self.plain_secondary(rel):
+            # Delete rows from the association table rather than loading the
+            # whole relationship to remove from it.
+            try:
+                self.delete_associations(
+                    rel, self.association_rows(rel, obj, items)
                 )
+            except sqlalchemy.exc.IntegrityError as e:
+                raise HTTPFailedDependency(str(e))
+            self.expire_related(
+                rel, obj, [item._jsonapi_id for item in items]
+            )
+            self.record_association_changes(rel, obj, items)
+            return {}
+        for item in items:
             try:
-                getattr(obj, relname).\
-                    remove(DBSession.query(rel_class).get(resid['id']))
+                getattr(obj, relname).remove(item)
             except ValueError as e:
                 if e.args[0].endswith(': x not in list'):
                     # The item we were asked to remove is not there.
@@ -1455,6 +3712,287 @@ class CollectionViewBase:
             raise HTTPFailedDependency(str(e))
         return {}
 
+    @staticmethod
+    def plain_secondary(rel):
+        '''Whether rel is a MANYTOMANY relationship through a plain table.
+
+        Rows of such association tables can be written directly.
+        '''
+        return rel.direction is MANYTOMANY and not rel.viewonly and\
+            isinstance(rel.secondary, sqlalchemy.Table)
+
+    @staticmethod
+    def association_rows(rel, obj, rel_items):
+        '''Association table rows linking obj to each of rel_items.
+
+        Parameters:
+            rel (sqlalchemy.orm.relationships.RelationshipProperty):
+                MANYTOMANY relationship of obj.
+
+            obj: item on the local side.
+
+            rel_items (list): items on the remote side.
+
+        Returns:
+            list: dicts mapping association table columns to values, without
+            duplicates.
+        '''
+        local = {
+            secondary: getattr(
+                obj, rel.parent.get_property_by_column(col).key
+            )
+            for col, secondary in rel.synchronize_pairs
+        }
+        rows = OrderedDict()
+        for rel_item in rel_items:
+            row = dict(local)
+            for col, secondary in rel.secondary_synchronize_pairs:
+                row[secondary] = getattr(
+                    rel_item, rel.mapper.get_property_by_column(col).key
+                )
+            rows[tuple(sorted(
+                (col.key, value) for col, value in row.items()
+            ))] = row
+        return list(rows.values())
+
+    def insert_associations(self, rel, rows):
+        '''Insert association table rows, skipping any which already exist.
+
+        On PostgreSQL (``ON CONFLICT DO NOTHING``) and SQLite (``INSERT OR
+        IGNORE``) the database skips existing rows if the table has a primary
+        key or unique constraint over the association columns, as association
+        tables normally do. Otherwise the existing rows are looked up first.
+        Either way only the requested rows are read or written.
+
+        Parameters:
+            rel (sqlalchemy.orm.relationships.RelationshipProperty):
+                relationship through a plain association table.
+
+            rows (list): rows from :py:func:`association_rows`.
+        '''
+        if not rows:
+            return
+        DBSession = self.get_dbsession()
+        table = rel.secondary
+        dialect = DBSession.get_bind().dialect.name
+        columns = set(rows[0])
+        unique = any(
+            set(constraint.columns) == columns
+            for constraint in table.constraints
+            if isinstance(
+                constraint,
+                (sqlalchemy.PrimaryKeyConstraint, sqlalchemy.UniqueConstraint)
+            )
+        )
+        if unique and dialect == 'postgresql':
+            stmt = postgresql.insert(table).on_conflict_do_nothing()
+        elif unique and dialect == 'sqlite':
+            stmt = table.insert().prefix_with('OR IGNORE')
+        else:
+            existing = {
+                tuple(row) for row in DBSession.execute(
+                    sqlalchemy.select(list(rows[0])).where(
+                        self.association_clause(rows)
+                    )
+                )
+            }
+            rows = [
+                row for row in rows if tuple(row.values()) not in existing
+            ]
+            if not rows:
+                return
+            stmt = table.insert()
+        DBSession.execute(stmt, [
+            {col.key: value for col, value in row.items()} for row in rows
+        ])
+
+    def delete_associations(self, rel, rows):
+        '''Delete association table rows (any which don't exist are ignored).
+
+        Parameters:
+            rel (sqlalchemy.orm.relationships.RelationshipProperty):
+                relationship through a plain association table.
+
+            rows (list): rows from :py:func:`association_rows`.
+        '''
+        if not rows:
+            return
+        self.get_dbsession().execute(
+            rel.secondary.delete().where(self.association_clause(rows))
+        )
+
+    @staticmethod
+    def association_clause(rows):
+        '''Clause matching any of rows of an association table.
+
+        Columns with the same value in every row are compared with ``=`` and
+        the rest with ``IN``.
+        '''
+        columns = list(rows[0])
+        fixed = [
+            col for col in columns
+            if len({row[col] for row in rows}) == 1
+        ]
+        varying = [col for col in columns if col not in fixed]
+        clauses = [col == rows[0][col] for col in fixed]
+        if len(varying) == 1:
+            clauses.append(varying[0].in_({row[varying[0]] for row in rows}))
+        elif varying:
+            clauses.append(sqlalchemy.tuple_(*varying).in_(
+                [tuple(row[col] for col in varying) for row in rows]
+            ))
+        return sqlalchemy.and_(*clauses)
+
+    def replace_related(self, rel, obj, rel_items):
+        '''Replace the members of a to-many relationship, writing only changes.
+
+        The current members' ids are selected (and nothing else), compared
+        with the requested items, and only the differences are written: an
+        ``UPDATE`` of the foreign keys of added and removed items for
+        ONETOMANY, or inserts and deletes of association rows for MANYTOMANY
+        through a plain association table.
+
+        Relationships which can't be handled like this (delete-orphan
+        cascades, which need the ORM, view only relationships, or
+        association tables not keyed by the related item's id) are left
+        alone.
+
+        Parameters:
+            rel (sqlalchemy.orm.relationships.RelationshipProperty): to-many
+                relationship of obj.
+
+            obj: item whose relationship is replaced.
+
+            rel_items (list): the new members.
+
+        Returns:
+            bool: True if the relationship was replaced, False if the caller
+            should use the ORM instead.
+        '''
+        DBSession = self.get_dbsession()
+        rel_view = self.view_instance(rel.mapper.class_)
+        key = rel_view.key_column
+        local = {
+            col: getattr(obj, rel.parent.get_property_by_column(col).key)
+            for col, _ in rel.synchronize_pairs
+        }
+        if rel.viewonly or rel.cascade.delete_orphan:
+            return False
+        if rel.direction is ONETOMANY:
+            current_q = sqlalchemy.select([key]).where(sqlalchemy.and_(*(
+                remote == local[col] for col, remote in rel.synchronize_pairs
+            )))
+        elif self.plain_secondary(rel) and\
+                len(rel.secondary_synchronize_pairs) == 1 and\
+                rel.secondary_synchronize_pairs[0][0].name == key.name and\
+                rel.secondary_synchronize_pairs[0][0].table is key.table:
+            rel_secondary = rel.secondary_synchronize_pairs[0][1]
+            current_q = sqlalchemy.select([rel_secondary]).where(
+                sqlalchemy.and_(*(
+                    secondary == local[col]
+                    for col, secondary in rel.synchronize_pairs
+                ))
+            )
+        else:
+            return False
+        current = {row[0] for row in DBSession.execute(current_q)}
+        requested = OrderedDict(
+            (item._jsonapi_id, item) for item in rel_items
+        )
+        added = [rel_id for rel_id in requested if rel_id not in current]
+        removed = [rel_id for rel_id in current if rel_id not in requested]
+        if rel.direction is ONETOMANY:
+            for rel_ids, value in ((added, local), (removed, {})):
+                if rel_ids:
+                    DBSession.execute(
+                        key.table.update().where(key.in_(rel_ids)).values({
+                            remote.key: value.get(col)
+                            for col, remote in rel.synchronize_pairs
+                        })
+                    )
+        else:
+            self.insert_associations(rel, self.association_rows(
+                rel, obj, [requested[rel_id] for rel_id in added]
+            ))
+            removed_rows = []
+            for rel_id in removed:
+                row = {
+                    secondary: local[col]
+                    for col, secondary in rel.synchronize_pairs
+                }
+                row[rel_secondary] = rel_id
+                removed_rows.append(row)
+            self.delete_associations(rel, removed_rows)
+        if added or removed:
+            self.expire_related(rel, obj, added + removed)
+            record_changes(DBSession, [{
+                'collection': self.collection_name,
+                'item_id': str(obj._jsonapi_id),
+                'op': 'update',
+            }] + [
+                {
+                    'collection': rel_view.collection_name,
+                    'item_id': str(rel_id),
+                    'op': 'update',
+                }
+                for rel_id in added + removed
+            ])
+        return True
+
+    def expire_related(self, rel, obj, rel_ids):
+        '''Expire session state made stale by writing a relationship directly.
+
+        The relationship is expired on obj and, on any related items loaded
+        into the session whose links changed, so is the other side of it
+        (and, for ONETOMANY, their foreign keys). For ONETOMANY the
+        relationship is also expired on any other loaded item which has it
+        loaded, since the related items may have moved from there.
+
+        Parameters:
+            rel (sqlalchemy.orm.relationships.RelationshipProperty): to-many
+                relationship of obj.
+
+            obj: item whose relationship was written.
+
+            rel_ids (list): ids of the related items added or removed.
+        '''
+        session = self.get_dbsession()
+        session.expire(obj, [rel.key])
+        rel_ids = {str(rel_id) for rel_id in rel_ids}
+        reverse = [prop.key for prop in rel._reverse_property]
+        if rel.direction is ONETOMANY:
+            reverse += [
+                rel.mapper.get_property_by_column(remote).key
+                for _, remote in rel.synchronize_pairs
+            ]
+        for item in list(session.identity_map.values()):
+            if isinstance(item, rel.mapper.class_) and\
+                    str(item._jsonapi_id) in rel_ids and reverse:
+                session.expire(item, reverse)
+            elif rel.direction is ONETOMANY and item is not obj and\
+                    isinstance(item, rel.parent.class_) and\
+                    rel.key in sqlalchemy.inspect(item).dict:
+                session.expire(item, [rel.key])
+
+    def record_association_changes(self, rel, obj, rel_items):
+        '''Record updates to both ends of directly written associations.'''
+        rel_view = self.view_instance(rel.mapper.class_)
+        record_changes(
+            self.get_dbsession(),
+            [{
+                'collection': self.collection_name,
+                'item_id': str(obj._jsonapi_id),
+                'op': 'update',
+            }] + [
+                {
+                    'collection': rel_view.collection_name,
+                    'item_id': str(rel_item._jsonapi_id),
+                    'op': 'update',
+                }
+                for rel_item in rel_items
+            ]
+        )
+
     @property
     def single_item_query(self):
         '''A query representing the single item referenced by the request.
@@ -1474,7 +4012,99 @@ class CollectionViewBase:
             load_only(*self.allowed_requested_query_columns.keys())
         ).filter(
             self.model._jsonapi_id == self.request.matchdict['id']
+        ).execution_options(
+            jsonapi_prepare=self.prepare_statements
+        )
+        return q
+
+    def cached_collection_queries(self):
+        '''Baked queries for collection_get from the statement cache.
+
+        The query shape (collection, fieldset, sort keys, filter columns and
+        operators and include plan) is the cache key: filter values, offset
+        and limit are bound as parameters, so requests which differ only in
+        those values reuse the same compiled SQL.
+
+        Returns:
+            tuple: (page, count) pair of
+            ``sqlalchemy.ext.baked.Result`` objects with parameters bound.
+        '''
+        DBSession = self.get_dbsession()
+        if isinstance(DBSession, sqlalchemy.orm.scoped_session):
+            # Baked queries need the session itself, not the registry.
+            DBSession = DBSession()
+        qinfo = self.collection_query_info(self.request)
+        filters = sorted(
+            qinfo['_filters'].values(),
+            key=lambda finfo: (finfo['colspec'], finfo['op'])
+        )
+        shape = (
+            self.collection_name,
+            tuple(sorted(self.allowed_requested_query_columns.keys())),
+            tuple(
+                (key_info['key'], key_info['ascending'])
+                for key_info in qinfo['_sort']
+            ),
+            tuple((tuple(f['colspec']), f['op']) for f in filters),
+            tuple(sorted(self.requested_include_names())),
+        )
+        bq = self.statement_cache.get(
+            shape,
+            functools.partial(self.shape_query, shape)
+        )
+        params = {
+            'jsonapi_filter_{}'.format(i): self.filter_value(
+                finfo['op'], finfo['value']
+            )
+            for i, finfo in enumerate(filters)
+        }
+        params['jsonapi_offset'] = qinfo['page[offset]']
+        params['jsonapi_limit'] = qinfo['page[limit]']
+        q = bq
+        if qinfo['page[count]'] == 'window':
+            q = q.with_criteria(self.query_add_window_count)
+        q = q.with_criteria(
+            lambda q: q.offset(
+                sqlalchemy.bindparam('jsonapi_offset')
+            ).limit(
+                sqlalchemy.bindparam('jsonapi_limit')
+            )
+        )
+        return (
+            q(DBSession).params(**params),
+            bq(DBSession).params(**params)
+        )
+
+    @classmethod
+    def shape_query(cls, shape, session):
+        '''Build the collection query for a query shape.
+
+        Filter values are left as bind parameters named
+        ``jsonapi_filter_<n>``, numbered in the same order as the filters in
+        ``shape``.
+
+        Parameters:
+            shape (tuple): query shape as built by
+                :py:func:`cached_collection_queries`.
+
+            session (sqlalchemy.orm.session.Session): session for the query.
+
+        Returns:
+            sqlalchemy.orm.query.Query: query without paging.
+        '''
+        collection_name, fields, sort, filters, includes = shape
+        q = session.query(cls.model).options(load_only(*fields))
+        q = cls.sorted_query(
+            q,
+            [{'key': key, 'ascending': ascending} for key, ascending in sort]
         )
+        for i, (colspec, op) in enumerate(filters):
+            q = q.filter(
+                cls.filter_clause(
+                    list(colspec), op,
+                    sqlalchemy.bindparam('jsonapi_filter_{}'.format(i))
+                )
+            )
         return q
 
     def single_return(self, q, not_found_message=None, identifier=False):
@@ -1530,7 +4160,9 @@ class CollectionViewBase:
                 ret['included'] = [obj for obj in included.values()]
         return ret
 
-    def collection_return(self, q, count=None, identifiers=False):
+    def collection_return(
+            self, q, count=None, identifiers=False, count_info=None
+            ):
         '''Populate return dictionary for collections.
 
         Arguments:
@@ -1542,6 +4174,9 @@ class CollectionViewBase:
 
             identifiers(bool): return identifiers if True, objects if false.
 
+            count_info(dict): results meta from :py:func:`query_count`. Takes
+            precedence over ``count``.
+
         Returns:
             dict: dict in the form:
 
@@ -1570,35 +4205,69 @@ class CollectionViewBase:
         # Add information to the return dict
         ret = {'meta': {'results': {}}}
 
-        if count is None:
-            try:
-                count = q.count()
-            except sqlalchemy.exc.ProgrammingError as e:
-                raise HTTPBadRequest(
-                    "Could not use operator '{}' with field '{}'".format(
-                        op, prop.name
+        if count_info is None:
+            if count is None:
+                try:
+                    count = q.count()
+                except sqlalchemy.exc.ProgrammingError as e:
+                    raise HTTPBadRequest(
+                        "Could not use operator '{}' with field '{}'".format(
+                            op, prop.name
+                        )
                     )
-                )
-        ret['meta']['results']['available'] = count
-
-        # Pagination links
+            count_info = {'available': count, 'count': 'exact'}
+        count_info = dict(count_info)
+
+        dbitems = q.all()
+        if count_info['count'] == 'window':
+            # Rows are (item, total) pairs.
+            fallback = count_info.pop('fallback')
+            if dbitems:
+                count_info['available'] = dbitems[0][-1]
+            elif qinfo['page[offset]'] == 0:
+                count_info['available'] = 0
+            else:
+                # Off the end: nothing to read the total from.
+                count_info['available'] = fallback()
+            count_info['count'] = 'exact'
+            dbitems = [row[0] for row in dbitems]
+        ret['meta']['results'].update(count_info)
+
+        more = False
+        if self.keyset_paging:
+            # The keyset query fetches one extra item to find out if there
+            # are more in the direction of travel.
+            more = len(dbitems) > qinfo['page[limit]']
+            dbitems = dbitems[:qinfo['page[limit]']]
+            if 'before' in qinfo['_page']:
+                dbitems.reverse()
+
+        # Pagination links. Only an exact count can be used to find the last
+        # page.
+        if count_info['count'] == 'exact':
+            count = count_info['available']
+        else:
+            count = None
         ret['links'] = self.pagination_links(
-            count=ret['meta']['results']['available']
+            count=count,
+            items=dbitems,
+            more=more
         )
         ret['meta']['results']['limit'] = qinfo['page[limit]']
-        ret['meta']['results']['offset'] = qinfo['page[offset]']
+        if not self.keyset_paging:
+            ret['meta']['results']['offset'] = qinfo['page[offset]']
 
         # Primary data
         if identifiers:
             ret['data'] = [
                 self.serialise_resource_identifier(dbitem._jsonapi_id)
-                for dbitem in q.all()
+                for dbitem in dbitems
             ]
         else:
             included = {}
             ret['data'] = [
                 self.serialise_db_item(dbitem, included)
-                for dbitem in q.all()
+                for dbitem in dbitems
             ]
             # Included objects
             if self.requested_include_names():
@@ -1629,15 +4298,53 @@ class CollectionViewBase:
         # Get info for query.
         qinfo = self.collection_query_info(self.request)
 
-        # Sorting.
-        for key_info in qinfo['_sort']:
+        rank = None
+        if any(key_info['key'] == '_rank' for key_info in qinfo['_sort']):
+            rank = self.search_rank()
+        return self.sorted_query(q, qinfo['_sort'], rank=rank)
+
+    @classmethod
+    def sorted_query(cls, q, sort_info, rank=None):
+        '''Add ``order_by`` clauses for a list of sort keys to query.
+
+        Parameters:
+            q (sqlalchemy.orm.query.Query): query
+
+            sort_info (list): sort keys in the same form as the ``_sort`` key
+                from :py:func:`collection_query_info`.
+
+            rank: search rank expression to sort by for the key ``_rank``.
+
+        Returns:
+            sqlalchemy.orm.query.Query: query with ``order_by`` clause.
+
+        Raises:
+            HTTPBadRequest: if sorting by ``_rank`` without a search.
+        '''
+        q, aggregates = cls.query_add_sort_aggregates(q, sort_info)
+        for key_info in sort_info:
+            if key_info['key'] in aggregates:
+                order_att = aggregates[key_info['key']]
+                q = q.order_by(
+                    order_att if key_info['ascending'] else order_att.desc()
+                )
+                continue
+            if key_info['key'] == '_rank':
+                if rank is None:
+                    raise HTTPBadRequest(
+                        'Sorting by _rank needs a search filter.'
+                    )
+                q = q.order_by(
+                    rank if key_info['ascending'] else rank.desc()
+                )
+                continue
             sort_keys = key_info['key'].split('.')
             # We are using 'id' to stand in for the key column, whatever that
             # is.
             main_key = sort_keys[0]
             if main_key == 'id':
-                main_key = self.key_column.name
-            order_att = getattr(self.model, main_key)
+                main_key = cls.key_column.name
+            order_att = getattr(cls.model, main_key)
             # order_att will be a sqlalchemy.orm.properties.ColumnProperty if
             # sort_keys[0] is the name of an attribute or a
             # sqlalchemy.orm.relationships.RelationshipProperty if sort_keys[0]
@@ -1652,9 +4359,9 @@ class CollectionViewBase:
                     sub_key = sort_keys[1]
                 except IndexError:
                     # Use the relationship
-                    sub_key = self.view_instance(
+                    sub_key = view_classes[
                         rel.mapper.class_
-                    ).key_column.name
+                    ].key_column.name
                 order_att = getattr(rel.mapper.entity, sub_key)
             if key_info['ascending']:
                 q = q.order_by(order_att)
@@ -1663,6 +4370,83 @@ class CollectionViewBase:
 
         return q
 
+    @classmethod
+    def query_add_sort_aggregates(cls, q, sort_info):
+        '''Join subqueries for sort keys on aggregates of relationships.
+
+        Sort keys of the form ``<relationship>.@count`` or
+        ``<relationship>.@<function>.<attribute>`` (function one of ``sum``,
+        ``avg``, ``min`` or ``max``) sort by an aggregate over the items of a
+        to-many relationship. Each relationship gets one subquery, grouped
+        by the foreign key and holding all the aggregates asked for, which is
+        outer joined to the query once. Items with no related items have a
+        count of 0 and other aggregates null.
+
+        Parameters:
+            q (sqlalchemy.orm.query.Query): query
+
+            sort_info (list): sort keys in the same form as the ``_sort`` key
+                from :py:func:`collection_query_info`.
+
+        Returns:
+            tuple: (query with joins, dict mapping aggregate sort keys to
+            the columns to sort on).
+
+        Raises:
+            HTTPBadRequest: for bad aggregate sort keys.
+        '''
+        by_rel = OrderedDict()
+        for key_info in sort_info:
+            parts = key_info['key'].split('.')
+            if len(parts) > 1 and parts[1].startswith('@'):
+                by_rel.setdefault(parts[0], OrderedDict())[
+                    key_info['key']
+                ] = parts[1:]
+        columns = {}
+        for relname, keys in by_rel.items():
+            rel = cls.relationships.get(relname)
+            if rel is None or rel.direction is MANYTOONE or\
+                    len(rel.synchronize_pairs) != 1:
+                raise HTTPBadRequest(
+                    'Cannot sort {} by aggregates of {}.'.format(
+                        cls.collection_name, relname
+                    )
+                )
+            target = rel.mapper.class_
+            parent_col, key = rel.synchronize_pairs[0]
+            if rel.secondary is None:
+                from_obj = rel.mapper.local_table
+            else:
+                target_col, secondary_col = rel.secondary_synchronize_pairs[0]
+                from_obj = rel.secondary.join(
+                    rel.mapper.local_table, target_col == secondary_col
+                )
+            selects = [key.label('jsonapi_key')]
+            for i, (sort_key, spec) in enumerate(keys.items()):
+                func_name = spec[0][1:]
+                if spec == ['@count']:
+                    agg = sqlalchemy.func.count()
+                elif func_name in AGGREGATE_FUNCTIONS and len(spec) == 2 and\
+                        spec[1] in view_classes[target].attributes:
+                    agg = getattr(sqlalchemy.func, func_name)(
+                        getattr(target, spec[1])
+                    )
+                else:
+                    raise HTTPBadRequest(
+                        'Bad aggregate sort key {}.'.format(sort_key)
+                    )
+                selects.append(agg.label('jsonapi_agg_{}'.format(i)))
+            subq = sqlalchemy.select(selects).select_from(
+                from_obj
+            ).group_by(key).alias('jsonapi_sort_{}'.format(relname))
+            q = q.outerjoin(subq, parent_col == subq.c.jsonapi_key)
+            for i, (sort_key, spec) in enumerate(keys.items()):
+                col = subq.c['jsonapi_agg_{}'.format(i)]
+                if spec == ['@count']:
+                    col = sqlalchemy.func.coalesce(col, 0)
+                columns[sort_key] = col
+        return q, columns
+
     def query_add_filtering(self, q):
         '''Add filtering clauses to query.
 
@@ -1694,6 +4478,9 @@ class CollectionViewBase:
             * ``ge`` as sqlalchemy ``__ge__``
             * ``like`` or ``ilike`` as sqlalchemy ``like`` or ``ilike``, except
               replace any '*' with '%' (so that '*' acts as a wildcard)
+            * ``search`` full text search (see :py:func:`search_clause`).
+
+        ``filter[q]=<terms>`` searches all of the collection's search columns.
 
         See Also:
             ``_filters`` key from :py:func:`collection_query_info`
@@ -1727,779 +4514,3271 @@ class CollectionViewBase:
         qinfo = self.collection_query_info(self.request)
         # Filters
         for p, finfo in qinfo['_filters'].items():
-            val = finfo['value']
-            colspec = finfo['colspec']
-            op = finfo['op']
-            prop = getattr(self.model, colspec[0])
-            if isinstance(prop.property, RelationshipProperty):
-                # TODO(Colin): deal with relationships properly.
-                pass
-            if op == 'eq':
-                op_func = getattr(prop, '__eq__')
-            elif op == 'ne':
-                op_func = getattr(prop, '__ne__')
-            elif op == 'startswith':
-                op_func = getattr(prop, 'startswith')
-            elif op == 'endswith':
-                op_func = getattr(prop, 'endswith')
-            elif op == 'contains':
-                op_func = getattr(prop, 'contains')
-            elif op == 'lt':
-                op_func = getattr(prop, '__lt__')
-            elif op == 'gt':
-                op_func = getattr(prop, '__gt__')
-            elif op == 'le':
-                op_func = getattr(prop, '__le__')
-            elif op == 'ge':
-                op_func = getattr(prop, '__ge__')
-            elif op == 'like' or op == 'ilike':
-                op_func = getattr(prop, op)
-                val = re.sub(r'\*', '%', val)
-            else:
-                raise HTTPBadRequest(
-                    "No such filter operator: '{}'".format(op)
+            if finfo['op'] == 'search':
+                q = q.filter(
+                    self.search_clause(finfo['colspec'], finfo['value'])
+                )
+                continue
+            q = q.filter(
+                self.filter_clause(
+                    finfo['colspec'],
+                    finfo['op'],
+                    self.filter_value(finfo['op'], finfo['value'])
                 )
-            q = q.filter(op_func(val))
+            )
 
         return q
 
-    def related_limit(self, relationship):
-        '''Paging limit for related resources.
+    @classmethod
+    def filter_clause(cls, colspec, op, val):
+        '''Build the sqlalchemy clause for one filter.
 
-        **Query Parameters**
+        Parameters:
+            colspec (list): column spec split on '.'.
 
-            **page[limit:relationships:<relname>]:** number of results to
-            return per page for related resource <relname>.
+            op (str): filter operator.
 
-        Parameters:
-            relationship(sqlalchemy.orm.relationships.RelationshipProperty):
-                the relationship to get the limit for.
+            val: value to compare to. May be a literal value (already passed
+                through :py:func:`filter_value`) or a
+                ``sqlalchemy.sql.expression.BindParameter``.
 
         Returns:
-            int: paging limit for related resources.
+            sqlalchemy.sql.expression.ClauseElement: filter clause.
+
+        Raises:
+            HTTPBadRequest: if ``op`` is not a known filter operator.
         '''
-        limit_comps = ['limit', 'relationships', relationship.key]
-        limit = self.default_limit
-        qinfo = self.collection_query_info(self.request)
-        while limit_comps:
-            if '.'.join(limit_comps) in qinfo['_page']:
-                limit = int(qinfo['_page']['.'.join(limit_comps)])
-                break
-            limit_comps.pop()
-        return min(limit, self.max_limit)
+        prop = getattr(cls.model, colspec[0])
+        if isinstance(prop.property, RelationshipProperty):
+            # TODO(Colin): deal with relationships properly.
+            pass
+        if op == 'eq':
+            op_func = getattr(prop, '__eq__')
+        elif op == 'ne':
+            op_func = getattr(prop, '__ne__')
+        elif op == 'startswith':
+            op_func = getattr(prop, 'startswith')
+        elif op == 'endswith':
+            op_func = getattr(prop, 'endswith')
+        elif op == 'contains':
+            op_func = getattr(prop, 'contains')
+        elif op == 'lt':
+            op_func = getattr(prop, '__lt__')
+        elif op == 'gt':
+            op_func = getattr(prop, '__gt__')
+        elif op == 'le':
+            op_func = getattr(prop, '__le__')
+        elif op == 'ge':
+            op_func = getattr(prop, '__ge__')
+        elif op == 'like' or op == 'ilike':
+            op_func = getattr(prop, op)
+        else:
+            raise HTTPBadRequest(
+                "No such filter operator: '{}'".format(op)
+            )
+        return op_func(val)
 
-    def related_query(self, obj_id, relationship, full_object=True):
-        '''Construct query for related objects.
+    def search_names(self, colspec):
+        '''Names of the search columns to search for a filter colspec.
 
         Parameters:
-            obj_id (str): id of an item in this view's collection.
+            colspec (list): column spec split on '.'. Empty to search all the
+                search columns.
 
-            relationship (sqlalchemy.orm.relationships.RelationshipProperty):
-                the relationships to get related objects from.
+        Returns:
+            list: attribute names.
 
-            full_object (bool): if full_object is ``True``, query for all
-                requested columns (probably to build resource objects). If
-                full_object is False, only query for the key column (probably
-                to build resource identifiers).
+        Raises:
+            HTTPBadRequest: if the column isn't a search column.
+        '''
+        if not colspec:
+            if not self.search_columns:
+                raise HTTPBadRequest(
+                    'Collection {} has no search columns.'.format(
+                        self.collection_name
+                    )
+                )
+            return list(self.search_columns)
+        if len(colspec) > 1 or colspec[0] not in self.search_columns:
+            raise HTTPBadRequest(
+                'Cannot search {}.{}: search columns are: {}.'.format(
+                    self.collection_name, '.'.join(colspec),
+                    ', '.join(self.search_columns) or 'none'
+                )
+            )
+        return colspec
+
+    def search_clause(self, colspec, terms):
+        '''Build the full text search clause for one search filter.
+
+        On PostgreSQL this is ``to_tsvector(config, document) @@
+        websearch_to_tsquery(config, terms)``, where the document is the
+        column or (for ``filter[q]``) the search columns joined together:
+        the same expressions indexed by :py:func:`search_index_ddl`. On
+        SQLite the terms are matched against the collection's FTS5 table.
+        Other databases fall back to a case insensitive substring match.
+
+        Parameters:
+            colspec (list): column spec split on '.' (empty for all search
+                columns).
+
+            terms (str): search terms in web search syntax: words, "quoted
+                phrases", ``or`` and ``-`` to exclude a word.
 
         Returns:
-            sqlalchemy.orm.query.Query: query which will fetch related
-            object(s).
+            sqlalchemy.sql.expression.ClauseElement: filter clause.
         '''
-        DBSession = self.get_dbsession()
-        rel = relationship
-        rel_class = rel.mapper.class_
-        rel_view = self.view_instance(rel_class)
-        local_col, rem_col = rel.local_remote_pairs[0]
-        q = DBSession.query(rel_class)
-        if full_object:
-            q = q.options(
-                load_only(*rel_view.allowed_requested_query_columns.keys())
+        names = self.search_names(colspec)
+        dialect = self.get_dbsession().get_bind().dialect.name
+        if dialect == 'postgresql':
+            return self.search_vector(names).op('@@')(
+                self.search_query(terms)
             )
-        else:
-            q = q.options(load_only(rel_view.key_column.name))
-        if rel.direction is ONETOMANY:
-            q = q.filter(obj_id == rem_col)
-        elif rel.direction is MANYTOMANY:
-            q = q.filter(
-                obj_id == rel.primaryjoin.right
-            ).filter(
-                rel_class._jsonapi_id == rel.secondaryjoin.right
-            )
-        elif rel.direction is MANYTOONE:
-            q = q.filter(
-                local_col == rel_class._jsonapi_id
-            ).filter(
-                self.model._jsonapi_id == obj_id
+        if dialect == 'sqlite':
+            return getattr(self.model, self.key_column.name).in_(
+                sqlalchemy.select(
+                    [sqlalchemy.literal_column('rowid')]
+                ).select_from(
+                    sqlalchemy.table(self.fts_table_name())
+                ).where(self.fts_match(colspec, terms))
             )
-        else:
-            raise HTTPError('Unknown relationships direction, "{}".'.format(
-                rel.direction.name
-            ))
-
-        return q
+        return sqlalchemy.or_(*(
+            getattr(self.model, name).ilike('%{}%'.format(terms))
+            for name in names
+        ))
 
-    def object_exists(self, obj_id):
-        '''Test if object with id obj_id exists.
+    def search_rank(self):
+        '''Rank of items for the current request's search filters.
 
-        Args:
-            obj_id (str): object id
+        Higher ranks are better matches, so ``sort=-_rank`` puts the best
+        first. With more than one search filter the ranks are added.
 
         Returns:
-            bool: True if object exists, False if not.
+            sqlalchemy.sql.expression.ColumnElement: rank, or None if the
+            request has no search filters.
         '''
-        DBSession = self.get_dbsession()
-        item = DBSession.query(
-            self.model
-        ).options(
-            load_only(self.key_column.name)
-        ).get(obj_id)
-        if item:
-            return True
+        qinfo = self.collection_query_info(self.request)
+        dialect = self.get_dbsession().get_bind().dialect.name
+        ranks = []
+        for finfo in qinfo['_filters'].values():
+            if finfo['op'] != 'search':
+                continue
+            names = self.search_names(finfo['colspec'])
+            if dialect == 'postgresql':
+                ranks.append(sqlalchemy.func.ts_rank(
+                    self.search_vector(names),
+                    self.search_query(finfo['value'])
+                ))
+            elif dialect == 'sqlite':
+                fts_name = self.fts_table_name()
+                # bm25() is lower for better matches.
+                ranks.append(-sqlalchemy.select([
+                    sqlalchemy.func.bm25(sqlalchemy.literal_column(fts_name))
+                ]).select_from(
+                    sqlalchemy.table(fts_name)
+                ).where(
+                    self.fts_match(finfo['colspec'], finfo['value'])
+                ).where(
+                    sqlalchemy.literal_column('rowid') ==
+                    getattr(self.model, self.key_column.name)
+                ).as_scalar())
+            else:
+                ranks.append(sqlalchemy.literal(0))
+        if not ranks:
+            return None
+        return functools.reduce(lambda a, b: a + b, ranks)
+
+    @classmethod
+    def search_vector(cls, names, columns=None):
+        '''PostgreSQL ``to_tsvector()`` of the search document.
+
+        Parameters:
+            names (list): attribute names making up the document.
+
+            columns (list): column expressions to use instead of the model's
+                attributes (for index DDL).
+
+        Returns:
+            sqlalchemy.sql.expression.ColumnElement: tsvector expression.
+        '''
+        if columns is None:
+            columns = [getattr(cls.model, name) for name in names]
+        if len(columns) == 1:
+            document = columns[0]
         else:
-            return False
+            # Keep to immutable functions so that the expression can be
+            # indexed.
+            document = functools.reduce(
+                lambda a, b: a.op('||')(
+                    sqlalchemy.literal_column("' '")
+                ).op('||')(b),
+                (
+                    sqlalchemy.func.coalesce(
+                        col, sqlalchemy.literal_column("''")
+                    ) for col in columns
+                )
+            )
+        return sqlalchemy.func.to_tsvector(
+            sqlalchemy.literal_column("'{}'".format(cls.search_config)),
+            document
+        )
 
-    def serialise_resource_identifier(self, obj_id):
-        '''Return a resource identifier dictionary for id "obj_id"
+    @classmethod
+    def search_query(cls, terms):
+        '''PostgreSQL ``websearch_to_tsquery()`` of terms.'''
+        return sqlalchemy.func.websearch_to_tsquery(
+            sqlalchemy.literal_column("'{}'".format(cls.search_config)),
+            terms
+        )
+
+    @classmethod
+    def fts_table_name(cls):
+        '''Name of the SQLite FTS5 table for this collection.'''
+        return '{}_fts'.format(sqlalchemy.inspect(cls.model).local_table.name)
+
+    def fts_match(self, colspec, terms):
+        '''SQLite FTS5 ``MATCH`` clause for a search filter.'''
+        if colspec:
+            target = sqlalchemy.literal_column(
+                sqlalchemy.inspect(self.model).mapper.get_property(
+                    colspec[0]
+                ).columns[0].name
+            )
+        else:
+            target = sqlalchemy.literal_column(self.fts_table_name())
+        return target.op('MATCH')(self.fts_terms(terms))
 
+    @staticmethod
+    def fts_terms(terms):
+        '''Convert web search syntax terms into an FTS5 query string.
+
+        Words and "quoted phrases" are quoted as FTS5 strings (so that
+        punctuation can't be taken as query syntax), ``or`` becomes ``OR``
+        and a leading ``-`` becomes ``NOT``.
         '''
-        ret = {
-            'type': self.collection_name,
-            'id': str(obj_id)
-        }
+        parts = []
+        for minus, phrase, word in re.findall(
+            r'(-?)(?:"([^"]*)"?|([^\s"]+))', terms
+        ):
+            if word.lower() == 'or':
+                if parts and parts[-1] not in ('OR', 'NOT'):
+                    parts.append('OR')
+                continue
+            text = (phrase or word).strip()
+            if not text:
+                continue
+            if minus:
+                if not parts or parts[-1] in ('OR', 'NOT'):
+                    # FTS5 NOT needs something on its left.
+                    continue
+                parts.append('NOT')
+            parts.append('"{}"'.format(text))
+        while parts and parts[-1] in ('OR', 'NOT'):
+            parts.pop()
+        return ' '.join(parts) or '""'
 
-        for callback in self.callbacks['after_serialise_identifier']:
-            ret = callback(self, ret)
+    @classmethod
+    def search_index_ddl(cls, dialect):
+        '''Statements creating the indexes used by search filters.
 
-        return ret
+        On PostgreSQL these are GIN indexes on the ``to_tsvector()`` of each
+        search column and of all the search columns together (for
+        ``filter[q]``). On SQLite they create an external content FTS5 table
+        with triggers to keep it up to date, and fill it.
 
-    def serialise_db_item(
-            self, item,
-            included, include_path=None,
-            ):
-        '''Serialise an individual database item to JSON-API.
+        Parameters:
+            dialect (str): database dialect name.
 
-        Arguments:
-            item: item to serialise.
+        Returns:
+            list: SQL statements (empty if there are no search columns or the
+            database isn't supported).
+        '''
+        if not cls.search_columns:
+            return []
+        mapper = sqlalchemy.inspect(cls.model).mapper
+        table = mapper.local_table.name
+        columns = [
+            mapper.get_property(name).columns[0].name
+            for name in cls.search_columns
+        ]
+        if dialect == 'postgresql':
+            pg_dialect = postgresql.dialect()
+            indexes = [
+                ('{}_{}_search_idx'.format(table, col), [col])
+                for col in columns
+            ]
+            if len(columns) > 1:
+                indexes.append(('{}_search_idx'.format(table), columns))
+            return [
+                'CREATE INDEX IF NOT EXISTS {} ON {} USING gin ({})'.format(
+                    name, table,
+                    cls.search_vector(
+                        None, [sqlalchemy.column(col) for col in cols]
+                    ).compile(
+                        dialect=pg_dialect,
+                        compile_kwargs={'literal_binds': True}
+                    )
+                ) for name, cols in indexes
+            ]
+        if dialect == 'sqlite':
+            fts = cls.fts_table_name()
+            key = cls.key_column.name
+            cols = ', '.join(columns)
+            new = ', '.join('new.{}'.format(col) for col in columns)
+            old = ', '.join('old.{}'.format(col) for col in columns)
+            delete = (
+                "INSERT INTO {fts}({fts}, rowid, {cols}) "
+                "VALUES ('delete', old.{key}, {old});"
+            )
+            insert = (
+                "INSERT INTO {fts}(rowid, {cols}) VALUES (new.{key}, {new});"
+            )
+            return [stmt.format(
+                fts=fts, table=table, key=key, cols=cols, new=new, old=old
+            ) for stmt in (
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                "{cols}, content='{table}', content_rowid='{key}')",
+                "CREATE TRIGGER IF NOT EXISTS {fts}_ai "
+                "AFTER INSERT ON {table} "
+                "BEGIN " + insert + " END",
+                "CREATE TRIGGER IF NOT EXISTS {fts}_ad "
+                "AFTER DELETE ON {table} "
+                "BEGIN " + delete + " END",
+                "CREATE TRIGGER IF NOT EXISTS {fts}_au "
+                "AFTER UPDATE ON {table} "
+                "BEGIN " + delete + " " + insert + " END",
+                "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+            )]
+        return []
+
+    @staticmethod
+    def filter_value(op, val):
+        '''Convert a filter param value to the value used in the query.
+
+        ``like`` and ``ilike`` replace any '*' with '%'; other operators use
+        the value as is.
+        '''
+        if op == 'like' or op == 'ilike':
+            val = re.sub(r'\*', '%', val)
+        return val
 
-        Keyword Arguments:
-            included (dict): dictionary to be filled with included resource
-                objects.
-            include_path (list): list tracking current include path for
-                recursive calls.
+    def query_count(self, q):
+        '''Count the results of q using the requested count strategy.
+
+        **Query Parameters**
+
+            **page[count]:** one of:
+
+                * ``exact``: ``SELECT count(*)`` over the whole query.
+                * ``window``: an exact count read from a ``count(*) OVER ()``
+                  column added to the page query, saving a round trip.
+                  Nothing is run here: the page query does the work (see
+                  :py:func:`collection_return`). Keyset paging gets an exact
+                  count instead, since the window would only see rows after
+                  the cursor.
+                * ``estimate``: the planner's row estimate from ``EXPLAIN``
+                  (PostgreSQL only: other databases get an exact count).
+                * ``capped``: an exact count of at most ``count_cap`` items.
+                  If there are more, the total is reported as unknown.
+                * ``none``: don't count.
+
+            If the count cache is enabled, exact counts are looked up there
+            first and ``cached`` in the returned dict says whether the count
+            came from the cache.
+
+            The default is the collection's ``count_strategy``.
+
+        Parameters:
+            q (sqlalchemy.orm.query.Query): unpaged query.
 
         Returns:
-            dict: resource object dictionary.
+            dict: results meta in the form:
+
+            .. parsed-literal::
+
+                {
+                    'available': count (None if not known),
+                    'count': strategy actually used,
+                    'at_least': (capped only) lower bound if over the cap
+                }
+
+            For ``window`` the dict also has a ``fallback`` key: a callable
+            giving the count if the page turns out to be empty.
         '''
-        DBSession = self.get_dbsession()
-        if include_path is None:
-            include_path = []
-        model = self.model
-        # Required for some introspection.
-        mapper = sqlalchemy.inspect(model).mapper
-        ispector = self.request.registry.introspector
+        strategy = self.collection_query_info(self.request)['page[count]']
+        if strategy == 'none':
+            return {'available': None, 'count': 'none'}
+        if strategy == 'window' and not self.keyset_paging:
+            return {'available': None, 'count': 'window', 'fallback': q.count}
+        if strategy == 'capped':
+            count = q.limit(self.count_cap + 1).count()
+            if count > self.count_cap:
+                return {
+                    'available': None,
+                    'count': 'capped',
+                    'at_least': count
+                }
+            return {'available': count, 'count': 'exact'}
+        if strategy == 'estimate':
+            estimate = self.estimate_count(q)
+            if estimate is not None:
+                return {'available': estimate, 'count': 'estimate'}
+        if self.count_cache is None:
+            return {'available': q.count(), 'count': 'exact'}
+        key = self.count_cache_key()
+        count = self.count_cache.get(key)
+        if count is not None:
+            return {'available': count, 'count': 'exact', 'cached': True}
+        tables = self.count_cache_tables()
+        generations = self.count_cache.generations(tables)
+        count = q.count()
+        self.count_cache.set(key, count, tables, generations)
+        return {'available': count, 'count': 'exact', 'cached': False}
 
-        # Item's id and type are required at the top level of json-api
-        # objects.
-        # The item's id.
-        item_id = item._jsonapi_id
-        # JSON API type.
-        type_name = self.collection_name
-        item_url = self.request.route_url(
-            self.item_route_name,
-            **{'id': item._jsonapi_id}
+    def count_cache_key(self):
+        '''Key for the current request's total in the count cache.
+
+        The total depends on the route (collection, or parent item and
+        relationship), the filters and any sort keys which join to related
+        tables. Paging, sparse fields and includes don't change it.
+
+        Returns:
+            tuple: hashable key.
+        '''
+        qinfo = self.collection_query_info(self.request)
+        return (
+            self.collection_name,
+            self.request.matched_route.name,
+            tuple(sorted(self.request.matchdict.items())),
+            tuple(sorted(
+                (tuple(finfo['colspec']), finfo['op'], finfo['value'])
+                for finfo in qinfo['_filters'].values()
+            )),
+            tuple(sorted(
+                key_info['key'] for key_info in qinfo['_sort']
+                if '.' in key_info['key'] or
+                key_info['key'] in self.relationships
+            )),
         )
 
-        atts = {
-            key: getattr(item, key)
-            for key in self.requested_attributes.keys()
-        }
+    def count_cache_tables(self):
+        '''Names of tables whose changes invalidate the current count.
 
-        rels = {}
-        for key, rel in self.relationships.items():
-            rel_path_str = '.'.join(include_path + [key])
-            if key not in self.requested_relationships and\
-                    rel_path_str not in self.requested_include_names():
-                continue
-            rel_dict = {
-                'links': {
-                    'self': '{}/relationships/{}'.format(item_url, key),
-                    'related': '{}/{}'.format(item_url, key)
-                },
-                'meta': {
-                    'direction': rel.direction.name,
-                    'results': {}
+        Returns:
+            set: this collection's tables, association tables of its
+            relationships, and tables joined for sorting.
+        '''
+        qinfo = self.collection_query_info(self.request)
+        mapper = sqlalchemy.inspect(self.model).mapper
+        tables = {table.name for table in mapper.tables}
+        for rel in mapper.relationships:
+            if rel.secondary is not None:
+                tables.add(rel.secondary.name)
+        for key_info in qinfo['_sort']:
+            relname = key_info['key'].split('.')[0]
+            if relname in self.relationships:
+                tables.update(
+                    table.name for table in
+                    self.relationships[relname].mapper.tables
+                )
+        return tables
+
+    def estimate_count(self, q):
+        '''Planner estimate of the number of results of q.
+
+        Parameters:
+            q (sqlalchemy.orm.query.Query): query.
+
+        Returns:
+            int: estimated number of rows, or None if the database can't
+            provide an estimate (not PostgreSQL).
+        '''
+        conn = self.get_dbsession().connection()
+        if conn.dialect.name != 'postgresql':
+            return None
+        compiled = q.statement.compile(dialect=conn.dialect)
+        plan = conn.execute(
+            'EXPLAIN (FORMAT JSON) {}'.format(compiled),
+            compiled.params
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def collection_aggregate(self):
+        '''Compute aggregates over the (filtered) collection.
+
+        Grouping and counting is done by the database: only the groups are
+        returned, in ``meta.aggregate``, rather than the resources.
+
+        **Query Parameters**
+
+            **aggregate[count]:** comma separated list of columns to group by.
+            The number of resources in each group is returned as ``count``.
+            Columns are attributes, the id or to-one relationships (grouped
+            by the related id, named either by relationship or by foreign key
+            column). An empty value gives a single group.
+
+            **aggregate[bucket]:** ``<attribute>:<unit>`` where unit is one of
+            ``second``, ``minute``, ``hour``, ``day`` (default), ``week``,
+            ``month`` or ``year``. Also group by the date/time attribute
+            truncated to the unit.
+
+            **aggregate[sum|avg|min|max]:** comma separated list of
+            attributes to compute the function of in each group, returned as
+            ``<function>.<attribute>``.
+
+            **aggregate[facets]:** comma separated list of columns to return
+            distinct values and their counts for, most common first.
+
+            **filter[<attribute>:<op>]:** filters are applied before
+            aggregating.
+
+        Returns:
+            dict: dict in the form:
+
+            .. parsed-literal::
+
+                {
+                    "meta": {
+                        "aggregate": {
+                            "groups": [
+                                {
+                                    <column>: value,
+                                    <attribute>:<unit>: bucket,
+                                    "count": count,
+                                    <function>.<attribute>: value
+                                },
+                                ...
+                            ],
+                            "facets": {
+                                <column>: [
+                                    {"value": value, "count": count},
+                                    ...
+                                ]
+                            },
+                            "truncated": true if there were more than
+                                pyramid_jsonapi.aggregate.max_groups groups
+                        }
+                    }
                 }
-            }
-            rel_class = rel.mapper.class_
-            rel_view = self.view_instance(rel_class)
-            is_included = False
-            if rel_path_str in self.requested_include_names():
-                is_included = True
-            q = self.related_query(
-                item._jsonapi_id, rel, full_object=is_included
+
+        Raises:
+            HTTPBadRequest
+
+            HTTPForbidden: if the collection decides which objects are
+            allowed (overrides :py:func:`allowed_object`): aggregates never
+            load the objects to ask.
+
+        Examples:
+            Count posts per author per day:
+
+            .. parsed-literal::
+
+                http GET http://localhost:6543/posts?aggregate[count]=author_id&aggregate[bucket]=published_at:day
+        '''
+        if type(self).allowed_object is not CollectionViewBase.allowed_object:
+            raise HTTPForbidden(
+                'Collection {} has per object permissions: aggregates are not '
+                'allowed.'.format(self.collection_name)
             )
-            if rel.direction is ONETOMANY or rel.direction is MANYTOMANY:
-                qinfo = self.collection_query_info(self.request)
-                limit = self.related_limit(rel)
-                rel_dict['meta']['results']['limit'] = limit
-                rel_dict['meta']['results']['available'] = q.count()
-                q = q.limit(limit)
-                rel_dict['data'] = []
-                for ritem in q.all():
-                    rel_dict['data'].append(
-                        rel_view.serialise_resource_identifier(
-                            ritem._jsonapi_id
-                        )
-                    )
-                    if is_included:
-                        included[
-                            (rel_view.collection_name, ritem._jsonapi_id)
-                        ] = rel_view.serialise_db_item(
-                            ritem,
-                            included, include_path + [key]
-                        )
-                rel_dict['meta']['results']['returned'] =\
-                    len(rel_dict['data'])
-            else:
-                if is_included:
-                    ritem = None
-                    try:
-                        ritem = q.one()
-                    except sqlalchemy.orm.exc.NoResultFound:
-                        rel_dict['data'] = None
-                    if ritem:
-                        included[
-                            (rel_view.collection_name, ritem._jsonapi_id)
-                        ] = rel_view.serialise_db_item(
-                            ritem,
-                            included, include_path + [key]
-                        )
+        DBSession = self.get_dbsession()
+        qinfo = self.collection_query_info(self.request)
+        params = dict(qinfo['_aggregate'])
+        max_groups = self.max_aggregate_groups
+        aggregate = {}
 
-                else:
-                    rel_id = getattr(
-                        item,
-                        rel.local_remote_pairs[0][0].name
+        groups = [
+            (name, self.aggregate_column(name))
+            for name in self.aggregate_names(params.pop('count', ''))
+        ]
+        bucket = params.pop('bucket', None)
+        if bucket is not None:
+            name, _, unit = bucket.partition(':')
+            groups.append((
+                bucket,
+                self.bucket_expression(
+                    self.aggregate_column(name, attribute=True), unit or 'day'
+                )
+            ))
+        metrics = []
+        for func_name in AGGREGATE_FUNCTIONS:
+            for name in self.aggregate_names(params.pop(func_name, '')):
+                metrics.append((
+                    '{}.{}'.format(func_name, name),
+                    getattr(sqlalchemy.func, func_name)(
+                        self.aggregate_column(name, attribute=True)
                     )
-                    if rel_id is None:
-                        rel_dict['data'] = None
-                    else:
-                        rel_dict[
-                            'data'
-                        ] = rel_view.serialise_resource_identifier(
-                            rel_id
-                        )
-            if key in self.requested_relationships:
-                rels[key] = rel_dict
+                ))
+        facets = [
+            (name, self.aggregate_column(name))
+            for name in self.aggregate_names(params.pop('facets', ''))
+        ]
+        if params:
+            raise HTTPBadRequest(
+                'Unknown aggregate parameter(s): {}'.format(
+                    ', '.join('aggregate[{}]'.format(k) for k in params)
+                )
+            )
 
-        ret = {
-            'id': str(item_id),
-            'type': type_name,
-            'attributes': atts,
-            'links': {
-                'self': item_url
-            },
-            'relationships': rels
-        }
+        try:
+            if 'count' in qinfo['_aggregate'] or groups or metrics:
+                group_exprs = [expr for name, expr in groups]
+                q = DBSession.query(
+                    *group_exprs + [sqlalchemy.func.count()] +
+                    [expr for name, expr in metrics]
+                ).select_from(self.model)
+                q = self.query_add_filtering(q)
+                if group_exprs:
+                    q = q.group_by(*group_exprs).order_by(*group_exprs)
+                names = [name for name, expr in groups] + ['count'] +\
+                    [name for name, expr in metrics]
+                rows = q.limit(max_groups + 1).all()
+                if len(rows) > max_groups:
+                    aggregate['truncated'] = True
+                aggregate['groups'] = [
+                    dict(zip(names, row)) for row in rows[:max_groups]
+                ]
+            if facets:
+                aggregate['facets'] = {}
+            for name, expr in facets:
+                count = sqlalchemy.func.count()
+                q = DBSession.query(expr, count).select_from(self.model)
+                q = self.query_add_filtering(q)
+                rows = q.group_by(expr).order_by(
+                    count.desc(), expr
+                ).limit(max_groups + 1).all()
+                if len(rows) > max_groups:
+                    aggregate['truncated'] = True
+                aggregate['facets'][name] = [
+                    {'value': value, 'count': count}
+                    for value, count in rows[:max_groups]
+                ]
+        except sqlalchemy.exc.ProgrammingError as e:
+            raise HTTPBadRequest(
+                'Could not compute aggregate: {}'.format(e.orig)
+            )
+
+        ret = {'meta': {'aggregate': aggregate}}
+        for callback in self.callbacks['after_collection_get']:
+            ret = callback(self, ret)
+        return ret
+
+    @staticmethod
+    def aggregate_names(value):
+        '''Split a comma separated aggregate parameter value.'''
+        return [name for name in value.split(',') if name]
+
+    def aggregate_column(self, name, attribute=False):
+        '''Column to aggregate on for name.
+
+        Only fields in :py:attr:`allowed_fields` (and the id) can be used.
+
+        Parameters:
+            name (str): attribute, id, to-one relationship or foreign key
+                column name.
+
+            attribute (bool): only allow attributes.
+
+        Returns:
+            sqlalchemy.orm.attributes.InstrumentedAttribute: column.
+
+        Raises:
+            HTTPBadRequest: if name can't be aggregated on.
+        '''
+        allowed = self.allowed_fields
+        if name in self.attributes and name in allowed:
+            return getattr(self.model, name)
+        if not attribute:
+            if name == self.key_column.name:
+                return getattr(self.model, name)
+            mapper = sqlalchemy.inspect(self.model).mapper
+            for relname, rel in self.relationships.items():
+                if rel.direction is not MANYTOONE or\
+                        len(rel.local_columns) != 1 or relname not in allowed:
+                    continue
+                prop = mapper.get_property_by_column(
+                    list(rel.local_columns)[0]
+                )
+                if name in (relname, prop.key):
+                    return getattr(self.model, prop.key)
+        raise HTTPBadRequest(
+            'Cannot aggregate on {}.{}'.format(self.collection_name, name)
+        )
+
+    def bucket_expression(self, col, unit):
+        '''Expression truncating a date/time column to unit.
+
+        Parameters:
+            col: date or datetime column.
+
+            unit (str): one of ``BUCKET_UNITS``.
+
+        Returns:
+            sqlalchemy.sql.expression.ColumnElement: truncated value.
+
+        Raises:
+            HTTPBadRequest: for unknown units or databases without support.
+        '''
+        if unit not in BUCKET_UNITS:
+            raise HTTPBadRequest(
+                'Bucket unit must be one of {}'.format(', '.join(BUCKET_UNITS))
+            )
+        dialect = self.get_dbsession().get_bind().dialect.name
+        if dialect == 'postgresql':
+            return sqlalchemy.func.date_trunc(unit, col)
+        if dialect == 'sqlite':
+            if unit == 'week':
+                # Monday of the week.
+                return sqlalchemy.func.date(col, 'weekday 0', '-6 days')
+            return sqlalchemy.func.strftime({
+                'second': '%Y-%m-%dT%H:%M:%S',
+                'minute': '%Y-%m-%dT%H:%M:00',
+                'hour': '%Y-%m-%dT%H:00:00',
+                'day': '%Y-%m-%d',
+                'month': '%Y-%m-01',
+                'year': '%Y-01-01',
+            }[unit], col)
+        raise HTTPBadRequest(
+            'aggregate[bucket] is not supported on {}'.format(dialect)
+        )
+
+    @property
+    def keyset_paging(self):
+        '''Whether the request asks for keyset (cursor) pagination.
+
+        **Query Parameters**
+
+            **page[after]:** or **page[before]:** cursor.
+
+        Returns:
+            bool: True if ``page[after]`` or ``page[before]`` is present.
+
+        Raises:
+            HTTPBadRequest: if both are present.
+        '''
+        page = self.collection_query_info(self.request)['_page']
+        if 'after' in page and 'before' in page:
+            raise HTTPBadRequest(
+                'Only one of page[after] and page[before] may be used.'
+            )
+        return 'after' in page or 'before' in page
+
+    def query_add_paging(self, q):
+        '''Add paging to query.
+
+        Use ``page[offset]`` and ``page[limit]``, or keyset paging via
+        :py:func:`query_add_keyset` if a cursor was requested, or a random
+        sample via :py:func:`query_add_sample` for ``page[sample]``. With
+        ``page[count]=window`` the total is added to each row by
+        :py:func:`query_add_window_count`.
+
+        Parameters:
+            q (sqlalchemy.orm.query.Query): query
+
+        Returns:
+            sqlalchemy.orm.query.Query: query for one page.
+        '''
+        if 'sample' in self.collection_query_info(self.request)['_page']:
+            return self.query_add_sample(q)
+        if self.keyset_paging:
+            return self.query_add_keyset(q)
+        qinfo = self.collection_query_info(self.request)
+        if qinfo['page[count]'] == 'window':
+            q = self.query_add_window_count(q)
+        q = q.offset(qinfo['page[offset]'])
+        q = q.limit(qinfo['page[limit]'])
+        return q
+
+    def sample_params(self):
+        '''Size, percentage and method of the requested sample.
+
+        **Query Parameters**
+
+            **page[sample]:** either a number of items or a percentage of the
+            collection (``10%``).
+
+            **page[sample_method]:** ``system`` (sample whole pages of the
+            table: fastest) or ``bernoulli`` (sample individual rows). The
+            default is the collection's ``sample_method``. PostgreSQL only.
+
+        Returns:
+            tuple: (size, percent, method). One of size and percent is None.
+            The method is the one actually used: on SQLite a number of items
+            is chosen by ``rowid`` and a percentage by ``bernoulli``.
+
+        Raises:
+            HTTPBadRequest: if the parameters are invalid or can't be combined
+            with keyset paging.
+        '''
+        page = self.collection_query_info(self.request)['_page']
+        if 'after' in page or 'before' in page:
+            raise HTTPBadRequest(
+                'page[sample] may not be used with page[after] or '
+                'page[before].'
+            )
+        value = page['sample']
+        size = percent = None
+        try:
+            if value.endswith('%'):
+                percent = float(value[:-1])
+                valid = 0 < percent <= 100
+            else:
+                size = int(value)
+                valid = size > 0
+        except ValueError:
+            valid = False
+        if not valid:
+            raise HTTPBadRequest(
+                'page[sample] must be a number of items or a percentage '
+                '(for example 10%).'
+            )
+        method = page.get('sample_method', self.sample_method)
+        if method not in SAMPLE_METHODS:
+            raise HTTPBadRequest(
+                'page[sample_method] must be one of {}'.format(
+                    ', '.join(SAMPLE_METHODS)
+                )
+            )
+        if self.get_dbsession().get_bind().dialect.name == 'sqlite':
+            method = 'rowid' if percent is None else 'bernoulli'
+        return size, percent, method
+
+    def query_add_sample(self, q):
+        '''Restrict query to a random sample of the (filtered) collection.
+
+        The ids of the sample are picked by a subquery which never orders the
+        whole table: only the sampled rows are shuffled to pick the page.
+
+        On PostgreSQL the subquery uses ``TABLESAMPLE``. For a number of
+        items, the percentage sampled is worked out from the planner's
+        estimate of the number of results, with some to spare.
+
+        On SQLite a number of items is sampled by picking random ids between
+        the lowest and highest and looking them up, so gaps in the ids mean
+        fewer items may come back. A percentage keeps each row with that
+        probability.
+
+        Either way at most ``page[limit]`` items (or the number asked for, up
+        to ``max_limit``) are returned.
+
+        Parameters:
+            q (sqlalchemy.orm.query.Query): sorted and filtered query.
+
+        Returns:
+            sqlalchemy.orm.query.Query: query for the sample.
+        '''
+        size, percent, method = self.sample_params()
+        key = getattr(self.model, self.key_column.name)
+        ids = self.query_add_filtering(self.get_dbsession().query(key))
+        dialect = self.get_dbsession().get_bind().dialect.name
+        if size is not None:
+            limit = min(size, self.max_limit)
+        else:
+            limit = self.collection_query_info(self.request)['page[limit]']
+        if dialect == 'postgresql':
+            if percent is None:
+                estimate = self.estimate_count(ids) or 1
+                percent = min(
+                    100.0, 100.0 * SAMPLE_OVERSAMPLING * limit / estimate
+                )
+            sample = sqlalchemy.tablesample(
+                self.key_column.table,
+                getattr(sqlalchemy.func, method)(percent),
+                name='jsonapi_sample'
+            )
+            ids = ids.filter(key.in_(
+                sqlalchemy.select([sample.c[self.key_column.name]])
+            ))
+        elif dialect == 'sqlite':
+            if percent is None:
+                ids = ids.filter(key.in_(
+                    self.random_keys(SAMPLE_OVERSAMPLING * limit)
+                ))
+            else:
+                ids = ids.filter(
+                    sqlalchemy.func.abs(sqlalchemy.func.random()) % 1000000 <
+                    percent * 10000
+                )
+        else:
+            raise HTTPBadRequest(
+                'page[sample] is not supported on {}.'.format(dialect)
+            )
+        ids = ids.order_by(sqlalchemy.func.random()).limit(limit)
+        return q.filter(key.in_(ids.subquery()))
+
+    def random_keys(self, count):
+        '''Select of count random integers between the lowest and highest key.
+
+        Parameters:
+            count (int): number of keys to pick.
+
+        Returns:
+            sqlalchemy.sql.expression.Select: select of keys (which may not
+            all exist).
+        '''
+        bounds = sqlalchemy.select([
+            sqlalchemy.func.min(self.key_column).label('lo'),
+            sqlalchemy.func.max(self.key_column).label('hi'),
+        ]).alias('jsonapi_bounds')
+        picks = sqlalchemy.select([
+            sqlalchemy.literal(0).label('n'),
+            sqlalchemy.null().label('key'),
+        ]).cte('jsonapi_picks', recursive=True)
+        picks = picks.union_all(
+            sqlalchemy.select([
+                picks.c.n + 1,
+                bounds.c.lo + sqlalchemy.func.abs(sqlalchemy.func.random()) %
+                (bounds.c.hi - bounds.c.lo + 1)
+            ]).where(picks.c.n < count)
+        )
+        return sqlalchemy.select([picks.c.key]).where(picks.c.key.isnot(None))
+
+    @staticmethod
+    def query_add_window_count(q):
+        '''Add a ``count(*) OVER ()`` column to query.
+
+        The window is evaluated before LIMIT and OFFSET, so every row of a
+        page carries the total number of results and no separate count query
+        is needed.
+
+        Parameters:
+            q (sqlalchemy.orm.query.Query): query before paging.
+
+        Returns:
+            sqlalchemy.orm.query.Query: query returning (item, total) rows.
+        '''
+        return q.add_columns(
+            sqlalchemy.func.count().over().label('jsonapi_total')
+        )
+
+    def keyset_columns(self):
+        '''Column names and directions which define the keyset order.
+
+        These are the sort keys with the key column added as a tie-breaker.
+
+        Returns:
+            list: list of (column name, ascending) tuples.
+
+        Raises:
+            HTTPBadRequest: if sorting on anything other than attributes.
+        '''
+        qinfo = self.collection_query_info(self.request)
+        cols = []
+        for key_info in qinfo['_sort']:
+            key = key_info['key']
+            if key == 'id':
+                key = self.key_column.name
+            if key != self.key_column.name and key not in self.attributes:
+                raise HTTPBadRequest(
+                    'Cursor pagination only supports sorting by attributes '
+                    'of {}, not {}.'.format(self.collection_name, key)
+                )
+            cols.append((key, key_info['ascending']))
+        if self.key_column.name not in [key for key, ascending in cols]:
+            cols.append((self.key_column.name, True))
+        return cols
+
+    def query_add_keyset(self, q):
+        '''Add keyset pagination to query.
+
+        The query is (re)ordered by :py:func:`keyset_columns` and restricted
+        to items after (or before) the cursor, so the database can seek
+        straight to the page instead of scanning past an offset. One more item
+        than the page limit is fetched to find out if there are more.
+
+        **Query Parameters**
+
+            **page[after]:** or **page[before]:** cursor as produced by
+            :py:func:`item_cursor`. An empty cursor means the start (after) or
+            end (before) of the results.
+
+        Parameters:
+            q (sqlalchemy.orm.query.Query): query
+
+        Returns:
+            sqlalchemy.orm.query.Query: query for one page (plus one item).
+            For ``page[before]`` the order is reversed.
+        '''
+        qinfo = self.collection_query_info(self.request)
+        before = 'before' in qinfo['_page']
+        cursor = qinfo['_page']['before' if before else 'after']
+        cols = [
+            (getattr(self.model, key), ascending)
+            for key, ascending in self.keyset_columns()
+        ]
+
+        # NULLs sort after every value (the PostgreSQL default, made
+        # explicit) and the seek conditions below have to agree.
+        q = q.order_by(None)
+        for col, ascending in cols:
+            if ascending != before:
+                q = q.order_by(
+                    col.asc().nullslast() if self.nullable(col) else col
+                )
+            else:
+                q = q.order_by(
+                    col.desc().nullsfirst() if self.nullable(col)
+                    else col.desc()
+                )
+
+        if cursor:
+            values = self.decode_cursor(cursor)
+            if len(values) != len(cols):
+                raise HTTPBadRequest(
+                    'Cursor does not match sort order {}.'.format(
+                        qinfo['sort']
+                    )
+                )
+            # (c1 > v1) or (c1 == v1 and c2 > v2) or ...
+            clauses = []
+            for i, (col, ascending) in enumerate(cols):
+                cmp = self.keyset_seek(col, values[i], ascending != before)
+                if cmp is None:
+                    continue
+                clauses.append(sqlalchemy.and_(
+                    *[
+                        cols[j][0].is_(None) if values[j] is None
+                        else cols[j][0] == values[j]
+                        for j in range(i)
+                    ] + [cmp]
+                ))
+            q = q.filter(
+                sqlalchemy.or_(*clauses) if clauses else sqlalchemy.false()
+            )
+
+        return q.limit(qinfo['page[limit]'] + 1)
+
+    @staticmethod
+    def nullable(col):
+        '''Whether the column behind a mapped attribute allows NULL.'''
+        return any(c.nullable for c in col.property.columns)
+
+    def keyset_seek(self, col, value, forwards):
+        '''Condition for col being past value in keyset order.
+
+        NULL sorts after every other value.
+
+        Parameters:
+            col: mapped column attribute.
+            value: the cursor's value for col.
+            forwards (bool): whether col increases through the pages.
+
+        Returns:
+            condition, or None if nothing can be past value.
+        '''
+        nullable = self.nullable(col)
+        if value is None:
+            return col.isnot(None) if not forwards else None
+        if forwards:
+            cmp = col > value
+            return sqlalchemy.or_(cmp, col.is_(None)) if nullable else cmp
+        return col < value
+
+    def item_cursor(self, item):
+        '''Keyset cursor pointing at item.
+
+        Args:
+            item: database item.
+
+        Returns:
+            str: opaque cursor for ``page[after]`` or ``page[before]``.
+        '''
+        values = [getattr(item, key) for key, asc in self.keyset_columns()]
+        return base64.urlsafe_b64encode(
+            json.dumps(values, default=str).encode()
+        ).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        '''Decode a cursor produced by :py:func:`item_cursor`.
+
+        Returns:
+            list: column values.
+
+        Raises:
+            HTTPBadRequest: if the cursor is not valid.
+        '''
+        try:
+            values = json.loads(
+                base64.urlsafe_b64decode(cursor.encode()).decode()
+            )
+        except (ValueError, TypeError):
+            raise HTTPBadRequest('Invalid cursor {}'.format(cursor))
+        if not isinstance(values, list):
+            raise HTTPBadRequest('Invalid cursor {}'.format(cursor))
+        return values
+
+    def related_limit(self, relationship):
+        '''Paging limit for related resources.
+
+        **Query Parameters**
+
+            **page[limit:relationships:<relname>]:** number of results to
+            return per page for related resource <relname>.
+
+        Parameters:
+            relationship(sqlalchemy.orm.relationships.RelationshipProperty):
+                the relationship to get the limit for.
+
+        Returns:
+            int: paging limit for related resources.
+        '''
+        limit_comps = ['limit', 'relationships', relationship.key]
+        limit = self.default_limit
+        qinfo = self.collection_query_info(self.request)
+        while limit_comps:
+            if '.'.join(limit_comps) in qinfo['_page']:
+                limit = int(qinfo['_page']['.'.join(limit_comps)])
+                break
+            limit_comps.pop()
+        return min(limit, self.max_limit)
+
+    def related_query(self, obj_id, relationship, full_object=True):
+        '''Construct query for related objects.
+
+        The related items are found by joining explicitly from the item,
+        along the relationship's full join conditions (through any secondary
+        table): composite and custom conditions work and the database can use
+        the item's primary key and the foreign key indexes. The joins are
+        built once per relationship in ``related_joins``.
+
+        Parameters:
+            obj_id (str): id of an item in this view's collection.
+
+            relationship (sqlalchemy.orm.relationships.RelationshipProperty):
+                the relationships to get related objects from.
+
+            full_object (bool): if full_object is ``True``, query for all
+                requested columns (probably to build resource objects). If
+                full_object is False, only query for the key column (probably
+                to build resource identifiers).
+
+        Returns:
+            sqlalchemy.orm.query.Query: query which will fetch related
+            object(s).
+        '''
+        DBSession = self.get_dbsession()
+        rel = relationship
+        rel_class = rel.mapper.class_
+        rel_view = self.view_instance(rel_class)
+        try:
+            parent, path = self.related_joins[rel.key]
+        except KeyError:
+            raise HTTPError('Unknown relationship "{}".'.format(rel.key))
+        q = DBSession.query(rel_class).execution_options(
+            jsonapi_prepare=self.prepare_statements
+        )
+        if full_object:
+            q = q.options(
+                load_only(*rel_view.allowed_requested_query_columns.keys())
+            )
+        else:
+            q = q.options(load_only(rel_view.key_column.name))
+        q = q.select_from(parent).join(path).filter(
+            getattr(parent, self.key_column.name) == obj_id
+        )
+
+        return q
+
+    def object_exists(self, obj_id):
+        '''Test if object with id obj_id exists.
+
+        Args:
+            obj_id (str): object id
+
+        Returns:
+            bool: True if object exists, False if not.
+        '''
+        DBSession = self.get_dbsession()
+        item = DBSession.query(
+            self.model
+        ).options(
+            load_only(self.key_column.name)
+        ).execution_options(
+            jsonapi_prepare=self.prepare_statements
+        ).get(obj_id)
+        if item:
+            return True
+        else:
+            return False
+
+    def serialise_resource_identifier(self, obj_id):
+        '''Return a resource identifier dictionary for id "obj_id"
+
+        '''
+        ret = {
+            'type': self.collection_name,
+            'id': str(obj_id)
+        }
+
+        for callback in self.callbacks['after_serialise_identifier']:
+            ret = callback(self, ret)
+
+        return ret
+
+    def serialise_db_item(
+            self, item,
+            included, include_path=None, related=None
+            ):
+        '''Serialise an individual database item to JSON-API.
+
+        Arguments:
+            item: item to serialise.
+
+        Keyword Arguments:
+            included (dict): dictionary to be filled with included resource
+                objects.
+            include_path (list): list tracking current include path for
+                recursive calls.
+            related (dict): related items already known for some to-many
+                relationships, keyed by relationship name. These are used
+                instead of querying the database.
+
+        Returns:
+            dict: resource object dictionary.
+        '''
+        DBSession = self.get_dbsession()
+        if include_path is None:
+            include_path = []
+        model = self.model
+        # Required for some introspection.
+        mapper = sqlalchemy.inspect(model).mapper
+        ispector = self.request.registry.introspector
+
+        # Item's id and type are required at the top level of json-api
+        # objects.
+        # The item's id.
+        item_id = item._jsonapi_id
+        # JSON API type.
+        type_name = self.collection_name
+        item_url = self.request.route_url(
+            self.item_route_name,
+            **{'id': item._jsonapi_id}
+        )
+
+        atts = {
+            key: getattr(item, key)
+            for key in self.requested_attributes.keys()
+        }
+
+        rels = {}
+        for key, rel in self.relationships.items():
+            rel_path_str = '.'.join(include_path + [key])
+            if key not in self.requested_relationships and\
+                    rel_path_str not in self.requested_include_names():
+                continue
+            rel_dict = {
+                'links': {
+                    'self': '{}/relationships/{}'.format(item_url, key),
+                    'related': '{}/{}'.format(item_url, key)
+                },
+                'meta': {
+                    'direction': rel.direction.name,
+                    'results': {}
+                }
+            }
+            rel_class = rel.mapper.class_
+            rel_view = self.view_instance(rel_class)
+            is_included = False
+            if rel_path_str in self.requested_include_names():
+                is_included = True
+            q = self.related_query(
+                item._jsonapi_id, rel, full_object=is_included
+            )
+            if rel.direction is ONETOMANY or rel.direction is MANYTOMANY:
+                qinfo = self.collection_query_info(self.request)
+                limit = self.related_limit(rel)
+                rel_dict['meta']['results']['limit'] = limit
+                if related is not None and key in related:
+                    ritems = related[key]
+                    rel_dict['meta']['results']['available'] = len(ritems)
+                    ritems = ritems[:limit]
+                else:
+                    rel_dict['meta']['results']['available'] = q.count()
+                    ritems = q.limit(limit).all()
+                rel_dict['data'] = []
+                for ritem in ritems:
+                    rel_dict['data'].append(
+                        rel_view.serialise_resource_identifier(
+                            ritem._jsonapi_id
+                        )
+                    )
+                    if is_included:
+                        included[
+                            (rel_view.collection_name, ritem._jsonapi_id)
+                        ] = rel_view.serialise_db_item(
+                            ritem,
+                            included, include_path + [key]
+                        )
+                rel_dict['meta']['results']['returned'] =\
+                    len(rel_dict['data'])
+            else:
+                if is_included:
+                    ritem = None
+                    try:
+                        ritem = q.one()
+                    except sqlalchemy.orm.exc.NoResultFound:
+                        rel_dict['data'] = None
+                    if ritem:
+                        included[
+                            (rel_view.collection_name, ritem._jsonapi_id)
+                        ] = rel_view.serialise_db_item(
+                            ritem,
+                            included, include_path + [key]
+                        )
+
+                else:
+                    rel_id = getattr(
+                        item,
+                        rel.local_remote_pairs[0][0].name
+                    )
+                    if rel_id is None:
+                        rel_dict['data'] = None
+                    else:
+                        rel_dict[
+                            'data'
+                        ] = rel_view.serialise_resource_identifier(
+                            rel_id
+                        )
+            if key in self.requested_relationships:
+                rels[key] = rel_dict
+
+        ret = {
+            'id': str(item_id),
+            'type': type_name,
+            'attributes': atts,
+            'links': {
+                'self': item_url
+            },
+            'relationships': rels
+        }
+
+        for callback in self.callbacks['after_serialise_object']:
+            ret = callback(self, ret)
+
+        return ret
+
+    @classmethod
+    @functools.lru_cache(maxsize=128)
+    def collection_query_info(cls, request):
+        '''Return dictionary of information used during DB query.
+
+        Args:
+            request (pyramid.request): request object.
+
+        Returns:
+            dict: query info in the form::
+
+                {
+                    'page[limit]': maximum items per page,
+                    'page[offset]': offset for current page (in items),
+                    'page[count]': count strategy,
+                    'sort': sort param from request,
+                    '_sort': [
+                        {
+                            'key': sort key ('field' or 'relationship.field'),
+                            'ascending': sort ascending or descending (bool)
+                        },
+                        ...
+                    },
+                    '_filters': {
+                        filter_param_name: {
+                            'colspec': list of columns split on '.',
+                            'op': filter operator,
+                            'value': value of filter param,
+                        }
+                    },
+                    '_page': {
+                        paging_param_name: value,
+                        ...
+                    },
+                    '_aggregate': {
+                        aggregate function: value,
+                        ...
+                    }
+                }
+
+            Keys beginning with '_' are derived.
+        '''
+        info = {}
+
+        # Paging by limit and offset.
+        # Use params 'page[limit]' and 'page[offset]' to comply with spec.
+        info['page[limit]'] = min(
+            cls.max_limit,
+            int(request.params.get('page[limit]', cls.default_limit))
+        )
+        info['page[offset]'] = int(request.params.get('page[offset]', 0))
+        info['page[count]'] = request.params.get(
+            'page[count]', cls.count_strategy
+        )
+        if info['page[count]'] not in COUNT_STRATEGIES:
+            raise HTTPBadRequest(
+                'page[count] must be one of {}'.format(
+                    ', '.join(COUNT_STRATEGIES)
+                )
+            )
+        if cls.max_offset is not None and\
+                info['page[offset]'] > cls.max_offset:
+            # Deep offsets make the database scan and discard every row up to
+            # the offset.
+            raise HTTPBadRequest(
+                'page[offset] may not be more than {}: '
+                'use page[after] to page further.'.format(cls.max_offset)
+            )
+
+        # Sorting.
+        # Use param 'sort' as per spec.
+        # Split on '.' to allow sorting on columns of relationship tables:
+        #   sort=name -> sort on the 'name' column.
+        #   sort=owner.name -> sort on the 'name' column of the target table
+        #     of the relationship 'owner'.
+        # The default sort column is 'id'.
+        sort_param = request.params.get('sort', cls.key_column.name)
+        info['sort'] = sort_param
+
+        # Break sort param down into components and store in _sort.
+        info['_sort'] = []
+        for sort_key in sort_param.split(','):
+            key_info = {}
+            # Check to see if it starts with '-', which indicates a reverse
+            # sort.
+            ascending = True
+            if sort_key.startswith('-'):
+                ascending = False
+                sort_key = sort_key[1:]
+            key_info['key'] = sort_key
+            key_info['ascending'] = ascending
+            info['_sort'].append(key_info)
+
+        # Find all parametrised parameters ( :) )
+        info['_filters'] = {}
+        info['_page'] = {}
+        info['_aggregate'] = {}
+        for p in request.params.keys():
+            match = re.match(r'(.*?)\[(.*?)\]', p)
+            if not match:
+                continue
+            val = request.params.get(p)
+
+            # Filtering.
+            # Use 'filter[<condition>]' param.
+            # Format:
+            #   filter[<column_spec>:<operator>] = <value>
+            #   where:
+            #     <column_spec> is either:
+            #       <column_name> for an attribute, or
+            #       <relationship_name>.<column_name> for a relationship.
+            # Examples:
+            #   filter[name:eq]=Fred
+            #      would find all objects with a 'name' attribute of 'Fred'
+            #   filter[author.name:eq]=Fred
+            #      would find all objects where the relationship author pointed
+            #      to an object with 'name' 'Fred'
+            #
+            # Find all the filters.
+            if match.group(1) == 'filter':
+                if match.group(2) == 'q':
+                    # Full text search of all the search columns.
+                    info['_filters'][p] = {
+                        'colspec': [],
+                        'op': 'search',
+                        'value': val
+                    }
+                    continue
+                colspec, op = match.group(2).split(':')
+                colspec = colspec.split('.')
+                info['_filters'][p] = {
+                    'colspec': colspec,
+                    'op': op,
+                    'value': val
+                }
+
+            # Paging.
+            elif match.group(1) == 'page':
+                info['_page'][match.group(2)] = val
+
+            # Aggregates.
+            elif match.group(1) == 'aggregate':
+                info['_aggregate'][match.group(2)] = val
+
+        return info
+
+    def pagination_links(self, count=0, items=None, more=False):
+        '''Return a dictionary of pagination links.
+
+        Links use ``page[offset]`` unless the request used keyset paging
+        (``page[after]`` or ``page[before]``), in which case next and prev
+        links carry cursors for the last and first items of the page.
+
+        Args:
+            count (int): total number of results available (None if not
+                known).
+            items (list): database items in the current page.
+            more (bool): whether there are more items beyond this page in the
+                direction of travel (keyset paging only).
+
+        Returns:
+            dict: dictionary of named links.
+        '''
+        links = {}
+        req = self.request
+        route_name = req.matched_route.name
+        qinfo = self.collection_query_info(req)
+        if 'sample' in qinfo['_page']:
+            # Every request draws a fresh sample: there are no other pages.
+            return links
+        _query = {'page[{}]'.format(k): v for k, v in qinfo['_page'].items()}
+        _query['sort'] = qinfo['sort']
+        for f in sorted(qinfo['_filters']):
+            _query[f] = qinfo['_filters'][f]['value']
+
+        if self.keyset_paging:
+            for k in ('page[offset]', 'page[after]', 'page[before]'):
+                _query.pop(k, None)
+            before = 'before' in qinfo['_page']
+            cursor = qinfo['_page']['before' if before else 'after']
+            links['first'] = req.route_url(
+                route_name, _query=dict(_query, **{'page[after]': ''}),
+                **req.matchdict
+            )
+            links['last'] = req.route_url(
+                route_name, _query=dict(_query, **{'page[before]': ''}),
+                **req.matchdict
+            )
+            if items:
+                # Going forwards there are more if we found them; going
+                # backwards there are more if we started from a cursor.
+                if (more and not before) or (before and cursor):
+                    links['next'] = req.route_url(
+                        route_name,
+                        _query=dict(
+                            _query,
+                            **{'page[after]': self.item_cursor(items[-1])}
+                        ),
+                        **req.matchdict
+                    )
+                if (more and before) or (not before and cursor):
+                    links['prev'] = req.route_url(
+                        route_name,
+                        _query=dict(
+                            _query,
+                            **{'page[before]': self.item_cursor(items[0])}
+                        ),
+                        **req.matchdict
+                    )
+            return links
+
+        # First link.
+        _query['page[offset]'] = 0
+        links['first'] = req.route_url(
+            route_name, _query=_query, **req.matchdict
+        )
+
+        # Next link. Without a count, assume there is a next page unless this
+        # one was short.
+        next_offset = qinfo['page[offset]'] + qinfo['page[limit]']
+        if count is None:
+            has_next = items is None or len(items) >= qinfo['page[limit]']
+        else:
+            has_next = next_offset < count
+        if has_next:
+            _query['page[offset]'] = next_offset
+            links['next'] = req.route_url(
+                route_name, _query=_query, **req.matchdict
+            )
+
+        # Previous link.
+        if qinfo['page[offset]'] > 0:
+            prev_offset = qinfo['page[offset]'] - qinfo['page[limit]']
+            if prev_offset < 0:
+                prev_offset = 0
+            _query['page[offset]'] = prev_offset
+            links['prev'] = req.route_url(
+                route_name, _query=_query, **req.matchdict
+            )
+
+        # Last link.
+        if count is not None:
+            _query['page[offset]'] = (
+                max((count - 1), 0) //
+                qinfo['page[limit]']
+            ) * qinfo['page[limit]']
+            links['last'] = req.route_url(
+                route_name, _query=_query, **req.matchdict
+            )
+        return links
+
+    @property
+    def allowed_fields(self):
+        '''Set of fields to which current action is allowed.
+
+        Returns:
+            set: set of allowed field names.
+        '''
+        return set(self.fields)
+
+    def allowed_object(self, obj):
+        '''Whether or not current action is allowed on object.
+
+        Returns:
+            bool:
+        '''
+        return True
+
+    @property
+    @functools.lru_cache(maxsize=128)
+    def requested_field_names(self):
+        '''Get the sparse field names from request.
+
+        **Query Parameters**
+
+            **fields[<collection>]:** comma separated list of fields
+            (attributes or relationships) to include in data.
+
+        Returns:
+            set: set of field names.
+        '''
+        param = self.request.params.get(
+            'fields[{}]'.format(self.collection_name)
+        )
+        if param is None:
+            return self.attributes.keys() | self.relationships.keys()
+        if param == '':
+            return set()
+        return set(param.split(','))
+
+    @property
+    def requested_attributes(self):
+        '''Return a dictionary of attributes.
+
+        **Query Parameters**
+
+            **fields[<collection>]:** comma separated list of fields
+            (attributes or relationships) to include in data.
+
+        Returns:
+            dict: dict in the form:
+
+                .. parsed-literal::
+
+                    {
+                        <colname>: <column_object>,
+                        ...
+                    }
+        '''
+        return {
+            k: v for k, v in self.attributes.items()
+            if k in self.requested_field_names
+        }
+
+    @property
+    def requested_relationships(self):
+        '''Return a dictionary of relationships.
+
+        **Query Parameters**
+
+            **fields[<collection>]:** comma separated list of fields
+            (attributes or relationships) to include in data.
+
+        Returns:
+            dict: dict in the form:
+
+                .. parsed-literal::
+
+                    {
+                        <relname>: <relationship_object>,
+                        ...
+                    }
+        '''
+        return {
+            k: v for k, v in self.relationships.items()
+            if k in self.requested_field_names
+        }
+
+    @property
+    def requested_fields(self):
+        '''Union of attributes and relationships.
+
+        **Query Parameters**
+
+            **fields[<collection>]:** comma separated list of fields
+            (attributes or relationships) to include in data.
+
+        Returns:
+            dict: dict in the form:
+
+                .. parsed-literal::
+
+                    {
+                        <colname>: <column_object>,
+                        ...
+                        <relname>: <relationship_object>,
+                        ...
+                    }
+
+        '''
+        ret = self.requested_attributes
+        ret.update(
+            self.requested_relationships
+        )
+        return ret
+
+    @property
+    def allowed_requested_relationships_local_columns(self):
+        '''Finds all the local columns for allowed MANYTOONE relationships.
+
+        Returns:
+            dict: local columns indexed by column name.
+        '''
+        return {
+            pair[0].name: pair[0]
+            for k, rel in self.requested_relationships.items()
+            for pair in rel.local_remote_pairs
+            if rel.direction is MANYTOONE and k in self.allowed_fields
+        }
+
+    @property
+    def allowed_requested_query_columns(self):
+        '''All columns required in query to fetch allowed requested fields from
+        db.
+
+        Returns:
+            dict: Union of allowed requested_attributes and
+            allowed_requested_relationships_local_columns
+        '''
+        ret = {
+            k: v for k, v in self.requested_attributes.items()
+            if k in self.allowed_fields
+        }
+        ret.update(
+            self.allowed_requested_relationships_local_columns
+        )
+        return ret
+
+    @functools.lru_cache(maxsize=128)
+    def requested_include_names(self):
+        '''Parse any 'include' param in http request.
+
+        Returns:
+            set: names of all requested includes.
+
+        Default:
+            set: names of all direct relationships of self.model.
+        '''
+        inc = set()
+        param = self.request.params.get('include')
+
+        if param is None:
+            return inc
+
+        for i in param.split(','):
+            curname = []
+            for name in i.split('.'):
+                curname.append(name)
+                inc.add('.'.join(curname))
+        return inc
+
+    @property
+    def bad_include_paths(self):
+        '''Return a set of invalid 'include' parameters.
+
+        **Query Parameters**
+
+            **include:** comma separated list of related resources to include
+            in the include section.
+
+        Returns:
+            set: set of requested include paths with no corresponding
+            attribute.
+        '''
+        param = self.request.params.get('include')
+        bad = set()
+        if param is None:
+            return bad
+        for i in param.split(','):
+            curname = []
+            curview = self
+            tainted = False
+            for name in i.split('.'):
+                curname.append(name)
+                if tainted:
+                    bad.add('.'.join(curname))
+                else:
+                    if name in curview.relationships.keys():
+                        curview = curview.view_instance(
+                            curview.relationships[name].mapper.class_
+                        )
+                    else:
+                        tainted = True
+                        bad.add('.'.join(curname))
+        return bad
+
+    @functools.lru_cache(maxsize=128)
+    def view_instance(self, model):
+        '''(memoised) get an instance of view class for model.
+
+        Args:
+            model (DeclarativeMeta): model class.
+
+        Returns:
+            class: subclass of CollectionViewBase providing view for ``model``.
+        '''
+        return view_classes[model](self.request)
+
+    @classmethod
+    def append_callback_set(cls, set_name):
+        '''Append a named set of callbacks from ``callback_sets``.
+
+        Args:
+            set_name (str): key in ``callback_sets``.
+        '''
+        for cb_name, callback in callback_sets[set_name].items():
+            cls.callbacks[cb_name].append(callback)
+
+
+def acso_after_serialise_object(view, obj):
+    '''Standard callback altering object to take account of permissions.
+
+    Args:
+        obj (dict): the object immediately after serialisation.
+
+    Returns:
+        dict: the object, possibly with some fields removed, or meta
+        information indicating permission was denied to the whole object.
+    '''
+    if view.allowed_object(obj):
+        # Remove any forbidden fields that have been added by other
+        # callbacks. Those from the model won't have been added in the first
+        # place.
+
+        # Keep track so we can tell the caller which ones were forbidden.
+        forbidden = set()
+        if 'attributes' in obj:
+            atts = {}
+            for name, val in obj['attributes'].items():
+                if name in view.allowed_fields:
+                    atts[name] = val
+                else:
+                    forbidden.add(name)
+            obj['attributes'] = atts
+        if 'relationships' in obj:
+            rels = {}
+            for name, val in obj['relationships'].items():
+                if name in view.allowed_fields:
+                    rels[name] = val
+                else:
+                    forbidden.add(name)
+            obj['relationships'] = rels
+        # Now add all the forbidden fields from the model to the forbidden
+        # list. They don't need to be removed from the serialised object
+        # because they should not have been added in the first place.
+        for field in view.requested_field_names:
+            if field not in view.allowed_fields:
+                forbidden.add(field)
+        if 'meta' not in obj:
+            obj['meta'] = {}
+        obj['meta']['forbidden_fields'] = list(forbidden)
+        return obj
+    else:
+        return {
+            'type': obj['type'],
+            'id': obj['id'],
+            'meta': {
+                'errors': [
+                    {
+                        'code': 403,
+                        'title': 'Forbidden',
+                        'detail': 'No permission to view {}/{}.'.format(
+                            obj['type'], obj['id']
+                        )
+                    }
+                ]
+            }
+        }
+
+
+def acso_after_get(view, ret):
+    '''Standard callback throwing 403 (Forbidden) based on information in meta.
+
+    Args:
+        ret (dict): dict which would have been returned from get().
+
+    Returns:
+        dict: the same object if an error has not been raised.
+
+    Raises:
+        HTTPForbidden
+    '''
+    obj = ret['data']
+    errors = []
+    try:
+        errors = obj['meta']['errors']
+    except KeyError:
+        return ret
+    for error in errors:
+        if error['code'] == 403:
+            raise HTTPForbidden(error['detail'])
+    return ret
+
+
+callback_sets = {
+    'access_control_serialised_objects': {
+        'after_serialise_object': acso_after_serialise_object,
+        'after_get': acso_after_get
+    }
+}
+
+
+def append_callback_set_to_all_views(set_name):
+    '''Append a named set of callbacks to all view classes.
+
+    Args:
+        set_name (str): key in ``callback_sets``.
+    '''
+    for view_class in view_classes.values():
+        view_class.append_callback_set(set_name)
+
+
+def flushed_changes(session):
+    '''Collection items written by a flush (call from ``after_flush``).
+
+    Returns:
+        list: dicts with keys ``collection``, ``item_id`` and ``op``
+        (``create``, ``update`` or ``delete``).
+    '''
+    changes = []
+    for objs, op in (
+        (session.new, 'create'),
+        (session.dirty, 'update'),
+        (session.deleted, 'delete'),
+    ):
+        for obj in objs:
+            view = view_classes.get(type(obj))
+            if view is None:
+                continue
+            if op == 'update' and not session.is_modified(obj):
+                continue
+            changes.append({
+                'collection': view.collection_name,
+                'item_id': str(obj._jsonapi_id),
+                'op': op,
+            })
+    return changes
+
+
+def record_changes(session, changes, tables=()):
+    '''Record changes made without the ORM.
+
+    The session's flush events never see such changes, so this tells the
+    change log, subscriptions and the count cache about them. It also marks
+    the session as changed for zope.sqlalchemy, which would otherwise roll
+    the transaction back as read only.
+
+    Args:
+        session: session whose transaction made the changes.
+        changes (list): dicts with keys ``collection``, ``item_id`` and
+            ``op`` (``create``, ``update`` or ``delete``).
+        tables (iterable): names of any other tables written (the tables of
+            the changed collections are included anyway).
+    '''
+    if isinstance(session, sqlalchemy.orm.scoped_session):
+        session = session()
+    if mark_changed is not None:
+        mark_changed(session)
+    if count_cache.installed:
+        tables = set(tables)
+        collections = {change['collection'] for change in changes}
+        for view in view_classes.values():
+            if view.collection_name in collections:
+                tables.update(
+                    table.name
+                    for table in sqlalchemy.inspect(view.model).tables
+                )
+        count_cache.written(session.connection(), tables)
+    if change_log.installed:
+        change_log.record(session.connection(), changes)
+    if subscriptions.installed:
+        subscriptions.record(session, changes)
+
+
+class ChangeLog:
+    '''Change log table recording writes to collections.
+
+    Every flush adds a row for each created, updated or deleted item of a
+    collection, and the ``@changes`` feeds read them back in order.
+
+    On PostgreSQL each row also records the writing transaction's id. Rows
+    are read in (transaction id, row id) order and only for transactions
+    older than every transaction still running, so a transaction which
+    commits late can't slip in behind a token which has already been handed
+    out. Other databases order by row id alone.
+
+    Attributes:
+        table (sqlalchemy.Table): the ``jsonapi_changes`` table.
+    '''
+    def __init__(self):
+        self.metadata = sqlalchemy.MetaData()
+        self.table = sqlalchemy.Table(
+            'jsonapi_changes', self.metadata,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('txid', sqlalchemy.BigInteger),
+            sqlalchemy.Column(
+                'collection', sqlalchemy.String(255), nullable=False
+            ),
+            sqlalchemy.Column(
+                'item_id', sqlalchemy.String(255), nullable=False
+            ),
+            sqlalchemy.Column('op', sqlalchemy.String(10), nullable=False),
+            sqlalchemy.Index(
+                'jsonapi_changes_collection_idx', 'collection', 'txid', 'id'
+            ),
+        )
+        self.installed = False
+
+    def create(self, bind):
+        '''Create the change log table if it doesn't exist.'''
+        self.table.create(bind, checkfirst=True)
+
+    def install(self):
+        '''Record changes on every session flush (once only).'''
+        if self.installed:
+            return
+        sqlalchemy.event.listen(
+            sqlalchemy.orm.Session, 'after_flush', self.after_flush
+        )
+        self.installed = True
+
+    def after_flush(self, session, flush_context):
+        '''Record the collection items written by a flush.'''
+        self.record(session.connection(), flushed_changes(session))
+
+    def record(self, conn, rows):
+        '''Add change rows.
+
+        Write handlers which bypass the session should call this themselves.
+
+        Args:
+            conn: sqlalchemy connection in the writing transaction.
+            rows (list): dicts with keys ``collection``, ``item_id`` and
+                ``op`` (``create``, ``update`` or ``delete``).
+        '''
+        if not rows:
+            return
+        stmt = self.table.insert()
+        if conn.dialect.name == 'postgresql':
+            stmt = stmt.values(txid=sqlalchemy.func.txid_current())
+        conn.execute(stmt, rows)
+
+    def visible(self, conn):
+        '''Clause selecting rows from finished transactions only.'''
+        if conn.dialect.name != 'postgresql':
+            return sqlalchemy.true()
+        return self.table.c.txid < sqlalchemy.func.txid_snapshot_xmin(
+            sqlalchemy.func.txid_current_snapshot()
+        )
+
+    def changes(self, conn, collection, since, limit):
+        '''Changes to collection after token since.
+
+        Args:
+            conn: sqlalchemy connection.
+            collection (str): collection name.
+            since (tuple): parsed token.
+            limit (int): maximum number of rows.
+
+        Returns:
+            list: change rows in order.
+        '''
+        t = self.table
+        txid = sqlalchemy.func.coalesce(t.c.txid, 0)
+        return conn.execute(
+            sqlalchemy.select([t]).where(
+                t.c.collection == collection
+            ).where(
+                self.visible(conn)
+            ).where(
+                sqlalchemy.or_(
+                    txid > since[0],
+                    sqlalchemy.and_(txid == since[0], t.c.id > since[1])
+                )
+            ).order_by(txid, t.c.id).limit(limit)
+        ).fetchall()
+
+    def current_token(self, conn, collection):
+        '''Token for the latest change to collection.'''
+        t = self.table
+        row = conn.execute(
+            sqlalchemy.select([t]).where(
+                t.c.collection == collection
+            ).where(
+                self.visible(conn)
+            ).order_by(
+                sqlalchemy.func.coalesce(t.c.txid, 0).desc(), t.c.id.desc()
+            ).limit(1)
+        ).first()
+        if row is None:
+            return '0.0'
+        return self.make_token(row)
+
+    @staticmethod
+    def make_token(row):
+        '''Token for the position of a change row.'''
+        return '{}.{}'.format(row['txid'] or 0, row['id'])
+
+    @staticmethod
+    def parse_token(token):
+        '''Parse a token into a (txid, id) tuple.
+
+        Raises:
+            ValueError: if the token is bad.
+        '''
+        txid, row_id = token.split('.')
+        return (int(txid), int(row_id))
+
+
+change_log = ChangeLog()
+
+
+class Subscription:
+    '''A subscriber's queue of change batches from a broker.
+
+    Attributes:
+        overflowed (bool): changes were dropped because the subscriber fell
+            too far behind.
+    '''
+    def __init__(self, broker, collection, size=1000):
+        self.broker = broker
+        self.collection = collection
+        self.queue = queue.Queue(size)
+        self.overflowed = False
+
+    def put(self, changes):
+        '''Queue a batch of changes, or drop it if the queue is full.'''
+        try:
+            self.queue.put_nowait(changes)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        '''Next batch of changes, or None after timeout seconds.'''
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        '''Stop receiving changes.'''
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    '''Deliver committed changes to subscribers in this process.
+
+    Brokers provide ``publish(collection, changes)``, called after each
+    commit, and ``subscribe(collection)`` returning a :py:class:`Subscription`.
+    Subclasses deliver across processes by overriding :py:func:`publish` to
+    send changes elsewhere and calling :py:func:`deliver` as they arrive.
+    '''
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, collection):
+        '''Subscribe to changes to collection.'''
+        subscription = Subscription(self, collection)
+        with self.lock:
+            self.subscriptions.setdefault(collection, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        '''Remove subscription.'''
+        with self.lock:
+            self.subscriptions.get(subscription.collection, set()).discard(
+                subscription
+            )
+
+    def publish(self, collection, changes):
+        '''Publish a batch of committed changes to collection.'''
+        self.deliver(collection, changes)
+
+    def deliver(self, collection, changes):
+        '''Hand a batch of changes to local subscribers.'''
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(collection, ()))
+        for subscription in subscriptions:
+            subscription.put(changes)
+
+
+class PostgresBroker(LocalBroker):
+    '''Deliver changes to subscribers in all processes with LISTEN/NOTIFY.
+
+    Changes are sent with ``pg_notify()`` and a background thread in each
+    process listens for them on its own connection.
+
+    Args:
+        url (str): sqlalchemy URL of the PostgreSQL database.
+        channel (str): notification channel.
+    '''
+    # Stay well inside the 8000 byte notification payload limit.
+    batch_size = 50
+
+    def __init__(self, url, channel='jsonapi_changes'):
+        super().__init__()
+        self.connect_args = sqlalchemy.engine.url.make_url(
+            url
+        ).translate_connect_args(username='user', database='dbname')
+        self.channel = channel
+        self.notify_conn = None
+        self.listener = None
+        # Set while the listener is connected.
+        self.listening = threading.Event()
+
+    def connect(self):
+        conn = psycopg2.connect(**self.connect_args)
+        conn.set_session(autocommit=True)
+        return conn
+
+    def subscribe(self, collection):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(
+                    target=self.listen, name='jsonapi-listen', daemon=True
+                )
+                self.listener.start()
+        return super().subscribe(collection)
+
+    def publish(self, collection, changes):
+        with self.lock:
+            if self.notify_conn is None or self.notify_conn.closed:
+                self.notify_conn = self.connect()
+            try:
+                with self.notify_conn.cursor() as cursor:
+                    for i in range(0, len(changes), self.batch_size):
+                        cursor.execute('SELECT pg_notify(%s, %s)', (
+                            self.channel,
+                            json.dumps({
+                                'collection': collection,
+                                'changes': changes[i:i + self.batch_size],
+                            })
+                        ))
+            except psycopg2.Error:
+                # Connect afresh next time.
+                self.notify_conn.close()
+                self.notify_conn = None
+                raise
+
+    def listen(self):
+        '''Receive notifications until the process exits.'''
+        while True:
+            try:
+                conn = self.connect()
+                with conn.cursor() as cursor:
+                    cursor.execute('LISTEN {}'.format(self.channel))
+                self.listening.set()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        message = json.loads(conn.notifies.pop(0).payload)
+                        self.deliver(
+                            message['collection'], message['changes']
+                        )
+            except psycopg2.Error:
+                # Reconnect after a pause.
+                self.listening.clear()
+                time.sleep(5)
+
+
+class Subscriptions:
+    '''Publish changes to a broker when the transactions writing them commit.
+
+    Changes are noted against the innermost savepoint (or the transaction)
+    they were made in, so rolling back a savepoint forgets them. They are
+    published when the outermost transaction commits. The transaction has
+    committed by then, so a broker failure is logged rather than raised.
+
+    Attributes:
+        broker: broker (default :py:class:`LocalBroker`).
+        heartbeat (float): seconds between keepalive comments on idle
+            subscription streams.
+    '''
+    def __init__(self):
+        self.broker = LocalBroker()
+        self.heartbeat = 15
+        self.installed = False
+
+    def install(self):
+        '''Listen for changes on all sessions (once only).'''
+        if self.installed:
+            return
+        session = sqlalchemy.orm.Session
+        sqlalchemy.event.listen(session, 'after_flush', self.after_flush)
+        sqlalchemy.event.listen(session, 'after_commit', self.after_commit)
+        sqlalchemy.event.listen(
+            session, 'after_soft_rollback', self.after_soft_rollback
+        )
+        sqlalchemy.event.listen(
+            session, 'after_transaction_end', self.after_transaction_end
+        )
+        self.installed = True
+
+    @staticmethod
+    def boundary(session_transaction):
+        '''The savepoint or outermost transaction session_transaction is in.
+
+        Plain subtransactions (such as the one a flush runs in) commit and
+        roll back with their parents.
+        '''
+        while session_transaction is not None and\
+                not session_transaction.nested and\
+                session_transaction.parent is not None:
+            session_transaction = session_transaction.parent
+        return session_transaction
+
+    def record(self, session, changes):
+        '''Note changes made in session's current transaction.'''
+        boundary = self.boundary(session.transaction)
+        session.info.setdefault('jsonapi_changes', []).extend(
+            (boundary, change) for change in changes
+        )
+
+    def after_flush(self, session, flush_context):
+        self.record(session, flushed_changes(session))
+
+    def after_commit(self, session):
+        if session.transaction is not None and\
+                session.transaction.parent is not None:
+            # A savepoint released: wait for the real commit.
+            return
+        by_collection = OrderedDict()
+        for boundary, change in session.info.pop('jsonapi_changes', ()):
+            by_collection.setdefault(change['collection'], []).append({
+                'op': change['op'],
+                'id': change['item_id'],
+            })
+        for collection, changes in by_collection.items():
+            try:
+                self.broker.publish(collection, changes)
+            except Exception:
+                log.exception(
+                    'Could not publish changes to %s', collection
+                )
+
+    def after_soft_rollback(self, session, previous_transaction):
+        # Forget changes made inside a savepoint which has been rolled back.
+        rolled_back = self.boundary(previous_transaction)
+        if rolled_back is None or rolled_back.parent is None:
+            return
+
+        def inside(boundary):
+            while boundary is not None:
+                if boundary is rolled_back:
+                    return True
+                boundary = boundary.parent
+            return False
+
+        changes = session.info.get('jsonapi_changes')
+        if changes:
+            session.info['jsonapi_changes'] = [
+                (boundary, change) for boundary, change in changes
+                if not inside(boundary)
+            ]
+
+    def after_transaction_end(self, session, session_transaction):
+        # Anything not published by after_commit was rolled back (or the
+        # session was closed without committing).
+        if session_transaction.parent is None:
+            session.info.pop('jsonapi_changes', None)
+
+
+subscriptions = Subscriptions()
+
+
+def create_change_log(bind):
+    '''Create the change log table used by the @changes feeds.
+
+    Safe to run more than once.
+
+    Arguments:
+        bind: sqlalchemy engine or connection.
+    '''
+    change_log.create(bind)
+
+
+def create_search_indexes(bind):
+    '''Create the indexes needed by search filters for all collections.
+
+    Safe to run more than once.
+
+    Arguments:
+        bind: sqlalchemy engine or connection.
+    '''
+    for view in set(view_classes.values()):
+        for statement in view.search_index_ddl(bind.dialect.name):
+            bind.execute(statement)
+
+
+class ExportStream:
+    '''Response body for an export: encoded lines from its own connection.
+
+    The WSGI server calls :py:func:`close` whenever it is done with the body:
+    after the last line, if the client disconnects, or without reading
+    anything at all (a HEAD request, or a failure further up the stack). That
+    ends the export's transaction and returns its connection to the pool.
+    '''
+    def __init__(self, lines, session, conn):
+        self.lines = lines
+        self.session = session
+        self.conn = conn
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.lines).encode('utf-8')
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        '''Close the export session and connection (more than once is ok).'''
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        try:
+            self.lines.close()
+            self.session.close()
+        finally:
+            conn.close()
+
+
+class StatementCache:
+    '''LRU cache of baked queries keyed on request query shape.
 
-        for callback in self.callbacks['after_serialise_object']:
-            ret = callback(self, ret)
+    Each entry holds a ``sqlalchemy.ext.baked.BakedQuery``, so the SQL for a
+    given shape is compiled once and later requests only bind parameters.
 
-        return ret
+    Arguments:
+        size (int): maximum number of query shapes to keep.
 
-    @classmethod
-    @functools.lru_cache(maxsize=128)
-    def collection_query_info(cls, request):
-        '''Return dictionary of information used during DB query.
+    Attributes:
+        hits (int): number of lookups which found a cached shape.
+        misses (int): number of lookups which had to build a new shape.
+    '''
+    def __init__(self, size=100):
+        self.size = size
+        # The bakery holds compiled SQL for the page and count variants of
+        # each shape.
+        self.bakery = baked.bakery(size=size * 3)
+        self.shapes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, shape, build):
+        '''Return the baked query for ``shape``, building it if necessary.
 
         Args:
-            request (pyramid.request): request object.
+            shape (tuple): hashable description of the query.
+            build (callable): called with a session to build the query if it
+                has not been compiled yet.
 
         Returns:
-            dict: query info in the form::
-
-                {
-                    'page[limit]': maximum items per page,
-                    'page[offset]': offset for current page (in items),
-                    'sort': sort param from request,
-                    '_sort': [
-                        {
-                            'key': sort key ('field' or 'relationship.field'),
-                            'ascending': sort ascending or descending (bool)
-                        },
-                        ...
-                    },
-                    '_filters': {
-                        filter_param_name: {
-                            'colspec': list of columns split on '.',
-                            'op': filter operator,
-                            'value': value of filter param,
-                        }
-                    },
-                    '_page': {
-                        paging_param_name: value,
-                        ...
-                    }
-                }
+            sqlalchemy.ext.baked.BakedQuery: baked query for ``shape``.
+        '''
+        with self.lock:
+            try:
+                bq = self.shapes.pop(shape)
+                self.hits += 1
+            except KeyError:
+                bq = self.bakery(lambda session: build(session), shape)
+                self.misses += 1
+            self.shapes[shape] = bq
+            while len(self.shapes) > self.size:
+                self.shapes.popitem(last=False)
+        return bq
+
+    def info(self):
+        '''Cache statistics.
 
-            Keys beginning with '_' are derived.
+        Returns:
+            dict: hits, misses, current number of shapes and maximum size.
         '''
-        info = {}
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'shapes': len(self.shapes),
+            'size': self.size,
+        }
 
-        # Paging by limit and offset.
-        # Use params 'page[limit]' and 'page[offset]' to comply with spec.
-        info['page[limit]'] = min(
-            cls.max_limit,
-            int(request.params.get('page[limit]', cls.default_limit))
+    def clear(self):
+        '''Remove all cached shapes and reset the counters.'''
+        with self.lock:
+            self.shapes.clear()
+            self.bakery.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class PreparedStatements:
+    '''Server side prepared statements for tagged queries on PostgreSQL.
+
+    Queries executed with the execution option ``jsonapi_prepare=True`` are
+    counted by SQL text. Once a statement has been seen ``threshold`` times it
+    is PREPAREd on the connection in use and subsequently run with EXECUTE, so
+    PostgreSQL can skip parsing and planning. Prepared statements are tracked
+    in ``Connection.info``, which lives exactly as long as the DBAPI
+    connection: a recycled or invalidated connection starts afresh. At most
+    ``size`` statements are kept per connection (least recently used are
+    DEALLOCATEd).
+
+    The PREPARE and EXECUTE are sent together, after a ``SAVEPOINT`` (which
+    is released with the next one) unless the connection is in autocommit
+    mode. If the server reports that the prepared statements aren't what we
+    think (they were dropped by ``DISCARD ALL``, a schema change means a
+    cached plan can't be used, or another statement already has the name, as
+    can happen behind a pooler), the connection is rolled back to the
+    savepoint, its prepared statements are DEALLOCATEd and forgotten, and the
+    original statement is run as it is. Only if that fails too does the error
+    reach the caller.
+
+    Only connections using the psycopg2 (``pyformat``) dialect are
+    affected; other statements pass through untouched.
+
+    Attributes:
+        threshold (int): executions of a statement before it is prepared.
+        size (int): maximum prepared statements per connection.
+        prepared (int): number of PREPAREs issued.
+        executed (int): number of statements executed by name.
+        invalidated (int): number of times a connection's statements had to
+            be forgotten (and the statement run unprepared instead).
+    '''
+    savepoint = 'jsonapi_prepared'
+    placeholder_re = re.compile(r'%\((\w+)\)s')
+
+    def __init__(self, threshold=2, size=50):
+        self.threshold = threshold
+        self.size = size
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.installed = False
+        self.prepared = 0
+        self.executed = 0
+        self.invalidated = 0
+
+    def install(self):
+        '''Listen for statement execution on all engines (once only).'''
+        if self.installed:
+            return
+        engine = sqlalchemy.engine.Engine
+        sqlalchemy.event.listen(
+            engine, 'before_cursor_execute', self.before_cursor_execute,
+            retval=True
         )
-        info['page[offset]'] = int(request.params.get('page[offset]', 0))
+        sqlalchemy.event.listen(engine, 'do_execute', self.do_execute)
+        # Transaction ends and other savepoints take ours with them.
+        for event in (
+            'commit', 'rollback', 'rollback_savepoint', 'release_savepoint'
+        ):
+            sqlalchemy.event.listen(engine, event, self.savepoint_gone)
+        sqlalchemy.event.listen(
+            sqlalchemy.pool.Pool, 'checkin', self.checkin
+        )
+        self.installed = True
 
-        # Sorting.
-        # Use param 'sort' as per spec.
-        # Split on '.' to allow sorting on columns of relationship tables:
-        #   sort=name -> sort on the 'name' column.
-        #   sort=owner.name -> sort on the 'name' column of the target table
-        #     of the relationship 'owner'.
-        # The default sort column is 'id'.
-        sort_param = request.params.get('sort', cls.key_column.name)
-        info['sort'] = sort_param
+    def info(self):
+        '''Statistics.
 
-        # Break sort param down into components and store in _sort.
-        info['_sort'] = []
-        for sort_key in sort_param.split(','):
-            key_info = {}
-            # Check to see if it starts with '-', which indicates a reverse
-            # sort.
-            ascending = True
-            if sort_key.startswith('-'):
-                ascending = False
-                sort_key = sort_key[1:]
-            key_info['key'] = sort_key
-            key_info['ascending'] = ascending
-            info['_sort'].append(key_info)
+        Returns:
+            dict: prepared, executed and invalidated counters.
+        '''
+        return {
+            'prepared': self.prepared,
+            'executed': self.executed,
+            'invalidated': self.invalidated,
+        }
 
-        # Find all parametrised parameters ( :) )
-        info['_filters'] = {}
-        info['_page'] = {}
-        for p in request.params.keys():
-            match = re.match(r'(.*?)\[(.*?)\]', p)
-            if not match:
-                continue
-            val = request.params.get(p)
+    @staticmethod
+    def stale(error):
+        '''Whether a DBAPI error means our prepared statements are wrong.
 
-            # Filtering.
-            # Use 'filter[<condition>]' param.
-            # Format:
-            #   filter[<column_spec>:<operator>] = <value>
-            #   where:
-            #     <column_spec> is either:
-            #       <column_name> for an attribute, or
-            #       <relationship_name>.<column_name> for a relationship.
-            # Examples:
-            #   filter[name:eq]=Fred
-            #      would find all objects with a 'name' attribute of 'Fred'
-            #   filter[author.name:eq]=Fred
-            #      would find all objects where the relationship author pointed
-            #      to an object with 'name' 'Fred'
-            #
-            # Find all the filters.
-            if match.group(1) == 'filter':
-                colspec, op = match.group(2).split(':')
-                colspec = colspec.split('.')
-                info['_filters'][p] = {
-                    'colspec': colspec,
-                    'op': op,
-                    'value': val
-                }
+        That is: invalid_sql_statement_name (26000, e.g. after DISCARD ALL),
+        duplicate_prepared_statement (42P05) or the feature_not_supported
+        (0A000) raised when a schema change alters a cached plan's result
+        type.
+        '''
+        pgcode = getattr(error, 'pgcode', None)
+        if pgcode in ('26000', '42P05'):
+            return True
+        return pgcode == '0A000' and\
+            'cached plan must not change result type' in str(error)
 
-            # Paging.
-            elif match.group(1) == 'page':
-                info['_page'][match.group(2)] = val
+    def before_cursor_execute(
+            self, conn, cursor, statement, parameters, context, executemany
+            ):
+        '''Rewrite hot tagged statements to EXECUTE a prepared statement.
 
-        return info
+        The statements needed first (PREPARE, DEALLOCATE) are left on the
+        execution context for :py:func:`do_execute`.
+        '''
+        if executemany or context is None or context.compiled is None or\
+                not context.execution_options.get('jsonapi_prepare'):
+            return statement, parameters
+        if conn.dialect.name != 'postgresql' or\
+                conn.dialect.paramstyle != 'pyformat' or\
+                not isinstance(parameters, dict):
+            return statement, parameters
+
+        with self.lock:
+            if len(self.counts) > self.size * 20:
+                # Stop the counts growing without bound if there are many
+                # rarely used shapes.
+                self.counts.clear()
+            count = self.counts.get(statement, 0) + 1
+            self.counts[statement] = count
+        if count < self.threshold:
+            return statement, parameters
+
+        stmts = conn.info.setdefault('jsonapi_prepared', OrderedDict())
+        setup = []
+        try:
+            name, param_names = stmts.pop(statement)
+        except KeyError:
+            conn.info['jsonapi_prepared_seq'] =\
+                conn.info.get('jsonapi_prepared_seq', 0) + 1
+            name = 'jsonapi_{}'.format(conn.info['jsonapi_prepared_seq'])
+            param_names = []
+            for param_name in self.placeholder_re.findall(statement):
+                if param_name not in param_names:
+                    param_names.append(param_name)
+            # Sent with the parameters, so %% still means %.
+            setup.append('PREPARE {} AS {}'.format(
+                name,
+                self.placeholder_re.sub(
+                    lambda m: '${}'.format(param_names.index(m.group(1)) + 1),
+                    statement
+                )
+            ))
+            self.prepared += 1
+            while len(stmts) >= self.size:
+                old_name, _ = stmts.popitem(last=False)[1]
+                setup.insert(0, 'DEALLOCATE {}'.format(old_name))
+        stmts[statement] = (name, param_names)
+        self.executed += 1
+        context.jsonapi_unprepared = (statement, setup)
+        if param_names:
+            statement = 'EXECUTE {}({})'.format(
+                name,
+                ', '.join('%({})s'.format(p) for p in param_names)
+            )
+        else:
+            statement = 'EXECUTE {}'.format(name)
+        return statement, parameters
 
-    def pagination_links(self, count=0):
-        '''Return a dictionary of pagination links.
+    def do_execute(self, cursor, statement, parameters, context):
+        '''Run a rewritten statement, falling back to the original.'''
+        try:
+            original, setup = context.jsonapi_unprepared
+        except AttributeError:
+            return None
+        info = context.root_connection.info
+        guard = not cursor.connection.autocommit
+        sql = setup + [statement]
+        if guard:
+            sql.insert(0, 'SAVEPOINT {}'.format(self.savepoint))
+            if info.get('jsonapi_savepoint'):
+                sql.insert(0, 'RELEASE SAVEPOINT {}'.format(self.savepoint))
+            info['jsonapi_savepoint'] = False
+        try:
+            cursor.execute('; '.join(sql), parameters)
+            info['jsonapi_savepoint'] = guard
+            return True
+        except psycopg2.Error as e:
+            if not self.stale(e):
+                raise
+        if guard:
+            cursor.execute('ROLLBACK TO SAVEPOINT {}'.format(self.savepoint))
+            info['jsonapi_savepoint'] = True
+        cursor.execute('DEALLOCATE ALL')
+        info.pop('jsonapi_prepared', None)
+        self.invalidated += 1
+        cursor.execute(original, parameters)
+        return True
 
-        Args:
-            count (int): total number of results available.
+    def savepoint_gone(self, conn, *args):
+        '''Our savepoint is gone (or may be): don't release it later.'''
+        if not conn.closed:
+            conn.info.pop('jsonapi_savepoint', None)
 
-        Returns:
-            dict: dictionary of named links.
-        '''
-        links = {}
-        req = self.request
-        route_name = req.matched_route.name
-        qinfo = self.collection_query_info(req)
-        _query = {'page[{}]'.format(k): v for k, v in qinfo['_page'].items()}
-        _query['sort'] = qinfo['sort']
-        for f in sorted(qinfo['_filters']):
-            _query[f] = qinfo['_filters'][f]['value']
+    def checkin(self, dbapi_conn, record):
+        '''The pool has reset the connection: forget our savepoint.'''
+        if record is not None:
+            record.info.pop('jsonapi_savepoint', None)
 
-        # First link.
-        _query['page[offset]'] = 0
-        links['first'] = req.route_url(
-            route_name, _query=_query, **req.matchdict
-        )
 
-        # Next link.
-        next_offset = qinfo['page[offset]'] + qinfo['page[limit]']
-        if count is None or next_offset < count:
-            _query['page[offset]'] = next_offset
-            links['next'] = req.route_url(
-                route_name, _query=_query, **req.matchdict
-            )
+prepared_statements = PreparedStatements()
 
-        # Previous link.
-        if qinfo['page[offset]'] > 0:
-            prev_offset = qinfo['page[offset]'] - qinfo['page[limit]']
-            if prev_offset < 0:
-                prev_offset = 0
-            _query['page[offset]'] = prev_offset
-            links['prev'] = req.route_url(
-                route_name, _query=_query, **req.matchdict
-            )
 
-        # Last link.
-        if count is not None:
-            _query['page[offset]'] = (
-                max((count - 1), 0) //
-                qinfo['page[limit]']
-            ) * qinfo['page[limit]']
-            links['last'] = req.route_url(
-                route_name, _query=_query, **req.matchdict
-            )
-        return links
+class CountCache:
+    '''Cache of result totals with a TTL, invalidated by writes.
 
-    @property
-    def allowed_fields(self):
-        '''Set of fields to which current action is allowed.
+    Entries are invalidated when a write touches one of the tables the count
+    depends on:
 
-        Returns:
-            set: set of allowed field names.
-        '''
-        return set(self.fields)
+    * immediately, from the session ``after_flush`` (and bulk update/delete)
+      events, so the writing session sees fresh counts;
 
-    def allowed_object(self, obj):
-        '''Whether or not current action is allowed on object.
+    * again when the transaction commits or rolls back, from engine events
+      recording every INSERT, UPDATE and DELETE executed on a connection.
+      This catches core statements and closes the window in which another
+      request could cache a count from before the commit.
 
-        Returns:
-            bool:
-        '''
-        return True
+    Every invalidation also bumps a generation number for each table. A
+    count records the generations of its tables (:py:func:`generations`)
+    before it runs and is only stored if none of them have changed by the
+    time it finishes, so a count which raced a write is never cached.
 
-    @property
-    @functools.lru_cache(maxsize=128)
-    def requested_field_names(self):
-        '''Get the sparse field names from request.
+    Writes from other processes are only seen once entries expire after
+    ``ttl`` seconds.
 
-        **Query Parameters**
+    Attributes:
+        ttl (float): seconds an entry stays valid.
+        size (int): maximum number of entries.
+    '''
+    def __init__(self, ttl=60, size=1000):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = {}
+        self.lock = threading.Lock()
+        self.installed = False
+
+    def get(self, key):
+        '''Return the cached count for key, or None.'''
+        with self.lock:
+            try:
+                count, expires, tables = self.entries[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return count
+
+    def generations(self, tables):
+        '''Current invalidation generations of tables.
 
-            **fields[<collection>]:** comma separated list of fields
-            (attributes or relationships) to include in data.
+        Args:
+            tables (set): names of tables.
 
         Returns:
-            set: set of field names.
+            dict: generation number by table name.
         '''
-        param = self.request.params.get(
-            'fields[{}]'.format(self.collection_name)
-        )
-        if param is None:
-            return self.attributes.keys() | self.relationships.keys()
-        if param == '':
-            return set()
-        return set(param.split(','))
-
-    @property
-    def requested_attributes(self):
-        '''Return a dictionary of attributes.
+        with self.lock:
+            return {table: self.generation.get(table, 0) for table in tables}
 
-        **Query Parameters**
+    def set(self, key, count, tables, generations=None):
+        '''Cache count under key.
 
-            **fields[<collection>]:** comma separated list of fields
-            (attributes or relationships) to include in data.
+        Args:
+            key (tuple): cache key.
+            count (int): the count.
+            tables (set): names of tables the count depends on.
+            generations (dict): from :py:func:`generations`, taken before the
+                count started. If any of them have changed since, the count
+                may be out of date and is not stored.
 
         Returns:
-            dict: dict in the form:
+            bool: whether the count was stored.
+        '''
+        with self.lock:
+            if generations is not None and any(
+                self.generation.get(table, 0) != gen
+                for table, gen in generations.items()
+            ):
+                return False
+            self.entries[key] = (
+                count, time.monotonic() + self.ttl, frozenset(tables)
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            return True
 
-                .. parsed-literal::
+    def invalidate(self, tables):
+        '''Drop all entries which depend on any of tables (names).'''
+        tables = set(tables)
+        if not tables:
+            return
+        with self.lock:
+            for table in tables:
+                self.generation[table] = self.generation.get(table, 0) + 1
+            for key in [
+                key for key, (count, expires, deps) in self.entries.items()
+                if deps & tables
+            ]:
+                del self.entries[key]
+
+    def clear(self):
+        '''Drop all entries.'''
+        with self.lock:
+            self.entries.clear()
+
+    def install(self):
+        '''Listen for writes on all sessions and engines (once only).'''
+        if self.installed:
+            return
+        session = sqlalchemy.orm.Session
+        engine = sqlalchemy.engine.Engine
+        sqlalchemy.event.listen(session, 'after_flush', self.after_flush)
+        sqlalchemy.event.listen(
+            session, 'after_bulk_update', self.after_bulk
+        )
+        sqlalchemy.event.listen(
+            session, 'after_bulk_delete', self.after_bulk
+        )
+        sqlalchemy.event.listen(engine, 'after_execute', self.after_execute)
+        sqlalchemy.event.listen(engine, 'commit', self.end_transaction)
+        sqlalchemy.event.listen(engine, 'rollback', self.end_transaction)
+        self.installed = True
+
+    def after_flush(self, session, flush_context):
+        '''Invalidate counts for the tables of flushed objects.'''
+        tables = set()
+        for obj in set(session.new) | set(session.dirty) |\
+                set(session.deleted):
+            mapper = sqlalchemy.inspect(obj).mapper
+            tables.update(table.name for table in mapper.tables)
+            for rel in mapper.relationships:
+                if rel.secondary is not None:
+                    tables.add(rel.secondary.name)
+        self.invalidate(tables)
+
+    def after_bulk(self, context):
+        '''Invalidate counts for the table of a bulk update or delete.'''
+        self.invalidate({context.primary_table.name})
+
+    def written(self, conn, tables):
+        '''Invalidate counts for tables written on conn, now and at the end
+        of its transaction.
 
-                    {
-                        <colname>: <column_object>,
-                        ...
-                    }
+        Args:
+            conn: connection the writes were made on.
+            tables (set): names of the tables written.
         '''
-        return {
-            k: v for k, v in self.attributes.items()
-            if k in self.requested_field_names
-        }
+        self.invalidate(tables)
+        if conn.closed:
+            # Autocommit execution: already committed and closed.
+            return
+        conn.info.setdefault('jsonapi_written_tables', set()).update(tables)
 
-    @property
-    def requested_relationships(self):
-        '''Return a dictionary of relationships.
+    def after_execute(self, conn, clauseelement, multiparams, params, result):
+        '''Note the table written to by a DML statement.'''
+        if isinstance(clauseelement, sqlalchemy.sql.expression.UpdateBase):
+            self.written(conn, {clauseelement.table.name})
 
-        **Query Parameters**
+    def end_transaction(self, conn):
+        '''Invalidate counts for tables written in the transaction.'''
+        if conn.closed:
+            return
+        self.invalidate(conn.info.pop('jsonapi_written_tables', ()))
 
-            **fields[<collection>]:** comma separated list of fields
-            (attributes or relationships) to include in data.
 
-        Returns:
-            dict: dict in the form:
+count_cache = CountCache()
 
-                .. parsed-literal::
 
-                    {
-                        <relname>: <relationship_object>,
-                        ...
-                    }
-        '''
-        return {
-            k: v for k, v in self.relationships.items()
-            if k in self.requested_field_names
-        }
+class OperationsView:
+    '''Pyramid view class for the atomic operations endpoint.
 
-    @property
-    def requested_fields(self):
-        '''Union of attributes and relationships.
+    Available as ``/operations`` if ``pyramid_jsonapi.operations`` is
+    ``'true'``. A POST carries an ordered list of operations in the style of
+    the JSON:API atomic extension (https://jsonapi.org/ext/atomic), which are
+    run by the usual collection view handlers in one transaction: if any of
+    them fails, none of them take effect.
+
+    Attributes:
+        get_dbsession: callable returning the session used by the views.
+        max_operations (int): most operations accepted in one request.
+    '''
+    max_operations = 100
+
+    # View method and HTTP method for each op on a resource.
+    resource_methods = {
+        'add': ('collection_post', 'POST'),
+        'update': ('patch', 'PATCH'),
+        'remove': ('delete', 'DELETE'),
+    }
+    # View method and HTTP method for each op on a relationship.
+    relationship_methods = {
+        'add': ('relationships_post', 'POST'),
+        'update': ('relationships_patch', 'PATCH'),
+        'remove': ('relationships_delete', 'DELETE'),
+    }
 
-        **Query Parameters**
+    def __init__(self, request):
+        self.request = request
+        self.views = {
+            view.collection_name: view for view in view_classes.values()
+        }
+        # Ids of resources created so far, keyed by (type, lid).
+        self.lids = {}
 
-            **fields[<collection>]:** comma separated list of fields
-            (attributes or relationships) to include in data.
+    def post(self):
+        '''Handle POST requests: run a list of operations atomically.
 
-        Returns:
-            dict: dict in the form:
+        **Request Body**
 
-                .. parsed-literal::
+            .. parsed-literal::
 
-                    {
-                        <colname>: <column_object>,
-                        ...
-                        <relname>: <relationship_object>,
+                {
+                    "atomic:operations": [
+                        {
+                            "op": "add" | "update" | "remove",
+                            "ref": {
+                                "type": type,
+                                "id" or "lid": id,
+                                "relationship": name (optional)
+                            },
+                            "data": resource object(s) or identifier(s)
+                        },
                         ...
-                    }
-
-        '''
-        ret = self.requested_attributes
-        ret.update(
-            self.requested_relationships
-        )
-        return ret
+                    ]
+                }
 
-    @property
-    def allowed_requested_relationships_local_columns(self):
-        '''Finds all the local columns for allowed MANYTOONE relationships.
+            Resources created by earlier ``add`` operations may be referred
+            to by their ``lid`` instead of an ``id``. Consecutive ``add``
+            operations for the same collection are run as one bulk create if
+            the collection allows it (see
+            :py:func:`CollectionViewBase.collection_post_bulk`).
 
         Returns:
-            dict: local columns indexed by column name.
-        '''
-        return {
-            pair[0].name: pair[0]
-            for k, rel in self.requested_relationships.items()
-            for pair in rel.local_remote_pairs
-            if rel.direction is MANYTOONE and k in self.allowed_fields
-        }
+            dict: ``{"atomic:results": [ result, ... ]}`` with one result
+            (``{"data": ...}`` or ``{}``) per operation, or
+            ``{"errors": [ error objects ]}`` pointing at the operation which
+            failed.
 
-    @property
-    def allowed_requested_query_columns(self):
-        '''All columns required in query to fetch allowed requested fields from
-        db.
+        Raises:
+            HTTPBadRequest: if the body isn't a list of operations or has too
+            many of them.
 
-        Returns:
-            dict: Union of allowed requested_attributes and
-            allowed_requested_relationships_local_columns
-        '''
-        ret = {
-            k: v for k, v in self.requested_attributes.items()
-            if k in self.allowed_fields
-        }
-        ret.update(
-            self.allowed_requested_relationships_local_columns
-        )
-        return ret
+            HTTPUnsupportedMediaType: if the content type has parameters other
+            than the atomic extension.
 
-    @functools.lru_cache(maxsize=128)
-    def requested_include_names(self):
-        '''Parse any 'include' param in http request.
+        Example:
+            Create a post and a comment on it:
 
-        Returns:
-            set: names of all requested includes.
+            .. parsed-literal::
 
-        Default:
-            set: names of all direct relationships of self.model.
+                http POST http://localhost:6543/operations atomic:operations:='[
+                    {"op": "add", "data": {
+                        "type": "posts", "lid": "p",
+                        "attributes": {...}, "relationships": {...}
+                    }},
+                    {"op": "add", "data": {
+                        "type": "comments",
+                        "attributes": {"content": "first"},
+                        "relationships": {
+                            "post": {"data": {"type": "posts", "lid": "p"}}
+                        }
+                    }}
+                ]' Content-Type:application/vnd.api+json
         '''
-        inc = set()
-        param = self.request.params.get('include')
+        cth = self.request.headers.get('content-type', '').split(';')
+        for param in cth[1:]:
+            if param.strip().replace('"', '') !=\
+                    'ext=https://jsonapi.org/ext/atomic':
+                raise HTTPUnsupportedMediaType(
+                    'Only the atomic extension media type parameter is '
+                    'allowed.'
+                )
+        try:
+            operations = self.request.json_body['atomic:operations']
+        except (ValueError, KeyError, TypeError):
+            operations = None
+        if not isinstance(operations, list):
+            raise HTTPBadRequest(
+                'The body must have an "atomic:operations" array.'
+            )
+        if len(operations) > self.max_operations:
+            raise HTTPBadRequest(
+                'At most {} operations may be run at once.'.format(
+                    self.max_operations
+                )
+            )
+        self.request.response.content_type = 'application/vnd.api+json'
+
+        session = self.get_dbsession()
+        if isinstance(session, sqlalchemy.orm.scoped_session):
+            session = session()
+        savepoint = session.begin_nested()
+        results = []
+        for start, batch in self.batches(operations):
+            try:
+                results.extend(self.run_batch(start, batch))
+            except HTTPException as e:
+                savepoint.rollback()
+                errors = getattr(e, 'errors', None) or [{
+                    'code': str(e.code),
+                    'detail': e.detail,
+                    'title': e.title,
+                }]
+                for err in errors:
+                    err.setdefault('source', {}).setdefault(
+                        'pointer', '/atomic:operations/{}'.format(start)
+                    )
+                self.request.response.status_code = e.code
+                return {'errors': errors}
+        savepoint.commit()
+        return {'atomic:results': results}
 
-        if param is None:
-            return inc
+    def batches(self, operations):
+        '''Split operations into batches to be run together.
 
-        for i in param.split(','):
-            curname = []
-            for name in i.split('.'):
-                curname.append(name)
-                inc.add('.'.join(curname))
-        return inc
+        Consecutive ``add`` operations creating resources in the same
+        collection are batched for bulk create, up to the collection's
+        ``bulk_max_items``, unless one refers to another by its lid. Every
+        other operation is a batch of its own.
 
-    @property
-    def bad_include_paths(self):
-        '''Return a set of invalid 'include' parameters.
+        Parameters:
+            operations (list): operation objects.
 
-        **Query Parameters**
+        Yields:
+            tuple: index of the first operation and a list of operations.
+        '''
+        start, batch, batch_lids = 0, [], set()
+        for i, op in enumerate(operations):
+            view = self.bulk_view(op)
+            if batch and view is not None and\
+                    view is self.bulk_view(batch[0]) and\
+                    len(batch) < view.bulk_max_items and\
+                    not batch_lids & set(self.lid_refs(
+                        op['data'].get('relationships')
+                    )):
+                batch.append(op)
+            else:
+                if batch:
+                    yield start, batch
+                start, batch, batch_lids = i, [op], set()
+            if view is not None and 'lid' in op['data']:
+                batch_lids.add((op['data']['type'], op['data']['lid']))
+        if batch:
+            yield start, batch
 
-            **include:** comma separated list of related resources to include
-            in the include section.
+    def bulk_view(self, op):
+        '''The view class to bulk create with for an ``add`` operation.
 
         Returns:
-            set: set of requested include paths with no corresponding
-            attribute.
+            the view class, or None if op isn't an ``add`` operation for a
+            collection which allows bulk create.
         '''
-        param = self.request.params.get('include')
-        bad = set()
-        if param is None:
-            return bad
-        for i in param.split(','):
-            curname = []
-            curview = self
-            tainted = False
-            for name in i.split('.'):
-                curname.append(name)
-                if tainted:
-                    bad.add('.'.join(curname))
-                else:
-                    if name in curview.relationships.keys():
-                        curview = curview.view_instance(
-                            curview.relationships[name].mapper.class_
-                        )
-                    else:
-                        tainted = True
-                        bad.add('.'.join(curname))
-        return bad
-
-    @functools.lru_cache(maxsize=128)
-    def view_instance(self, model):
-        '''(memoised) get an instance of view class for model.
+        if not isinstance(op, dict) or op.get('op') != 'add' or\
+                (op.get('ref') or {}).get('relationship') or\
+                not isinstance(op.get('data'), dict):
+            return None
+        view = self.views.get(op['data'].get('type'))
+        if view is None or not view.bulk_max_items:
+            return None
+        return view
+
+    def run_batch(self, start, batch):
+        '''Run a batch of operations.
 
-        Args:
-            model (DeclarativeMeta): model class.
+        Parameters:
+            start (int): index of the first operation in the request.
+            batch (list): operations from :py:func:`batches`.
 
         Returns:
-            class: subclass of CollectionViewBase providing view for ``model``.
-        '''
-        return view_classes[model](self.request)
-
-    @classmethod
-    def append_callback_set(cls, set_name):
-        '''Append a named set of callbacks from ``callback_sets``.
+            list: a result object for each operation.
 
-        Args:
-            set_name (str): key in ``callback_sets``.
+        Raises:
+            HTTPException: if an operation failed. It may have an ``errors``
+            attribute with error objects pointing at the operations.
         '''
-        for cb_name, callback in callback_sets[set_name].items():
-            cls.callbacks[cb_name].append(callback)
-
-
-def acso_after_serialise_object(view, obj):
-    '''Standard callback altering object to take account of permissions.
+        if len(batch) == 1:
+            op = batch[0]
+            view, method, http_method, matchdict, body = self.resolve(op)
+            ret = self.call(view, method, http_method, matchdict, body, start)
+            result = {
+                key: ret[key] for key in ('data', 'meta') if ret.get(key)
+            }
+            if method == 'collection_post':
+                self.add_lid(op['data'], ret['data'])
+            return [result]
+        view = self.bulk_view(batch[0])
+        items = [self.resolve(op)[4]['data'] for op in batch]
+        ret = self.call(
+            view, 'collection_post', 'POST', {}, {'data': items}, start
+        )
+        for op, item in zip(batch, ret['data']):
+            self.add_lid(op['data'], item)
+        return [{'data': item} for item in ret['data']]
 
-    Args:
-        obj (dict): the object immediately after serialisation.
+    def resolve(self, op):
+        '''Work out which view method runs an operation, and how.
 
-    Returns:
-        dict: the object, possibly with some fields removed, or meta
-        information indicating permission was denied to the whole object.
-    '''
-    if view.allowed_object(obj):
-        # Remove any forbidden fields that have been added by other
-        # callbacks. Those from the model won't have been added in the first
-        # place.
+        Lids in the operation are replaced by the ids of the resources they
+        refer to.
 
-        # Keep track so we can tell the caller which ones were forbidden.
-        forbidden = set()
-        if 'attributes' in obj:
-            atts = {}
-            for name, val in obj['attributes'].items():
-                if name in view.allowed_fields:
-                    atts[name] = val
-                else:
-                    forbidden.add(name)
-            obj['attributes'] = atts
-        if 'relationships' in obj:
-            rels = {}
-            for name, val in obj['relationships'].items():
-                if name in view.allowed_fields:
-                    rels[name] = val
-                else:
-                    forbidden.add(name)
-            obj['relationships'] = rels
-        # Now add all the forbidden fields from the model to the forbidden
-        # list. They don't need to be removed from the serialised object
-        # because they should not have been added in the first place.
-        for field in view.requested_field_names:
-            if field not in view.allowed_fields:
-                forbidden.add(field)
-        if 'meta' not in obj:
-            obj['meta'] = {}
-        obj['meta']['forbidden_fields'] = list(forbidden)
-        return obj
-    else:
-        return {
-            'type': obj['type'],
-            'id': obj['id'],
-            'meta': {
-                'errors': [
-                    {
-                        'code': 403,
-                        'title': 'Forbidden',
-                        'detail': 'No permission to view {}/{}.'.format(
-                            obj['type'], obj['id']
-                        )
-                    }
-                ]
-            }
-        }
+        Parameters:
+            op (dict): operation object.
 
+        Returns:
+            tuple: view class, view method name, HTTP method, matchdict and
+            request body for the operation.
 
-def acso_after_get(view, ret):
-    '''Standard callback throwing 403 (Forbidden) based on information in meta.
+        Raises:
+            HTTPBadRequest: if the operation is malformed or refers to an
+            unknown lid.
 
-    Args:
-        ret (dict): dict which would have been returned from get().
+            HTTPNotFound: if the operation is for an unknown collection.
+        '''
+        if not isinstance(op, dict) or\
+                op.get('op') not in self.resource_methods:
+            raise HTTPBadRequest('op must be one of add, update, remove.')
+        ref = self.replace_lids(op.get('ref') or {})
+        data = op.get('data')
+        if isinstance(data, dict):
+            data = dict(data)
+            data.pop('lid', None)
+        data = self.replace_lids(data)
+        type_name = ref.get('type')
+        if type_name is None and isinstance(data, dict):
+            type_name = data.get('type')
+        try:
+            view = self.views[type_name]
+        except KeyError:
+            raise HTTPNotFound('Unknown type {}.'.format(type_name))
+        if ref.get('relationship'):
+            method, http_method = self.relationship_methods[op['op']]
+            matchdict = {
+                'id': str(ref.get('id')),
+                'relationship': ref['relationship'],
+            }
+            return view, method, http_method, matchdict, {'data': data}
+        method, http_method = self.resource_methods[op['op']]
+        if op['op'] == 'add':
+            return view, method, http_method, {}, {'data': data}
+        obj_id = ref.get('id')
+        if obj_id is None and isinstance(data, dict):
+            obj_id = data.get('id')
+        if obj_id is None:
+            raise HTTPBadRequest('No id for {} operation.'.format(op['op']))
+        matchdict = {'id': str(obj_id)}
+        if op['op'] == 'remove':
+            return view, method, http_method, matchdict, None
+        if isinstance(data, dict):
+            data.setdefault('id', str(obj_id))
+        return view, method, http_method, matchdict, {'data': data}
+
+    def replace_lids(self, value):
+        '''Replace lids in resource identifiers with ids.
 
-    Returns:
-        dict: the same object if an error has not been raised.
+        Parameters:
+            value: part of an operation. Attributes are left alone.
 
-    Raises:
-        HTTPForbidden
-    '''
-    obj = ret['data']
-    errors = []
-    try:
-        errors = obj['meta']['errors']
-    except KeyError:
-        return ret
-    for error in errors:
-        if error['code'] == 403:
-            raise HTTPForbidden(error['detail'])
-    return ret
+        Returns:
+            a copy of value with ``{"type": t, "lid": l}`` objects replaced by
+            ``{"type": t, "id": id}``.
 
+        Raises:
+            HTTPBadRequest: if a lid doesn't belong to an earlier ``add``.
+        '''
+        if isinstance(value, list):
+            return [self.replace_lids(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        value = {
+            key: item if key == 'attributes' else self.replace_lids(item)
+            for key, item in value.items()
+        }
+        if 'lid' in value and 'id' not in value:
+            lid = value.pop('lid')
+            try:
+                value['id'] = self.lids[(value.get('type'), lid)]
+            except KeyError:
+                raise HTTPBadRequest(
+                    'Unknown lid {} for type {}.'.format(
+                        lid, value.get('type')
+                    )
+                )
+        return value
 
-callback_sets = {
-    'access_control_serialised_objects': {
-        'after_serialise_object': acso_after_serialise_object,
-        'after_get': acso_after_get
-    }
-}
+    @classmethod
+    def lid_refs(cls, value):
+        '''Find the (type, lid) pairs referred to by value.'''
+        if isinstance(value, list):
+            for item in value:
+                yield from cls.lid_refs(item)
+        elif isinstance(value, dict):
+            if 'lid' in value and 'id' not in value:
+                yield (value.get('type'), value['lid'])
+            for key, item in value.items():
+                if key != 'attributes':
+                    yield from cls.lid_refs(item)
+
+    def add_lid(self, data, resource):
+        '''Remember the id of a resource created for data with a lid.'''
+        if isinstance(data, dict) and 'lid' in data and resource:
+            self.lids[(data.get('type'), data['lid'])] = resource['id']
+
+    def call(self, view, method, http_method, matchdict, body, start):
+        '''Call a view method with a request made up for it.
 
+        Parameters:
+            view: collection view class.
+            method (str): name of the view method.
+            http_method (str): HTTP method of the made up request.
+            matchdict (dict): route parameters.
+            body (dict): JSON body, or None.
+            start (int): index in the request of the (first) operation.
 
-def append_callback_set_to_all_views(set_name):
-    '''Append a named set of callbacks to all view classes.
+        Returns:
+            dict: what the view method returned, or ``{}`` for No Content.
 
-    Args:
-        set_name (str): key in ``callback_sets``.
-    '''
-    for view_class in view_classes.values():
-        view_class.append_callback_set(set_name)
+        Raises:
+            HTTPException: if the view method failed.
+        '''
+        if method == 'collection_post':
+            route_name = view.collection_route_name
+        elif method.startswith('relationships_'):
+            route_name = view.relationships_route_name
+        else:
+            route_name = view.item_route_name
+        headers = {'Content-Type': 'application/vnd.api+json'}
+        if 'prefer' in self.request.headers:
+            headers['Prefer'] = self.request.headers['prefer']
+        sub = pyramid.request.Request.blank(
+            self.request.route_path(route_name, **matchdict),
+            base_url=self.request.application_url,
+            headers=headers,
+            method=http_method,
+        )
+        if body is not None:
+            sub.body = json.dumps(body).encode()
+        sub.registry = self.request.registry
+        sub.matchdict = matchdict
+        ret = getattr(view(sub), method)()
+        if isinstance(ret, Response):
+            return {}
+        if sub.response.status_code >= 400:
+            # A failed bulk create: point its errors at the operations.
+            e = exception_response(sub.response.status_code)
+            e.errors = ret.get('errors', [])
+            for err in e.errors:
+                pointer = err.get('source', {}).get('pointer', '')
+                match = re.match(r'/data/(\d+)(.*)', pointer)
+                if match:
+                    err['source']['pointer'] =\
+                        '/atomic:operations/{}/data{}'.format(
+                            start + int(match.group(1)), match.group(2)
+                        )
+            raise e
+        return ret
 
 
 class DebugView:
@@ -2528,6 +7807,10 @@ class DebugView:
         '''
         # Create or update tables and schema. Safe if tables already exist.
         self.metadata.create_all(self.engine)
+        # Create search indexes and the change log. Safe if they already
+        # exist.
+        create_search_indexes(self.engine)
+        create_change_log(self.engine)
         # Add test data. Safe if test data already exists.
         self.test_data.add_to_db()
         return 'populated'
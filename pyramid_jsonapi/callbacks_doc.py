@@ -94,6 +94,40 @@ def before_collection_post(view_instance, obj):
     '''
 
 
+def before_collection_patch(view_instance, partial_object):
+    '''Called before view_instance.collection_patch() updates filtered items.
+
+    Raise an appropriate exception to refuse the update.
+
+    Args:
+        view_instance (pyramid_jsonapi.CollectionViewBase): the current view
+            instance.
+
+        partial_object (dict): JSON-API patch object (without an id).
+
+    Returns:
+        dict: altered patch object.
+    '''
+
+
+def before_collection_delete(view_instance, query):
+    '''Called before view_instance.collection_delete() deletes filtered items.
+
+    Raise an appropriate exception to refuse the delete, or add criteria to
+    the query to delete fewer items.
+
+    Args:
+        view_instance (pyramid_jsonapi.CollectionViewBase): the current view
+            instance.
+
+        query (sqlalchemy.orm.query.Query): query for the ids of the items to
+            be deleted.
+
+    Returns:
+        sqlalchemy.orm.query.Query: altered query.
+    '''
+
+
 def after_related_get(view_instance, document):
     '''Called before view_instance.related_get() returns.
 
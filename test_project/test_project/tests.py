@@ -1,12 +1,22 @@
 import unittest
+import contextlib
+import csv
+import io
+import json
 import transaction
 import testing.postgresql
+import webob
 import webtest
 import datetime
+from pyramid.httpexceptions import HTTPForbidden
 from pyramid.paster import get_app
+import pyramid.request
+import psycopg2
+import sqlalchemy
 from sqlalchemy import create_engine
 from sqlalchemy.exc import SAWarning
 import test_project
+import pyramid_jsonapi
 import inspect
 import os
 import urllib
@@ -61,6 +71,7 @@ class DBTestBase(unittest.TestCase):
 
     def setUp(self):
         Base.metadata.create_all(engine)
+        pyramid_jsonapi.create_change_log(engine)
         # Add some basic test data.
         test_data.add_to_db()
         transaction.begin()
@@ -68,6 +79,23 @@ class DBTestBase(unittest.TestCase):
     def tearDown(self):
         transaction.abort()
         Base.metadata.drop_all(engine)
+        engine.execute(pyramid_jsonapi.change_log.table.delete())
+
+    @contextlib.contextmanager
+    def statements(self):
+        '''Record the SQL statements executed inside the with block.'''
+        stmts = []
+
+        def record(conn, cursor, statement, *args):
+            stmts.append(statement)
+
+        # The app has its own engine: listen to all of them.
+        target = sqlalchemy.engine.Engine
+        sqlalchemy.event.listen(target, 'before_cursor_execute', record)
+        try:
+            yield stmts
+        finally:
+            sqlalchemy.event.remove(target, 'before_cursor_execute', record)
 
 
 class TestSpec(DBTestBase):
@@ -1155,7 +1183,7 @@ class TestSpec(DBTestBase):
                             "data": {"type": "people", "id": "3"}
                         },
                         "article": {
-                            "data": {"type": "articles", "id": article_id}
+                            "data": {"type": "articles_by_obj", "id": article_id}
                         }
                     }
                 }
@@ -1174,7 +1202,7 @@ class TestSpec(DBTestBase):
                             "data": {"type": "people", "id": "2"}
                         },
                         "article": {
-                            "data": {"type": "articles", "id": article_id}
+                            "data": {"type": "articles_by_obj", "id": article_id}
                         }
                     }
                 }
@@ -2062,6 +2090,2282 @@ class TestErrors(DBTestBase):
         self.assertIn('detail', err)
 
 
+class TestStatementCache(DBTestBase):
+    '''Test the compiled statement cache used by collection_get.'''
+
+    def setUp(self):
+        super().setUp()
+        self.cache = pyramid_jsonapi.view_classes[
+            test_project.models.Person
+        ].statement_cache
+        self.cache.clear()
+
+    def test_statement_cache_hits(self):
+        '''Same shape with different values should reuse the cached query.'''
+        self.test_app.get('/people?filter[name:eq]=alice&page[offset]=0')
+        self.assertEqual(self.cache.info()['misses'], 1)
+        self.assertEqual(self.cache.info()['hits'], 0)
+        self.test_app.get('/people?filter[name:eq]=bob&page[offset]=1')
+        self.assertEqual(self.cache.info()['misses'], 1)
+        self.assertEqual(self.cache.info()['hits'], 1)
+        # A different filter operator is a different shape.
+        self.test_app.get('/people?filter[name:ne]=bob')
+        self.assertEqual(self.cache.info()['misses'], 2)
+
+    def test_statement_cache_binds_values(self):
+        '''Cached queries should use the current request's values.'''
+        for name in ('alice', 'bob', 'alice'):
+            data = self.test_app.get(
+                '/people?filter[name:eq]={}'.format(name)
+            ).json['data']
+            self.assertEqual(len(data), 1)
+            self.assertEqual(data[0]['attributes']['name'], name)
+        data = self.test_app.get(
+            '/posts?sort=id&page[limit]=2&page[offset]=2'
+        ).json['data']
+        self.assertEqual([item['id'] for item in data], ['3', '4'])
+        json = self.test_app.get(
+            '/posts?sort=id&page[limit]=2&page[offset]=4'
+        ).json
+        self.assertEqual([item['id'] for item in json['data']], ['5', '6'])
+        self.assertEqual(json['meta']['results']['available'], 6)
+
+    def test_statement_cache_lru(self):
+        '''Least recently used shapes should be evicted first.'''
+        cache = pyramid_jsonapi.StatementCache(size=2)
+        build = lambda session: None
+        cache.get('a', build)
+        cache.get('b', build)
+        cache.get('a', build)
+        cache.get('c', build)
+        self.assertEqual(list(cache.shapes), ['a', 'c'])
+        cache.get('b', build)
+        self.assertEqual(cache.info()['misses'], 4)
+        self.assertEqual(cache.info()['hits'], 1)
+
+
+class TestPreparedStatements(DBTestBase):
+    '''Test server side prepared statements for hot queries.'''
+
+    def test_prepared_statements_used(self):
+        '''Repeated single item fetches should EXECUTE a prepared statement.'''
+        ps = pyramid_jsonapi.prepared_statements
+        executed = ps.info()['executed']
+        for person_id in ('1', '2', '1', '2'):
+            data = self.test_app.get(
+                '/people/{}'.format(person_id)
+            ).json['data']
+            self.assertEqual(data['id'], person_id)
+        self.assertGreater(ps.info()['executed'], executed)
+        # Related and relationships endpoints too.
+        for i in range(3):
+            data = self.test_app.get('/posts/1/author').json['data']
+            self.assertEqual(data['id'], '1')
+            data = self.test_app.get(
+                '/people/1/relationships/posts'
+            ).json['data']
+            self.assertEqual({item['id'] for item in data}, {'1', '2', '3'})
+
+    def prepare(self, conn, stmt, **params):
+        '''Execute stmt often enough for it to be prepared.'''
+        for i in range(pyramid_jsonapi.prepared_statements.threshold):
+            conn.execute(stmt, **params).fetchall()
+        self.assertIn('jsonapi_prepared', conn.info)
+
+    def test_prepared_statements_stale(self):
+        '''Statements dropped by the server should be run unprepared.'''
+        ps = pyramid_jsonapi.prepared_statements
+        people = test_project.models.Person.__table__
+        stmt = people.select().where(
+            people.c.id == sqlalchemy.bindparam('person_id')
+        )
+        with engine.connect() as conn:
+            conn = conn.execution_options(jsonapi_prepare=True)
+            self.prepare(conn, stmt, person_id=1)
+            conn.execute('DEALLOCATE ALL')
+            invalidated = ps.info()['invalidated']
+            rows = conn.execute(stmt, person_id=1).fetchall()
+            self.assertEqual(rows[0]['name'], 'alice')
+            self.assertEqual(ps.info()['invalidated'], invalidated + 1)
+            # And prepared again next time.
+            executed = ps.info()['executed']
+            rows = conn.execute(stmt, person_id=2).fetchall()
+            self.assertEqual(rows[0]['name'], 'bob')
+            self.assertEqual(ps.info()['executed'], executed + 1)
+            self.assertEqual(ps.info()['invalidated'], invalidated + 1)
+
+            # Recycled connections start with nothing prepared.
+            conn.invalidate()
+            self.assertNotIn('jsonapi_prepared', conn.info)
+            rows = conn.execute(stmt, person_id=2).fetchall()
+            self.assertEqual(rows[0]['name'], 'bob')
+
+    def test_prepared_statements_stale_transaction(self):
+        '''A transaction should carry on after a stale statement.'''
+        people = test_project.models.Person.__table__
+        stmt = people.select().where(
+            people.c.id == sqlalchemy.bindparam('person_id')
+        )
+        with engine.connect() as conn:
+            conn = conn.execution_options(jsonapi_prepare=True)
+            trans = conn.begin()
+            conn.execute(
+                people.update().where(people.c.id == 1).values(name='al')
+            )
+            self.prepare(conn, stmt, person_id=1)
+            conn.execute('DEALLOCATE ALL')
+            rows = conn.execute(stmt, person_id=1).fetchall()
+            self.assertEqual(rows[0]['name'], 'al')
+            for i in range(3):
+                rows = conn.execute(stmt, person_id=2).fetchall()
+                self.assertEqual(rows[0]['name'], 'bob')
+            trans.rollback()
+            rows = conn.execute(stmt, person_id=1).fetchall()
+            self.assertEqual(rows[0]['name'], 'alice')
+
+    def test_prepared_statements_result_type_changed(self):
+        '''A schema change under a prepared statement should not leak it.'''
+        ps = pyramid_jsonapi.prepared_statements
+        table = sqlalchemy.Table(
+            'prepared_test', sqlalchemy.MetaData(),
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('value', sqlalchemy.Integer),
+        )
+        stmt = table.select().where(
+            table.c.id == sqlalchemy.bindparam('row_id')
+        )
+        with engine.connect() as conn:
+            table.create(conn)
+            try:
+                conn.execute(table.insert().values(id=1, value=2))
+                conn = conn.execution_options(jsonapi_prepare=True)
+                self.prepare(conn, stmt, row_id=1)
+                conn.execute('ALTER TABLE prepared_test ALTER value TYPE text')
+                invalidated = ps.info()['invalidated']
+                rows = conn.execute(stmt, row_id=1).fetchall()
+                self.assertEqual(rows[0]['value'], '2')
+                self.assertEqual(ps.info()['invalidated'], invalidated + 1)
+                # The old statements were deallocated, not just forgotten.
+                names = [
+                    row[0] for row in conn.execute(
+                        'SELECT name FROM pg_prepared_statements'
+                    )
+                ]
+                self.assertEqual(names, [])
+            finally:
+                table.drop(conn)
+
+    def test_prepared_statements_duplicate_name(self):
+        '''A name already taken on the server should not break queries.'''
+        ps = pyramid_jsonapi.prepared_statements
+        people = test_project.models.Person.__table__
+        stmt = people.select().where(
+            people.c.name == sqlalchemy.bindparam('person_name')
+        )
+        with engine.connect() as conn:
+            conn = conn.execution_options(jsonapi_prepare=True)
+            # Someone else (a pooler, say) got there first.
+            conn.execute('PREPARE jsonapi_{} AS SELECT 1'.format(
+                conn.info.get('jsonapi_prepared_seq', 0) + 1
+            ))
+            invalidated = ps.info()['invalidated']
+            for i in range(ps.threshold):
+                rows = conn.execute(stmt, person_name='alice').fetchall()
+                self.assertEqual(rows[0]['name'], 'alice')
+            self.assertEqual(ps.info()['invalidated'], invalidated + 1)
+
+    def test_prepared_statements_stale_request(self):
+        '''A request which finds its statement gone should still succeed.'''
+        ps = pyramid_jsonapi.prepared_statements
+        app_engine = DBSession.get_bind()
+        # Start from one pooled connection so the requests all share it.
+        app_engine.dispose()
+        for i in range(ps.threshold):
+            self.test_app.get('/people/1')
+        with app_engine.connect() as conn:
+            self.assertIn('jsonapi_prepared', conn.info)
+            conn.execute('DEALLOCATE ALL')
+        invalidated = ps.info()['invalidated']
+        for i in range(2):
+            self.assertEqual(
+                self.test_app.get('/people/1').json['data']['id'], '1'
+            )
+        self.assertEqual(ps.info()['invalidated'], invalidated + 1)
+
+
+class TestKeysetPagination(DBTestBase):
+    '''Test cursor based pagination with page[after] and page[before].'''
+
+    def walk(self, url, link):
+        '''Follow link from url until it runs out, return ids in order.'''
+        ids = []
+        while url:
+            json = self.test_app.get(url).json
+            self.assertLessEqual(len(json['data']), 2)
+            if link == 'next':
+                ids.extend(item['id'] for item in json['data'])
+            else:
+                ids[:0] = [item['id'] for item in json['data']]
+            url = json['links'].get(link)
+        return ids
+
+    def test_keyset_forwards(self):
+        '''Following next links should visit every item once, in order.'''
+        ids = self.walk('/posts?page[limit]=2&page[after]=', 'next')
+        self.assertEqual(ids, ['1', '2', '3', '4', '5', '6'])
+        # With a sort key that has duplicates, reversed.
+        ids = self.walk(
+            '/posts?page[limit]=2&sort=-content&page[after]=', 'next'
+        )
+        contents = {
+            item['id']: item['attributes']['content'] for item in
+            self.test_app.get('/posts?page[limit]=100').json['data']
+        }
+        expected = sorted(
+            contents, key=lambda i: (contents[i], -int(i)), reverse=True
+        )
+        self.assertEqual(ids, expected)
+
+    def test_keyset_nulls(self):
+        '''Items with a NULL sort value should come last, not be skipped.'''
+        posts = test_project.models.Post.__table__
+        engine.execute(
+            posts.update().where(posts.c.id.in_([2, 5])).values(content=None)
+        )
+        contents = {
+            item['id']: item['attributes']['content'] for item in
+            self.test_app.get('/posts?page[limit]=100').json['data']
+        }
+        expected = sorted(
+            contents,
+            key=lambda i: (contents[i] is None, contents[i] or '', int(i))
+        )
+        self.assertEqual(
+            self.walk(
+                '/posts?page[limit]=2&sort=content&page[after]=', 'next'
+            ),
+            expected
+        )
+        self.assertEqual(
+            self.walk(
+                '/posts?page[limit]=2&sort=content&page[before]=', 'prev'
+            ),
+            expected
+        )
+        expected = sorted(
+            contents,
+            key=lambda i: (contents[i] is None, contents[i] or '', -int(i)),
+            reverse=True
+        )
+        self.assertEqual(
+            self.walk(
+                '/posts?page[limit]=2&sort=-content&page[after]=', 'next'
+            ),
+            expected
+        )
+
+    def test_keyset_backwards(self):
+        '''Following prev links from the end should visit every item.'''
+        ids = self.walk('/posts?page[limit]=2&page[before]=', 'prev')
+        self.assertEqual(ids, ['1', '2', '3', '4', '5', '6'])
+
+    def test_keyset_links(self):
+        '''Keyset pages should link to the neighbouring pages.'''
+        json = self.test_app.get('/posts?page[limit]=2&page[after]=').json
+        self.assertNotIn('prev', json['links'])
+        self.assertNotIn('offset', json['meta']['results'])
+        json = self.test_app.get(json['links']['next']).json
+        self.assertEqual([item['id'] for item in json['data']], ['3', '4'])
+        json = self.test_app.get(json['links']['prev']).json
+        self.assertEqual([item['id'] for item in json['data']], ['1', '2'])
+
+    def test_keyset_related(self):
+        '''Related and relationships endpoints should support cursors.'''
+        ids = self.walk('/people/1/posts?page[limit]=2&page[after]=', 'next')
+        self.assertEqual(ids, ['1', '2', '3'])
+        ids = self.walk(
+            '/people/1/relationships/posts?page[limit]=2&page[after]=',
+            'next'
+        )
+        self.assertEqual(ids, ['1', '2', '3'])
+
+    def test_keyset_errors(self):
+        '''Bad cursors and relationship sorts should be rejected.'''
+        self.test_app.get('/posts?page[after]=notacursor', status=400)
+        self.test_app.get(
+            '/posts?page[after]=&sort=author.name', status=400
+        )
+        self.test_app.get('/posts?page[after]=&page[before]=', status=400)
+
+    def test_max_offset(self):
+        '''Offsets beyond pyramid_jsonapi.paging.max_offset are refused.'''
+        self.test_app.get('/posts?page[offset]=1000')
+        self.test_app.get('/posts?page[offset]=1001', status=400)
+
+
+class TestCountStrategy(DBTestBase):
+    '''Test the page[count] count strategies.'''
+
+    def test_count_exact(self):
+        '''Default strategy should be an exact count.'''
+        results = self.test_app.get('/posts').json['meta']['results']
+        self.assertEqual(results['available'], 6)
+        self.assertEqual(results['count'], 'exact')
+
+    def test_count_none(self):
+        '''No count: available is null and there is no last link.'''
+        json = self.test_app.get('/posts?page[count]=none&page[limit]=2').json
+        self.assertIsNone(json['meta']['results']['available'])
+        self.assertEqual(json['meta']['results']['count'], 'none')
+        self.assertNotIn('last', json['links'])
+        self.assertIn('next', json['links'])
+        # A short page means there is no next page.
+        json = self.test_app.get(
+            '/posts?page[count]=none&page[limit]=4&page[offset]=4'
+        ).json
+        self.assertEqual(len(json['data']), 2)
+        self.assertNotIn('next', json['links'])
+
+    def test_count_estimate(self):
+        '''Estimated counts come from the planner.'''
+        json = self.test_app.get('/posts?page[count]=estimate').json
+        self.assertEqual(json['meta']['results']['count'], 'estimate')
+        self.assertIsInstance(json['meta']['results']['available'], int)
+        self.assertNotIn('last', json['links'])
+        json = self.test_app.get(
+            '/people/1/posts?page[count]=estimate'
+        ).json
+        self.assertEqual(json['meta']['results']['count'], 'estimate')
+
+    def test_count_capped(self):
+        '''Capped counts are exact up to the cap and unknown beyond it.'''
+        view = pyramid_jsonapi.view_classes[test_project.models.Post]
+        self.addCleanup(setattr, view, 'count_cap', view.count_cap)
+        view.count_cap = 3
+        results = self.test_app.get(
+            '/posts?page[count]=capped'
+        ).json['meta']['results']
+        self.assertIsNone(results['available'])
+        self.assertEqual(results['count'], 'capped')
+        self.assertEqual(results['at_least'], 4)
+        results = self.test_app.get(
+            '/posts?page[count]=capped&filter[id:le]=2'
+        ).json['meta']['results']
+        self.assertEqual(results['available'], 2)
+        self.assertEqual(results['count'], 'exact')
+
+    def test_count_window(self):
+        '''Window counts should need only the page query.'''
+        with self.statements() as stmts:
+            json = self.test_app.get(
+                '/posts?page[count]=window&page[limit]=2&page[offset]=2'
+            ).json
+        self.assertEqual(json['meta']['results']['available'], 6)
+        self.assertEqual(json['meta']['results']['count'], 'exact')
+        self.assertEqual([item['id'] for item in json['data']], ['3', '4'])
+        self.assertIn('last', json['links'])
+        self.assertEqual(
+            len([s for s in stmts if 'count(*) OVER ()' in s]), 1
+        )
+        self.assertFalse(
+            [s for s in stmts if s.startswith('SELECT count(*)')]
+        )
+        # Related endpoints, and an empty page past the end.
+        json = self.test_app.get(
+            '/people/1/relationships/posts?page[count]=window'
+        ).json
+        self.assertEqual(json['meta']['results']['available'], 3)
+        json = self.test_app.get(
+            '/people/1/posts?page[count]=window&page[offset]=10'
+        ).json
+        self.assertEqual(json['data'], [])
+        self.assertEqual(json['meta']['results']['available'], 3)
+
+    def test_count_bad(self):
+        '''Unknown count strategies are a bad request.'''
+        self.test_app.get('/posts?page[count]=lots', status=400)
+
+
+class TestCountCache(DBTestBase):
+    '''Test the total count cache.'''
+
+    def setUp(self):
+        super().setUp()
+        pyramid_jsonapi.count_cache.clear()
+
+    def count_selects(self, url):
+        '''Fetch url and return (results meta, number of count queries).'''
+        with self.statements() as stmts:
+            results = self.test_app.get(url).json['meta']['results']
+        return results, len([s for s in stmts if 'count(*)' in s])
+
+    def test_count_cache_hit(self):
+        '''The second request for the same total should hit the cache.'''
+        results, misses = self.count_selects('/people')
+        self.assertFalse(results['cached'])
+        results, hits = self.count_selects('/people')
+        self.assertTrue(results['cached'])
+        self.assertEqual(results['available'], 4)
+        # Nothing counted again (relationship totals are cached too).
+        self.assertGreater(misses, 0)
+        self.assertEqual(hits, 0)
+        # Paging doesn't change the total.
+        results = self.count_selects('/people?page[limit]=1')[0]
+        self.assertTrue(results['cached'])
+        # Different filters are counted separately.
+        results, counts = self.count_selects('/people?filter[name:eq]=alice')
+        self.assertFalse(results['cached'])
+        self.assertEqual(results['available'], 1)
+        # So are different parents of related collections.
+        self.assertFalse(self.count_selects('/people/1/posts')[0]['cached'])
+        results = self.count_selects('/people/2/posts')[0]
+        self.assertFalse(results['cached'])
+        self.assertTrue(self.count_selects('/people/2/posts')[0]['cached'])
+
+    def test_count_cache_invalidation(self):
+        '''Writes should invalidate counts for the tables they touch.'''
+        self.count_selects('/people')
+        self.count_selects('/blogs')
+        self.test_app.post_json(
+            '/people',
+            {
+                'data': {
+                    'type': 'people',
+                    'attributes': {
+                        'name': 'test'
+                    }
+                }
+            },
+            headers={'Content-Type': 'application/vnd.api+json'}
+        )
+        results = self.count_selects('/people')[0]
+        self.assertFalse(results['cached'])
+        self.assertEqual(results['available'], 5)
+        self.assertTrue(self.count_selects('/blogs')[0]['cached'])
+        self.test_app.delete('/people/5')
+        results = self.count_selects('/people')[0]
+        self.assertFalse(results['cached'])
+        self.assertEqual(results['available'], 4)
+
+    def test_count_cache_record_changes(self):
+        '''Writes reported by record_changes should invalidate counts.'''
+        self.count_selects('/people')
+        self.count_selects('/blogs')
+        pyramid_jsonapi.record_changes(DBSession, [
+            {'collection': 'people', 'item_id': '1', 'op': 'update'}
+        ])
+        self.assertFalse(self.count_selects('/people')[0]['cached'])
+        self.assertTrue(self.count_selects('/blogs')[0]['cached'])
+
+    def test_count_cache_race(self):
+        '''A count which raced a write should not be stored.'''
+        cache = pyramid_jsonapi.count_cache
+
+        def write_during_count(conn, cursor, statement, *args):
+            if 'count(*)' in statement:
+                # Another request commits a new person meanwhile.
+                cache.invalidate({'people'})
+
+        sqlalchemy.event.listen(
+            DBSession.get_bind(), 'before_cursor_execute',
+            write_during_count
+        )
+        try:
+            self.assertFalse(self.count_selects('/people')[0]['cached'])
+        finally:
+            sqlalchemy.event.remove(
+                DBSession.get_bind(), 'before_cursor_execute',
+            write_during_count
+            )
+        self.assertFalse(self.count_selects('/people')[0]['cached'])
+        self.assertTrue(self.count_selects('/people')[0]['cached'])
+        # Directly: only a count whose tables are unchanged is kept.
+        generations = cache.generations({'people', 'posts'})
+        cache.invalidate({'blogs'})
+        self.assertTrue(cache.set('a', 1, {'people', 'posts'}, generations))
+        cache.invalidate({'posts'})
+        self.assertFalse(cache.set('b', 1, {'people', 'posts'}, generations))
+        self.assertIsNone(cache.get('b'))
+
+    def test_count_cache_ttl(self):
+        '''Expired entries should be counted again.'''
+        self.addCleanup(
+            setattr, pyramid_jsonapi.count_cache, 'ttl',
+            pyramid_jsonapi.count_cache.ttl
+        )
+        pyramid_jsonapi.count_cache.ttl = 0
+        self.count_selects('/people')
+        self.assertFalse(self.count_selects('/people')[0]['cached'])
+
+
+class TestAggregate(DBTestBase):
+    '''Test aggregate[...] queries.'''
+
+    def aggregate(self, query, status=200):
+        '''Return meta.aggregate for /posts?<query>.'''
+        json = self.test_app.get('/posts?' + query, status=status).json
+        if status == 200:
+            self.assertNotIn('data', json)
+            return json['meta']['aggregate']
+        return json
+
+    def test_aggregate_count(self):
+        '''Should count per group, by column or by relationship.'''
+        groups = self.aggregate('aggregate[count]=author_id')['groups']
+        self.assertEqual(
+            groups,
+            [{'author_id': 1, 'count': 3}, {'author_id': 2, 'count': 3}]
+        )
+        groups = self.aggregate('aggregate[count]=blog')['groups']
+        self.assertEqual([g['count'] for g in groups], [2, 1, 2, 1])
+        # No columns: one group.
+        groups = self.aggregate('aggregate[count]=')['groups']
+        self.assertEqual(groups, [{'count': 6}])
+
+    def test_aggregate_filtered(self):
+        '''Filters should apply before aggregating.'''
+        groups = self.aggregate(
+            'aggregate[count]=author_id&filter[published_at:gt]=2015-01-02'
+        )['groups']
+        self.assertEqual(
+            groups,
+            [{'author_id': 1, 'count': 1}, {'author_id': 2, 'count': 3}]
+        )
+
+    def test_aggregate_bucket(self):
+        '''Should group by truncated dates.'''
+        groups = self.aggregate(
+            'aggregate[count]=author_id&aggregate[bucket]=published_at:week'
+        )['groups']
+        self.assertEqual(
+            [
+                (g['author_id'], g['published_at:week'][:10], g['count'])
+                for g in groups
+            ],
+            [
+                (1, '2014-12-29', 3),
+                (2, '2014-12-29', 1),
+                (2, '2015-01-05', 2),
+            ]
+        )
+
+    def test_aggregate_metrics(self):
+        '''Should compute functions per group.'''
+        groups = self.aggregate(
+            'aggregate[count]=author&aggregate[min]=title,published_at'
+        )['groups']
+        self.assertEqual(groups[0]['min.title'], 'post1: alice.main')
+        self.assertEqual(groups[1]['min.published_at'][:10], '2015-01-04')
+
+    def test_aggregate_facets(self):
+        '''Should return distinct values, most common first.'''
+        facets = self.aggregate('aggregate[facets]=content')['facets']
+        self.assertEqual(
+            facets['content'][:2],
+            [
+                {'value': 'something insightful', 'count': 2},
+                {'value': 'something trivial', 'count': 2},
+            ]
+        )
+        self.assertEqual(len(facets['content']), 4)
+
+    def test_aggregate_truncated(self):
+        '''Should flag results with too many groups.'''
+        view = pyramid_jsonapi.view_classes[test_project.models.Post]
+        self.addCleanup(
+            setattr, view, 'max_aggregate_groups', view.max_aggregate_groups
+        )
+        view.max_aggregate_groups = 2
+        aggregate = self.aggregate('aggregate[count]=id')
+        self.assertTrue(aggregate['truncated'])
+        self.assertEqual(len(aggregate['groups']), 2)
+
+    def test_aggregate_bad(self):
+        '''Unknown columns, functions and units are bad requests.'''
+        self.aggregate('aggregate[count]=nonsense', status=400)
+        self.aggregate('aggregate[sum]=author_id', status=400)
+        self.aggregate('aggregate[median]=title', status=400)
+        self.aggregate('aggregate[bucket]=published_at:fortnight', status=400)
+
+    def test_aggregate_allowed_fields(self):
+        '''Fields outside allowed_fields can't be aggregated on.'''
+        view = pyramid_jsonapi.view_classes[test_project.models.Post]
+        self.addCleanup(setattr, view, 'allowed_fields', view.allowed_fields)
+        view.allowed_fields = property(
+            lambda self: set(self.fields) - {'content', 'author'}
+        )
+        self.aggregate('aggregate[facets]=content', status=400)
+        self.aggregate('aggregate[count]=author', status=400)
+        self.aggregate('aggregate[count]=author_id', status=400)
+        self.aggregate('aggregate[count]=blog')
+
+    def test_aggregate_callbacks(self):
+        '''after_collection_get should run, per object permissions refuse.'''
+        view = pyramid_jsonapi.view_classes[test_project.models.Post]
+
+        def veto(view, doc):
+            raise HTTPForbidden('No.')
+
+        view.callbacks['after_collection_get'].append(veto)
+        try:
+            self.aggregate('aggregate[count]=author', status=403)
+        finally:
+            view.callbacks['after_collection_get'].pop()
+        # people has an allowed_object.
+        self.test_app.get('/people?aggregate[count]=', status=403)
+
+
+class TestSearch(DBTestBase):
+    '''Test full text search filters.'''
+
+    def setUp(self):
+        super().setUp()
+        pyramid_jsonapi.create_search_indexes(engine)
+
+    def ids(self, query):
+        '''Return the ids of /posts?<query>.'''
+        json = self.test_app.get('/posts?' + query).json
+        return [item['id'] for item in json['data']]
+
+    def test_search_column(self):
+        '''filter[<attr>:search] should match stemmed words.'''
+        self.assertEqual(self.ids('filter[content:search]=truth'), ['3', '6'])
+        self.assertEqual(
+            self.ids('filter[content:search]=something -trivial'), ['1', '4']
+        )
+        self.assertEqual(
+            self.ids('filter[content:search]="something trivial"'),
+            ['2', '5']
+        )
+
+    def test_search_all(self):
+        '''filter[q] should search all the search columns.'''
+        self.assertEqual(self.ids('filter[q]=insightful'), ['1', '4'])
+        self.assertEqual(self.ids('filter[q]=post1 truth'), ['3', '6'])
+        # Combined with other filters.
+        self.assertEqual(
+            self.ids('filter[q]=insightful&filter[author_id:eq]=2'), ['4']
+        )
+
+    def test_search_rank(self):
+        '''sort=-_rank should put the best matches first.'''
+        ids = self.ids('filter[q]=something or insightful&sort=-_rank')
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(set(ids[:2]), {'1', '4'})
+        self.test_app.get('/posts?sort=-_rank', status=400)
+
+    def test_search_bad(self):
+        '''Only search columns can be searched.'''
+        self.test_app.get('/posts?filter[published_at:search]=x', status=400)
+        self.test_app.get('/people?filter[q]=alice', status=400)
+
+    def test_search_uses_index(self):
+        '''The search query should be able to use the GIN indexes.'''
+        for query in ('filter[q]=truth', 'filter[content:search]=truth'):
+            executed = []
+
+            def record(conn, cursor, statement, parameters, *args):
+                if 'websearch_to_tsquery' in statement and\
+                        'count(*)' not in statement:
+                    executed.append((statement, parameters))
+
+            sqlalchemy.event.listen(
+                sqlalchemy.engine.Engine, 'before_cursor_execute', record
+            )
+            try:
+                self.ids(query)
+            finally:
+                sqlalchemy.event.remove(
+                    sqlalchemy.engine.Engine, 'before_cursor_execute', record
+                )
+            statement, parameters = executed[0]
+            with engine.connect() as conn:
+                conn.execute('SET enable_seqscan = off')
+                plan = '\n'.join(row[0] for row in conn.execute(
+                    'EXPLAIN ' + statement, parameters
+                ))
+            self.assertIn('_search_idx', plan)
+
+
+class TestExport(DBTestBase):
+    '''Test the streaming @export endpoint.'''
+
+    def test_export_ndjson(self):
+        '''Should stream one resource object per line.'''
+        res = self.test_app.get('/posts/@export')
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        lines = [json.loads(line) for line in res.text.splitlines()]
+        self.assertEqual([item['id'] for item in lines], [
+            '1', '2', '3', '4', '5', '6'
+        ])
+        self.assertEqual(lines[0]['type'], 'posts')
+        self.assertEqual(lines[0]['attributes']['title'], 'post1: alice.main')
+        self.assertEqual(
+            lines[0]['relationships']['author']['data'],
+            {'type': 'people', 'id': '1'}
+        )
+        self.assertNotIn('comments', lines[0]['relationships'])
+
+    def test_export_csv(self):
+        '''Should honour fields, sort and filters in CSV.'''
+        res = self.test_app.get(
+            '/posts/@export?format=csv&fields[posts]=title,author'
+            '&sort=-published_at&filter[author_id:eq]=1'
+        )
+        self.assertEqual(res.content_type, 'text/csv')
+        rows = list(csv.reader(io.StringIO(res.text)))
+        self.assertEqual(rows, [
+            ['id', 'title', 'author'],
+            ['3', 'post1: alice.second', '1'],
+            ['2', 'post2: alice.main', '1'],
+            ['1', 'post1: alice.main', '1'],
+        ])
+
+    def test_export_callbacks(self):
+        '''Callbacks should run and forbidden objects should be left out.'''
+        lines = [
+            json.loads(line) for line in
+            self.test_app.get('/people/@export').text.splitlines()
+        ]
+        self.assertEqual([item['id'] for item in lines], ['1', '2', '3'])
+        self.assertEqual(lines[0]['attributes']['name_copy'], 'alice')
+
+    def test_export_one_query(self):
+        '''The export should be a single SELECT.'''
+        with self.statements() as stmts:
+            self.test_app.get('/posts/@export?format=csv')
+        self.assertEqual(
+            len([s for s in stmts if s.lstrip().startswith('SELECT')]), 1
+        )
+
+    def test_export_closed_unread(self):
+        '''Closing the body without reading it should free the connection.'''
+        pool = DBSession.get_bind().pool
+        checkedout = pool.checkedout()
+        for path in ('/posts/@export', '/posts/@export?format=csv'):
+            body = self.test_app.app(
+                webob.Request.blank(path).environ,
+                lambda status, headers, exc_info=None: None
+            )
+            self.assertEqual(pool.checkedout(), checkedout + 1)
+            body.close()
+            self.assertEqual(pool.checkedout(), checkedout)
+            body.close()
+        # Part read, then closed (client went away).
+        body = self.test_app.app(
+            webob.Request.blank('/posts/@export').environ,
+            lambda status, headers, exc_info=None: None
+        )
+        self.assertEqual(json.loads(next(iter(body)))['id'], '1')
+        body.close()
+        self.assertEqual(pool.checkedout(), checkedout)
+
+    def test_export_bad_format(self):
+        '''Unknown formats are a bad request.'''
+        self.test_app.get('/posts/@export?format=xml', status=400)
+
+
+class TestChanges(DBTestBase):
+    '''Test the @changes feed.'''
+
+    def patch_title(self, post_id, title):
+        self.test_app.patch_json(
+            '/posts/{}'.format(post_id),
+            {
+                'data': {
+                    'id': str(post_id),
+                    'type': 'posts',
+                    'attributes': {
+                        'title': title
+                    }
+                }
+            },
+            headers={'Content-Type': 'application/vnd.api+json'},
+        )
+
+    def test_changes_feed(self):
+        '''Should return changed items and tombstones since a token.'''
+        json = self.test_app.get('/comments/@changes').json
+        self.assertEqual(json['data'], [])
+        token = json['meta']['changes']['token']
+        self.test_app.patch_json(
+            '/comments/1',
+            {
+                'data': {
+                    'id': '1',
+                    'type': 'comments',
+                    'attributes': {
+                        'content': 'edited'
+                    }
+                }
+            },
+            headers={'Content-Type': 'application/vnd.api+json'},
+        )
+        self.test_app.delete('/comments/5')
+        self.patch_title(1, 'not a comment')
+        json = self.test_app.get(
+            '/comments/@changes?since={}'.format(token)
+        ).json
+        self.assertEqual(
+            [(item['id'], item['attributes']['content'])
+             for item in json['data']],
+            [('1', 'edited')]
+        )
+        self.assertEqual(
+            json['meta']['changes']['deleted'],
+            [{'type': 'comments', 'id': '5'}]
+        )
+        self.assertFalse(json['meta']['changes']['more'])
+        # Nothing new since the new token.
+        json = self.test_app.get(json['links']['next']).json
+        self.assertEqual(json['data'], [])
+        self.assertEqual(json['meta']['changes']['deleted'], [])
+
+    def test_changes_paging(self):
+        '''Changes should be read page[limit] at a time.'''
+        token = self.test_app.get(
+            '/posts/@changes'
+        ).json['meta']['changes']['token']
+        self.patch_title(1, 'one')
+        self.patch_title(2, 'two')
+        self.patch_title(1, 'one again')
+        json = self.test_app.get(
+            '/posts/@changes?page[limit]=2&since={}'.format(token)
+        ).json
+        self.assertEqual([item['id'] for item in json['data']], ['1', '2'])
+        self.assertTrue(json['meta']['changes']['more'])
+        json = self.test_app.get(json['links']['next']).json
+        self.assertEqual(
+            [item['attributes']['title'] for item in json['data']],
+            ['one again']
+        )
+        self.assertFalse(json['meta']['changes']['more'])
+
+    def test_changes_bad_token(self):
+        '''Bad tokens are a bad request.'''
+        self.test_app.get('/posts/@changes?since=nonsense', status=400)
+
+
+class TestSubscriptions(DBTestBase):
+    '''Test @subscribe Server-Sent Event streams.'''
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(
+            setattr, pyramid_jsonapi.subscriptions, 'heartbeat',
+            pyramid_jsonapi.subscriptions.heartbeat
+        )
+        pyramid_jsonapi.subscriptions.heartbeat = 0.1
+
+    def subscribe(self, url):
+        '''Open a stream on url, returning (headers, stream iterator).'''
+        status_headers = []
+
+        def start_response(status, headers, exc_info=None):
+            status_headers.append((status, dict(headers)))
+
+        app_iter = self.app(webob.Request.blank(url).environ, start_response)
+        self.addCleanup(app_iter.close)
+        self.assertEqual(next(app_iter), b': subscribed\n\n')
+        return status_headers[0], app_iter
+
+    def event(self, stream):
+        '''Next event from stream as (event name, data), skipping comments.'''
+        for chunk in stream:
+            if not chunk.startswith(b':'):
+                break
+        lines = dict(
+            line.split(': ', 1) for line in chunk.decode().strip().split('\n')
+        )
+        return lines['event'], json.loads(lines['data'])
+
+    def patch_title(self, post_id, title):
+        self.test_app.patch_json(
+            '/posts/{}'.format(post_id),
+            {
+                'data': {
+                    'id': str(post_id),
+                    'type': 'posts',
+                    'attributes': {
+                        'title': title
+                    }
+                }
+            },
+            headers={'Content-Type': 'application/vnd.api+json'},
+        )
+
+    def test_subscribe_events(self):
+        '''Committed changes should be pushed to subscribers.'''
+        (status, headers), stream = self.subscribe('/comments/@subscribe')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(headers['Content-Type'].startswith('text/event-stream'))
+        # Idle streams get keepalives.
+        self.assertEqual(next(stream), b': keepalive\n\n')
+        self.test_app.delete('/comments/5')
+        self.assertEqual(
+            self.event(stream), ('delete', {'type': 'comments', 'id': '5'})
+        )
+        self.test_app.patch_json(
+            '/comments/1',
+            {
+                'data': {
+                    'id': '1',
+                    'type': 'comments',
+                    'attributes': {
+                        'content': 'edited'
+                    }
+                }
+            },
+            headers={'Content-Type': 'application/vnd.api+json'},
+        )
+        self.assertEqual(
+            self.event(stream), ('update', {'type': 'comments', 'id': '1'})
+        )
+
+    def test_subscribe_filtered_full(self):
+        '''Filters should apply and full resources can be sent.'''
+        stream = self.subscribe(
+            '/posts/@subscribe?full=true&filter[author_id:eq]=2'
+        )[1]
+        self.patch_title(1, 'alice post')
+        self.patch_title(4, 'bob post')
+        op, data = self.event(stream)
+        self.assertEqual(op, 'update')
+        self.assertEqual(data['id'], '4')
+        self.assertEqual(data['attributes']['title'], 'bob post')
+
+    def test_subscribe_rollback(self):
+        '''Changes which are rolled back should not be published.'''
+        stream = self.subscribe('/posts/@subscribe')[1]
+        post = DBSession.query(test_project.models.Post).get(1)
+        post.title = 'rolled back'
+        DBSession.flush()
+        transaction.abort()
+        self.patch_title(2, 'committed')
+        self.assertEqual(
+            self.event(stream), ('update', {'type': 'posts', 'id': '2'})
+        )
+
+    def test_subscribe_savepoint_rollback(self):
+        '''Changes in a rolled back savepoint should not be published.'''
+        subscription = pyramid_jsonapi.subscriptions.broker.subscribe('posts')
+        self.addCleanup(subscription.close)
+        Post = test_project.models.Post
+        savepoint = DBSession.begin_nested()
+        DBSession.query(Post).get(1).title = 'rolled back'
+        DBSession.flush()
+        savepoint.rollback()
+        savepoint = DBSession.begin_nested()
+        inner = DBSession.begin_nested()
+        DBSession.query(Post).get(2).title = 'inner rolled back'
+        DBSession.flush()
+        inner.commit()
+        savepoint.rollback()
+        savepoint = DBSession.begin_nested()
+        DBSession.query(Post).get(3).title = 'kept'
+        DBSession.flush()
+        savepoint.commit()
+        # Nothing is published until the transaction commits.
+        self.assertIsNone(subscription.get(timeout=0.1))
+        transaction.commit()
+        self.assertEqual(subscription.get(timeout=1), [
+            {'op': 'update', 'id': '3'}
+        ])
+
+    def test_subscribe_publish_error(self):
+        '''A broker failure should be logged, not fail the commit.'''
+        broker = pyramid_jsonapi.subscriptions.broker
+        self.addCleanup(
+            setattr, pyramid_jsonapi.subscriptions, 'broker', broker
+        )
+
+        class BadBroker(pyramid_jsonapi.LocalBroker):
+            def publish(self, collection, changes):
+                raise RuntimeError('broker down')
+
+        pyramid_jsonapi.subscriptions.broker = BadBroker()
+        with self.assertLogs('pyramid_jsonapi', 'ERROR'):
+            self.patch_title(1, 'still saved')
+        self.assertEqual(
+            self.test_app.get('/posts/1').json['data']['attributes']['title'],
+            'still saved'
+        )
+
+    def test_postgres_broker_reconnect(self):
+        '''A broken notify connection should be replaced.'''
+        broker = pyramid_jsonapi.PostgresBroker(
+            postgresql.url(), channel='jsonapi_test'
+        )
+        broker.publish('posts', [{'op': 'update', 'id': '1'}])
+        with engine.connect() as conn:
+            conn.execute(
+                'SELECT pg_terminate_backend(%s)',
+                broker.notify_conn.get_backend_pid()
+            )
+        with self.assertRaises(psycopg2.Error):
+            broker.publish('posts', [{'op': 'update', 'id': '1'}])
+        self.assertIsNone(broker.notify_conn)
+        broker.publish('posts', [{'op': 'update', 'id': '1'}])
+        broker.notify_conn.close()
+
+    def test_postgres_broker(self):
+        '''The PostgreSQL broker should deliver through NOTIFY.'''
+        broker = pyramid_jsonapi.PostgresBroker(
+            postgresql.url(), channel='jsonapi_test'
+        )
+        subscription = broker.subscribe('posts')
+        self.addCleanup(subscription.close)
+        self.assertTrue(broker.listening.wait(10))
+        changes = [{'op': 'update', 'id': str(i)} for i in range(120)]
+        broker.publish('posts', changes)
+        received = []
+        while len(received) < len(changes):
+            batch = subscription.get(timeout=10)
+            self.assertIsNotNone(batch)
+            received.extend(batch)
+        self.assertEqual(received, changes)
+        broker.notify_conn.close()
+
+    def test_subscribe_bad_filter(self):
+        '''Bad filters should be reported before streaming.'''
+        self.test_app.get('/posts/@subscribe?filter[title:nope]=x', status=400)
+
+
+class TestSortAggregates(DBTestBase):
+    '''Test sorting by aggregates of to-many relationships.'''
+
+    def ids(self, url):
+        return [item['id'] for item in self.test_app.get(url).json['data']]
+
+    def test_sort_count(self):
+        '''Should sort by number of related items, including none.'''
+        self.assertEqual(
+            self.ids('/blogs?sort=-posts.@count,id'),
+            ['1', '3', '2', '4', '5']
+        )
+        self.assertEqual(
+            self.ids('/blogs?sort=posts.@count,-id'),
+            ['5', '4', '2', '3', '1']
+        )
+
+    def test_sort_max(self):
+        '''Should sort by a function of a related attribute.'''
+        self.assertEqual(
+            self.ids('/blogs?sort=posts.@max.published_at'),
+            ['1', '2', '3', '4', '5']
+        )
+        self.assertEqual(
+            self.ids('/blogs?sort=posts.@min.title&page[limit]=3'),
+            ['1', '2', '3']
+        )
+
+    def test_sort_count_manytomany(self):
+        '''Should count through association tables.'''
+        self.assertEqual(
+            self.ids('/people?sort=-articles_by_assoc.@count,id'),
+            ['2', '1', '3', '4']
+        )
+
+    def test_sort_aggregates_joined_once(self):
+        '''Aggregates of the same relationship should share one join.'''
+        with self.statements() as stmts:
+            self.assertEqual(
+                self.ids(
+                    '/blogs?sort=-posts.@count,-posts.@max.published_at'
+                ),
+                ['3', '1', '4', '2', '5']
+            )
+        page_query = [s for s in stmts if 'jsonapi_sort_posts' in s][0]
+        self.assertEqual(page_query.count('LEFT OUTER JOIN'), 1)
+
+    def test_sort_aggregates_bad(self):
+        '''Bad aggregate sort keys are a bad request.'''
+        self.test_app.get('/blogs?sort=owner.@count', status=400)
+        self.test_app.get('/blogs?sort=posts.@median.title', status=400)
+        self.test_app.get('/blogs?sort=posts.@max.nonsense', status=400)
+        self.test_app.get('/blogs?sort=posts.@count.title', status=400)
+
+
+class TestSample(DBTestBase):
+    '''Test random samples of collections.'''
+
+    def test_sample_size(self):
+        '''Should return at most the number of items asked for.'''
+        with self.statements() as stmts:
+            json = self.test_app.get('/posts?page[sample]=3').json
+        ids = [item['id'] for item in json['data']]
+        self.assertLessEqual(len(ids), 3)
+        self.assertLessEqual(set(ids), {'1', '2', '3', '4', '5', '6'})
+        self.assertEqual(
+            json['meta']['results']['sample'],
+            {'size': 3, 'percent': None, 'method': 'system'}
+        )
+        self.assertEqual(json['meta']['results']['count'], 'none')
+        self.assertNotIn('next', json['links'])
+        self.assertTrue(any('TABLESAMPLE system' in s for s in stmts))
+        # Only the sample is shuffled.
+        self.assertFalse(any(
+            'ORDER BY random()' in s and 'TABLESAMPLE' not in s
+            for s in stmts
+        ))
+
+    def test_sample_percent(self):
+        '''A 100% sample should have everything, in the requested order.'''
+        json = self.test_app.get(
+            '/posts?page[sample]=100%&page[sample_method]=bernoulli'
+            '&sort=-id'
+        ).json
+        self.assertEqual(
+            [item['id'] for item in json['data']],
+            ['6', '5', '4', '3', '2', '1']
+        )
+        self.assertEqual(json['meta']['results']['sample']['method'],
+                         'bernoulli')
+
+    def test_sample_filtered(self):
+        '''Samples should be of the filtered collection.'''
+        json = self.test_app.get(
+            '/posts?page[sample]=100%&filter[title:like]=*bob*'
+        ).json
+        self.assertEqual(
+            [item['id'] for item in json['data']], ['4', '5', '6']
+        )
+
+    def test_sample_bad(self):
+        '''Bad samples are a bad request.'''
+        for query in (
+            'page[sample]=0', 'page[sample]=many', 'page[sample]=150%',
+            'page[sample]=3&page[sample_method]=block',
+            'page[sample]=3&page[after]=1',
+        ):
+            self.test_app.get('/posts?' + query, status=400)
+
+    def test_sample_related(self):
+        '''Related and relationships URLs can't be sampled.'''
+        for url in (
+            '/people/1/posts?page[sample]=2',
+            '/people/1/relationships/posts?page[sample]=50%',
+        ):
+            self.test_app.get(url, status=400)
+
+
+class TestRelatedQuery(DBTestBase):
+    '''Test the queries for related items.'''
+
+    def setUp(self):
+        super().setUp()
+        # See the SQL rather than EXECUTEs of prepared statements.
+        self.threshold = pyramid_jsonapi.prepared_statements.threshold
+        pyramid_jsonapi.prepared_statements.threshold = 10 ** 9
+
+    def tearDown(self):
+        pyramid_jsonapi.prepared_statements.threshold = self.threshold
+        super().tearDown()
+
+    def related_statements(self, url):
+        '''(statement, parameters) of the related queries run for url.'''
+        executed = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            if 'jsonapi_parent' in statement:
+                executed.append((statement, parameters))
+
+        sqlalchemy.event.listen(
+            sqlalchemy.engine.Engine, 'before_cursor_execute', record
+        )
+        try:
+            self.test_app.get(url)
+        finally:
+            sqlalchemy.event.remove(
+                sqlalchemy.engine.Engine, 'before_cursor_execute', record
+            )
+        return executed
+
+    def test_related_explicit_joins(self):
+        '''Related items should be found by explicit joins from the item.'''
+        for url, table in (
+            ('/people/1/posts', 'people AS jsonapi_parent JOIN posts'),
+            ('/posts/1/author', 'posts AS jsonapi_parent JOIN people'),
+            (
+                '/people/1/articles_by_assoc',
+                'people AS jsonapi_parent JOIN authors_articles_assoc'
+            ),
+        ):
+            executed = self.related_statements(url)
+            self.assertIn(table, executed[0][0])
+            for statement, parameters in executed:
+                from_clause = statement.split('FROM ')[-1].split('WHERE')[0]
+                self.assertIn(' JOIN ', from_clause, url)
+                self.assertNotIn(',', from_clause, url)
+
+    def test_related_uses_indexes(self):
+        '''Related queries should use the primary and foreign key indexes.'''
+        engine.execute('CREATE INDEX posts_author_id_idx ON posts (author_id)')
+        statement, parameters = [
+            (statement, parameters) for statement, parameters
+            in self.related_statements('/people/2/posts')
+            if 'count(*)' not in statement
+        ][0]
+        with engine.connect() as conn:
+            conn.execute('SET enable_seqscan = off')
+            plan = '\n'.join(row[0] for row in conn.execute(
+                'EXPLAIN ' + statement, parameters
+            ))
+        self.assertIn('people_pkey', plan)
+        self.assertIn('posts_author_id_idx', plan)
+
+    def test_related_round_trips(self):
+        '''The original resource should only be looked for if nothing is found.
+        '''
+        for url, queries in (
+            ('/people/1/posts?fields[posts]=title&page[count]=none', 1),
+            ('/people/1/relationships/posts?page[count]=none', 1),
+            ('/posts/1/author?fields[people]=name', 1),
+        ):
+            with self.statements() as stmts:
+                self.test_app.get(url)
+            self.assertEqual(len(stmts), queries, url)
+        # Nothing related: look for the original resource.
+        with self.statements() as stmts:
+            json = self.test_app.get(
+                '/people/4/posts?fields[posts]=title&page[count]=none'
+            ).json
+        self.assertEqual(json['data'], [])
+        self.assertEqual(len(stmts), 2)
+        self.test_app.get('/people/1000/posts', status=404)
+        self.test_app.get('/people/1000/relationships/blogs', status=404)
+        self.test_app.get('/blogs/1000/owner', status=404)
+
+    def test_patch_nonexistent_creates_nothing(self):
+        '''PATCHing a missing resource should 404 without creating it.'''
+        self.test_app.patch_json(
+            '/people/1000',
+            {'data': {'id': '1000', 'type': 'people',
+                      'attributes': {'name': 'ghost'}}},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=404
+        )
+        self.test_app.get('/people/1000', status=404)
+
+
+class TestBulkCreate(DBTestBase):
+    '''Test creating many resources with one POST.'''
+
+    def post_bulk(self, url, data, **kwargs):
+        return self.test_app.post_json(
+            url, {'data': data},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            **kwargs
+        )
+
+    def test_bulk_create_identifiers(self):
+        '''Should insert many items with one statement.'''
+        data = [
+            {'type': 'people', 'attributes': {'name': 'bulk{}'.format(i)}}
+            for i in range(50)
+        ]
+        with self.statements() as stmts:
+            res = self.post_bulk('/people?return=identifiers', data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(res.json['data']), 50)
+        self.assertEqual(
+            len([s for s in stmts if s.startswith('INSERT INTO people')]), 1
+        )
+        names = [
+            self.test_app.get(
+                '/people/{}'.format(ident['id'])
+            ).json['data']['attributes']['name']
+            for ident in res.json['data'][:3]
+        ]
+        self.assertEqual(names, ['bulk0', 'bulk1', 'bulk2'])
+
+    def test_bulk_create_relationships(self):
+        '''Should set to-one, to-many and many-to-many relationships.'''
+        res = self.post_bulk('/posts', [
+            {
+                'type': 'posts',
+                'attributes': {
+                    'title': 'bulk{}'.format(i),
+                    'published_at': '2018-01-01',
+                },
+                'relationships': {
+                    'author': {'data': {'type': 'people', 'id': '2'}},
+                    'comments': {'data': [
+                        {'type': 'comments', 'id': str(i + 1)}
+                    ]},
+                }
+            }
+            for i in range(2)
+        ])
+        data = res.json['data']
+        self.assertEqual(
+            [item['attributes']['title'] for item in data],
+            ['bulk0', 'bulk1']
+        )
+        self.assertEqual(
+            data[0]['relationships']['author']['data'],
+            {'type': 'people', 'id': '2'}
+        )
+        self.assertEqual(
+            data[1]['relationships']['comments']['data'],
+            [{'type': 'comments', 'id': '2'}]
+        )
+        res = self.post_bulk('/people', [{
+            'type': 'people',
+            'attributes': {'name': 'author'},
+            'relationships': {'articles_by_assoc': {'data': [
+                {'type': 'articles_by_assoc', 'id': '1'},
+                {'type': 'articles_by_assoc', 'id': '2'},
+            ]}}
+        }])
+        person_id = res.json['data'][0]['id']
+        self.assertEqual(
+            {
+                item['id'] for item in self.test_app.get(
+                    '/people/{}/relationships/articles_by_assoc'.format(
+                        person_id
+                    )
+                ).json['data']
+            },
+            {'1', '2'}
+        )
+
+    def test_bulk_create_errors(self):
+        '''Should report every bad item and create nothing.'''
+        available = self.test_app.get(
+            '/people?page[count]=exact'
+        ).json['meta']['results']['available']
+        res = self.post_bulk('/people', [
+            {'type': 'people', 'attributes': {'name': 'good'}},
+            {'type': 'posts', 'attributes': {'name': 'bad type'}},
+            {'type': 'people', 'attributes': {'shoe_size': 9}},
+            {
+                'type': 'people', 'attributes': {'name': 'bad blog'},
+                'relationships': {'blogs': {'data': [
+                    {'type': 'blogs', 'id': '1'},
+                    {'type': 'blogs', 'id': '1000'},
+                ]}}
+            },
+        ], status=400)
+        self.assertEqual(
+            [
+                (e['code'], e['source']['pointer'])
+                for e in res.json['errors']
+            ],
+            [
+                ('409', '/data/1/type'),
+                ('400', '/data/2/attributes/shoe_size'),
+                ('404', '/data/3/relationships/blogs/data/1'),
+            ]
+        )
+        self.assertEqual(
+            self.test_app.get(
+                '/people?page[count]=exact'
+            ).json['meta']['results']['available'],
+            available
+        )
+
+    def test_bulk_create_malformed(self):
+        '''Malformed members should be reported per item, not crash.'''
+        res = self.post_bulk('/people', [
+            {'type': 'people', 'attributes': {'name': 'good'}},
+            {'type': 'people', 'attributes': 'name'},
+            {'type': 'people', 'relationships': ['blogs']},
+            {'type': 'people', 'relationships': {'blogs': 'blog1'}},
+            {'type': 'people', 'relationships': {'blogs': {}}},
+            {'type': 'people', 'relationships': {'blogs': {'data': ['1']}}},
+            {
+                'type': 'people',
+                'relationships': {'comments': {'data': [
+                    {'type': 'comments', 'id': '1'}, None
+                ]}}
+            },
+        ], status=400)
+        self.assertEqual(
+            [
+                (e['code'], e['source']['pointer'])
+                for e in res.json['errors']
+            ],
+            [
+                ('400', '/data/1/attributes'),
+                ('400', '/data/2/relationships'),
+                ('400', '/data/3/relationships/blogs'),
+                ('400', '/data/4/relationships/blogs'),
+                ('400', '/data/5/relationships/blogs/data/0'),
+                ('400', '/data/6/relationships/comments/data/1'),
+            ]
+        )
+        # A to-one identifier which isn't an object.
+        res = self.post_bulk('/posts', [
+            {
+                'type': 'posts', 'attributes': {'title': 'x'},
+                'relationships': {'author': {'data': '1'}}
+            },
+        ], status=400)
+        self.assertEqual(
+            res.json['errors'][0]['source']['pointer'],
+            '/data/0/relationships/author/data'
+        )
+
+    def test_bulk_create_limits(self):
+        '''Should refuse more than max_items and conflicting ids.'''
+        self.post_bulk('/people', [
+            {'type': 'people', 'attributes': {'name': str(i)}}
+            for i in range(101)
+        ], status=400)
+        self.post_bulk('/people', [
+            {'type': 'people', 'id': '1', 'attributes': {'name': 'again'}}
+        ], status=409)
+
+
+class TestResolveIdentifiers(DBTestBase):
+    '''Test batched loading of resource identifiers in write handlers.'''
+
+    def test_relationships_patch_one_query(self):
+        '''All members should be loaded with one query.'''
+        with self.statements() as stmts:
+            self.test_app.patch_json(
+                '/people/1/relationships/posts',
+                {'data': [
+                    {'type': 'posts', 'id': str(i)} for i in range(1, 7)
+                ]},
+                headers={'Content-Type': 'application/vnd.api+json'}
+            )
+        self.assertEqual(
+            len([
+                s for s in stmts
+                if s.startswith('SELECT') and 'posts.id IN' in s
+            ]),
+            1
+        )
+        self.assertEqual(
+            len(self.test_app.get(
+                '/people/1/relationships/posts'
+            ).json['data']),
+            6
+        )
+
+    def test_missing_reported_together(self):
+        '''Every missing id should be in one 404.'''
+        res = self.test_app.post_json(
+            '/people/1/relationships/posts',
+            {'data': [
+                {'type': 'posts', 'id': '1'},
+                {'type': 'posts', 'id': '1000'},
+                {'type': 'posts', 'id': '1001'},
+            ]},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=404
+        )
+        detail = res.json['errors'][0]['detail']
+        self.assertIn('posts/1000', detail)
+        self.assertIn('posts/1001', detail)
+
+    def test_post_missing_related(self):
+        '''POST should 404 rather than relate nothing.'''
+        self.test_app.post_json(
+            '/people',
+            {'data': {
+                'type': 'people',
+                'attributes': {'name': 'nobody'},
+                'relationships': {'blogs': {'data': [
+                    {'type': 'blogs', 'id': '1000'}
+                ]}}
+            }},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=404
+        )
+
+    def test_wrong_types_conflict(self):
+        '''Identifiers of the wrong type should be a conflict.'''
+        self.test_app.patch_json(
+            '/people/1/relationships/posts',
+            {'data': [
+                {'type': 'posts', 'id': '1'},
+                {'type': 'blogs', 'id': '1'},
+            ]},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=409
+        )
+
+
+class TestAssociationWrites(DBTestBase):
+    '''Test direct writes to association tables.'''
+
+    def articles(self, person_id):
+        return {
+            item['id'] for item in self.test_app.get(
+                '/people/{}/relationships/articles_by_assoc'.format(person_id)
+            ).json['data']
+        }
+
+    def test_post_inserts_rows(self):
+        '''Should insert only the new rows without loading the others.'''
+        with self.statements() as stmts:
+            self.test_app.post_json(
+                '/people/2/relationships/articles_by_assoc',
+                {'data': [
+                    {'type': 'articles_by_assoc', 'id': '1'},
+                    {'type': 'articles_by_assoc', 'id': '2'},
+                ]},
+                headers={'Content-Type': 'application/vnd.api+json'}
+            )
+        self.assertTrue(any(
+            s.startswith('INSERT INTO authors_articles_assoc') and
+            'ON CONFLICT DO NOTHING' in s
+            for s in stmts
+        ))
+        self.assertFalse(any(
+            s.startswith('SELECT') and 'authors_articles_assoc' in s
+            for s in stmts
+        ))
+        self.assertEqual(self.articles(2), {'1', '2'})
+        self.test_app.post_json(
+            '/people/3/relationships/articles_by_assoc',
+            {'data': [{'type': 'articles_by_assoc', 'id': '2'}]},
+            headers={'Content-Type': 'application/vnd.api+json'}
+        )
+        self.assertEqual(self.articles(3), {'2'})
+
+    def test_delete_deletes_rows(self):
+        '''Should delete the requested rows with one statement.'''
+        with self.statements() as stmts:
+            self.test_app.delete_json(
+                '/people/2/relationships/articles_by_assoc',
+                {'data': [
+                    {'type': 'articles_by_assoc', 'id': '1'},
+                ]},
+                headers={'Content-Type': 'application/vnd.api+json'}
+            )
+        self.assertEqual(
+            len([
+                s for s in stmts
+                if s.startswith('DELETE FROM authors_articles_assoc')
+            ]),
+            1
+        )
+        self.assertFalse(any(
+            s.startswith('SELECT') and 'authors_articles_assoc' in s
+            for s in stmts
+        ))
+        self.assertEqual(self.articles(2), {'2'})
+        self.assertEqual(self.articles(1), {'1'})
+
+    def patch_statements(self, url, ids, rel_type):
+        with self.statements() as stmts:
+            self.test_app.patch_json(
+                url,
+                {'data': [{'type': rel_type, 'id': i} for i in ids]},
+                headers={'Content-Type': 'application/vnd.api+json'}
+            )
+        return [
+            s for s in stmts
+            if s.split()[0] in ('INSERT', 'UPDATE', 'DELETE')
+        ]
+
+    def test_patch_writes_differences(self):
+        '''PATCH should only write the links which change.'''
+        writes = self.patch_statements(
+            '/people/1/relationships/blogs', ['1', '3'], 'blogs'
+        )
+        self.assertEqual(
+            len([s for s in writes if s.startswith('UPDATE blogs')]), 2
+        )
+        self.assertEqual(
+            {
+                item['id'] for item in self.test_app.get(
+                    '/people/1/relationships/blogs'
+                ).json['data']
+            },
+            {'1', '3'}
+        )
+        self.assertIsNone(
+            self.test_app.get(
+                '/blogs/2/relationships/owner'
+            ).json['data']
+        )
+        writes = self.patch_statements(
+            '/people/2/relationships/articles_by_assoc', ['2'],
+            'articles_by_assoc'
+        )
+        self.assertEqual(
+            [
+                s.split()[0] for s in writes
+                if 'authors_articles_assoc' in s
+            ],
+            ['DELETE']
+        )
+        self.assertEqual(self.articles(2), {'2'})
+
+    def test_patch_unchanged(self):
+        '''PATCH with the current members should write nothing.'''
+        self.assertEqual(
+            self.patch_statements(
+                '/people/2/relationships/articles_by_assoc', ['1', '2'],
+                'articles_by_assoc'
+            ),
+            []
+        )
+
+    def test_missing_parent(self):
+        '''Should 404 if the resource doesn't exist.'''
+        self.test_app.post_json(
+            '/people/1000/relationships/articles_by_assoc',
+            {'data': [{'type': 'articles_by_assoc', 'id': '1'}]},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=404
+        )
+
+
+class TestDirectWrites(DBTestBase):
+    '''Test single item writes which bypass the ORM.'''
+
+    def test_patch_one_update(self):
+        '''Attribute only PATCH should be a single UPDATE.'''
+        with self.statements() as stmts:
+            self.test_app.patch_json(
+                '/people/1',
+                {'data': {
+                    'type': 'people', 'id': '1',
+                    'attributes': {'name': 'alicia'}
+                }},
+                headers={'Content-Type': 'application/vnd.api+json'}
+            )
+        self.assertEqual(
+            [s.split()[0] for s in stmts if 'people' in s],
+            ['UPDATE']
+        )
+        self.assertEqual(
+            self.test_app.get('/people/1').json['data']['attributes']['name'],
+            'alicia'
+        )
+
+    def test_patch_missing(self):
+        '''Should 404 when PATCHing a non existent item.'''
+        self.test_app.patch_json(
+            '/people/1000',
+            {'data': {
+                'type': 'people', 'id': '1000',
+                'attributes': {'name': 'nobody'}
+            }},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=404
+        )
+
+    def test_patch_prefer_minimal(self):
+        '''Should return 204 with no body for Prefer: return=minimal.'''
+        r = self.test_app.patch_json(
+            '/people/1',
+            {'data': {
+                'type': 'people', 'id': '1',
+                'attributes': {'name': 'alicia'}
+            }},
+            headers={
+                'Content-Type': 'application/vnd.api+json',
+                'Prefer': 'return=minimal',
+            },
+            status=204
+        )
+        self.assertEqual(r.body, b'')
+        self.assertNotIn('Content-Type', r.headers)
+        self.assertEqual(r.headers['Preference-Applied'], 'return=minimal')
+
+    def test_post_returning(self):
+        '''POST should insert and serialise without reading back.'''
+        with self.statements() as stmts:
+            r = self.test_app.post_json(
+                '/blogs',
+                {'data': {
+                    'type': 'blogs',
+                    'attributes': {'title': 'direct'},
+                    'relationships': {
+                        'owner': {'data': {'type': 'people', 'id': '1'}}
+                    }
+                }},
+                headers={'Content-Type': 'application/vnd.api+json'},
+                status=201
+            )
+        blog_stmts = [s for s in stmts if 'blogs' in s]
+        self.assertEqual(len(blog_stmts), 1)
+        self.assertIn('RETURNING', blog_stmts[0])
+        data = r.json['data']
+        self.assertEqual(data['attributes']['title'], 'direct')
+        self.assertEqual(data['relationships']['owner']['data']['id'], '1')
+        self.assertEqual(data['relationships']['posts']['data'], [])
+        self.assertEqual(
+            self.test_app.get(
+                '/blogs/{}/relationships/owner'.format(data['id'])
+            ).json['data']['id'],
+            '1'
+        )
+
+    def test_post_prefer_minimal(self):
+        '''Should only return an identifier for Prefer: return=minimal.'''
+        r = self.test_app.post_json(
+            '/people',
+            {'data': {'type': 'people', 'attributes': {'name': 'monty'}}},
+            headers={
+                'Content-Type': 'application/vnd.api+json',
+                'Prefer': 'return=minimal',
+            },
+            status=201
+        )
+        self.assertEqual(set(r.json['data']), {'type', 'id'})
+        self.assertTrue(r.headers['Location'].endswith(r.json['data']['id']))
+
+
+class TestDirectDelete(DBTestBase):
+    '''Test DELETE with pyramid_jsonapi.delete.direct.'''
+
+    def setUp(self):
+        super().setUp()
+        view = pyramid_jsonapi.view_classes[test_project.models.Person]
+        self.addCleanup(setattr, view, 'direct_delete', view.direct_delete)
+        view.direct_delete = True
+
+    def test_one_statement(self):
+        '''Should delete with one statement and no loading.'''
+        person_id = self.test_app.post_json(
+            '/people',
+            {'data': {'type': 'people', 'attributes': {'name': 'monty'}}},
+            headers={'Content-Type': 'application/vnd.api+json'}
+        ).json['data']['id']
+        with self.statements() as stmts:
+            data = self.test_app.delete(
+                '/people/{}'.format(person_id)
+            ).json['data']
+        self.assertEqual(data, {'type': 'people', 'id': person_id})
+        self.assertEqual(
+            [s.split()[0] for s in stmts if 'people' in s],
+            ['DELETE']
+        )
+        self.test_app.get('/people/{}'.format(person_id), status=404)
+
+    def test_missing(self):
+        '''Should return null data for a non existent item.'''
+        self.assertIsNone(self.test_app.delete('/people/1000').json['data'])
+
+    def test_schema_refuses(self):
+        '''Should 424 if foreign keys without ON DELETE rules refer to it.'''
+        self.test_app.delete('/people/1', status=424)
+        self.test_app.get('/people/1')
+
+
+class TestOperations(DBTestBase):
+    '''Test the atomic operations endpoint.'''
+
+    def operations(self, operations, status=200):
+        return self.test_app.post_json(
+            '/operations',
+            {'atomic:operations': operations},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=status
+        ).json
+
+    def test_lids(self):
+        '''Later operations should refer to new resources by lid.'''
+        results = self.operations([
+            {'op': 'add', 'data': {
+                'type': 'posts', 'lid': 'p',
+                'attributes': {
+                    'title': 'atomic', 'published_at': '2018-01-01T00:00:00'
+                },
+                'relationships': {
+                    'author': {'data': {'type': 'people', 'id': '1'}}
+                }
+            }},
+            {'op': 'add', 'data': {
+                'type': 'comments',
+                'attributes': {'content': 'first'},
+                'relationships': {
+                    'post': {'data': {'type': 'posts', 'lid': 'p'}}
+                }
+            }},
+            {'op': 'update', 'data': {
+                'type': 'people', 'id': '1',
+                'attributes': {'name': 'alicia'}
+            }},
+        ])['atomic:results']
+        self.assertEqual(len(results), 3)
+        post_id = results[0]['data']['id']
+        comments = self.test_app.get(
+            '/posts/{}/relationships/comments'.format(post_id)
+        ).json['data']
+        self.assertEqual(
+            [c['id'] for c in comments], [results[1]['data']['id']]
+        )
+        self.assertEqual(
+            self.test_app.get('/people/1').json['data']['attributes']['name'],
+            'alicia'
+        )
+
+    def test_relationship_and_remove(self):
+        '''Should run relationship and remove operations.'''
+        results = self.operations([
+            {
+                'op': 'add',
+                'ref': {
+                    'type': 'people', 'id': '2',
+                    'relationship': 'articles_by_assoc'
+                },
+                'data': [{'type': 'articles_by_assoc', 'id': '1'}]
+            },
+            {'op': 'remove', 'ref': {'type': 'comments', 'id': '1'}},
+        ])['atomic:results']
+        self.assertEqual(results[0], {})
+        self.test_app.get('/comments/1', status=404)
+
+    def test_relationship_read_back(self):
+        '''Later operations should see relationships written directly.'''
+        ref = {'type': 'people', 'id': '2', 'relationship': 'blogs'}
+        self.operations([
+            # Through the ORM: loads people/2's blogs into the session.
+            {'op': 'add', 'ref': ref, 'data': [{'type': 'blogs', 'id': '1'}]},
+            # Written directly.
+            {'op': 'update', 'ref': ref, 'data': [
+                {'type': 'blogs', 'id': '1'}, {'type': 'blogs', 'id': '2'}
+            ]},
+            # Through the ORM again, which has to see that blogs/3 was
+            # removed.
+            {'op': 'add', 'ref': ref, 'data': [{'type': 'blogs', 'id': '3'}]},
+        ])
+        self.assertEqual(
+            sorted(
+                item['id'] for item in self.test_app.get(
+                    '/people/2/relationships/blogs'
+                ).json['data']
+            ),
+            ['1', '2', '3']
+        )
+
+    def test_rollback(self):
+        '''A failed operation should undo the others.'''
+        json = self.operations([
+            {'op': 'add', 'data': {
+                'type': 'people', 'attributes': {'name': 'atomic'}
+            }},
+            {'op': 'update', 'data': {
+                'type': 'people', 'id': '1000',
+                'attributes': {'name': 'nobody'}
+            }},
+        ], status=404)
+        self.assertEqual(
+            json['errors'][0]['source']['pointer'], '/atomic:operations/1'
+        )
+        self.assertEqual(
+            self.test_app.get(
+                '/people?filter[name:eq]=atomic'
+            ).json['data'],
+            []
+        )
+
+    def test_rollback_conflict(self):
+        '''A database error should undo the whole batch.'''
+        self.operations([
+            {'op': 'update', 'data': {
+                'type': 'people', 'id': '2',
+                'attributes': {'name': 'changed'}
+            }},
+            {'op': 'add', 'data': {
+                'type': 'people', 'id': '1', 'attributes': {'name': 'clash'}
+            }},
+        ], status=409)
+        self.assertNotEqual(
+            self.test_app.get('/people/2').json['data']['attributes']['name'],
+            'changed'
+        )
+
+    def test_unknown_lid(self):
+        '''Should 400 for a lid which wasn't added earlier.'''
+        self.operations([
+            {'op': 'remove', 'ref': {'type': 'people', 'lid': 'x'}},
+        ], status=400)
+
+    def test_batches_adds(self):
+        '''Consecutive adds to one collection should be one INSERT.'''
+        with self.statements() as stmts:
+            results = self.operations([
+                {'op': 'add', 'data': {
+                    'type': 'people', 'lid': str(i),
+                    'attributes': {'name': 'atomic{}'.format(i)}
+                }}
+                for i in range(3)
+            ])['atomic:results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(
+            len([s for s in stmts if s.startswith('INSERT INTO people')]), 1
+        )
+        self.assertEqual(
+            [r['data']['attributes']['name'] for r in results],
+            ['atomic0', 'atomic1', 'atomic2']
+        )
+
+
+class TestFilteredWrites(DBTestBase):
+    '''Test PATCH and DELETE of filtered collections.'''
+
+    def test_patch(self):
+        '''Should update the filtered items with one UPDATE.'''
+        with self.statements() as stmts:
+            json = self.test_app.patch_json(
+                '/posts?filter[title:like]=*1*&confirm=true'
+                '&return=identifiers',
+                {'data': {'type': 'posts', 'attributes': {'content': 'x'}}},
+                headers={'Content-Type': 'application/vnd.api+json'}
+            ).json
+        self.assertEqual(
+            len([s for s in stmts if s.startswith('UPDATE posts')]), 1
+        )
+        self.assertFalse(any(s.startswith('SELECT posts') for s in stmts))
+        ids = {item['id'] for item in json['data']}
+        self.assertEqual(json['meta']['results']['updated'], len(ids))
+        self.assertTrue(ids)
+        for item in self.test_app.get('/posts').json['data']:
+            self.assertEqual(
+                item['attributes']['content'] == 'x', item['id'] in ids
+            )
+
+    def test_session_items(self):
+        '''Only loaded copies of the written items should be touched.'''
+        view = pyramid_jsonapi.view_classes[test_project.models.Comment]
+        comment1, comment2 = DBSession.query(
+            test_project.models.Comment
+        ).filter(
+            test_project.models.Comment.comments_id.in_([1, 2])
+        ).order_by(test_project.models.Comment.comments_id).all()
+        comment2.content = 'unsaved'
+
+        def call(method, http_method, body=None):
+            request = pyramid.request.Request.blank(
+                '/comments?filter[content:like]=comment1:*&confirm=true',
+                headers={'Content-Type': 'application/vnd.api+json'},
+                method=http_method,
+            )
+            if body is not None:
+                request.body = json.dumps(body).encode()
+            request.registry = self.app.registry
+            request.matchdict = {}
+            return getattr(view(request), method)()
+
+        call('collection_patch', 'PATCH', {'data': {
+            'type': 'comments', 'attributes': {'content': 'comment1: x'}
+        }})
+        self.assertEqual(comment1.content, 'comment1: x')
+        self.assertEqual(comment2.content, 'unsaved')
+        call('collection_delete', 'DELETE')
+        self.assertNotIn(comment1, DBSession)
+        self.assertIn(comment2, DBSession)
+        self.assertEqual(comment2.content, 'unsaved')
+
+    def test_delete(self):
+        '''Should delete the filtered items.'''
+        json = self.test_app.delete(
+            '/comments?filter[content:like]=*1*&confirm=true'
+        ).json
+        self.assertTrue(json['meta']['results']['deleted'])
+        self.assertEqual(
+            self.test_app.get(
+                '/comments?filter[content:like]=*1*'
+            ).json['data'],
+            []
+        )
+
+    def test_guards(self):
+        '''Should insist on a filter and confirmation.'''
+        self.test_app.delete('/comments?confirm=true', status=400)
+        self.test_app.delete(
+            '/comments?filter[content:like]=*1*', status=400
+        )
+
+    def test_callbacks(self):
+        '''Per item callbacks opt out, collection callbacks may veto.'''
+        view = pyramid_jsonapi.view_classes[test_project.models.Comment]
+
+        def veto(view, query):
+            raise HTTPForbidden('No.')
+
+        view.callbacks['before_delete'].append(lambda view, item: None)
+        try:
+            self.test_app.delete(
+                '/comments?filter[content:like]=*1*&confirm=true', status=403
+            )
+        finally:
+            view.callbacks['before_delete'].pop()
+        view.callbacks['before_collection_delete'].append(veto)
+        try:
+            self.test_app.delete(
+                '/comments?filter[content:like]=*1*&confirm=true', status=403
+            )
+        finally:
+            view.callbacks['before_collection_delete'].pop()
+
+
+class TestUpsert(DBTestBase):
+    '''Test POST with upsert=true.'''
+
+    def test_single(self):
+        '''Should update an existing item and create a new one.'''
+        with self.statements() as stmts:
+            r = self.test_app.post_json(
+                '/people?upsert=true',
+                {'data': {
+                    'type': 'people', 'id': '1',
+                    'attributes': {'name': 'alicia'}
+                }},
+                headers={'Content-Type': 'application/vnd.api+json'},
+                status=200
+            )
+        self.assertTrue(any(
+            s.startswith('INSERT INTO people') and 'ON CONFLICT' in s
+            for s in stmts
+        ))
+        self.assertEqual(r.json['data']['meta']['upsert'], 'updated')
+        self.assertEqual(r.json['data']['attributes']['name'], 'alicia')
+        r = self.test_app.post_json(
+            '/people?upsert=true',
+            {'data': {
+                'type': 'people', 'id': '1000',
+                'attributes': {'name': 'new'}
+            }},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=201
+        )
+        self.assertEqual(r.json['data']['meta']['upsert'], 'created')
+        self.test_app.get('/people/1000')
+
+    def test_bulk(self):
+        '''Should report which items were created and which updated.'''
+        data = self.test_app.post_json(
+            '/people?upsert=true&return=identifiers',
+            {'data': [
+                {'type': 'people', 'id': '1', 'attributes': {'name': 'a'}},
+                {'type': 'people', 'id': '1001', 'attributes': {'name': 'b'}},
+            ]},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=201
+        ).json['data']
+        self.assertEqual(
+            [(item['id'], item['meta']['upsert']) for item in data],
+            [('1', 'updated'), ('1001', 'created')]
+        )
+        self.assertEqual(
+            self.test_app.get('/people/1').json['data']['attributes']['name'],
+            'a'
+        )
+
+    def test_needs_ids(self):
+        '''Should 400 without ids or with to-many relationships.'''
+        self.test_app.post_json(
+            '/people?upsert=true',
+            {'data': {'type': 'people', 'attributes': {'name': 'x'}}},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=400
+        )
+        self.test_app.post_json(
+            '/people?upsert=true',
+            {'data': {
+                'type': 'people', 'id': '1', 'attributes': {},
+                'relationships': {'blogs': {'data': []}}
+            }},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=400
+        )
+        self.test_app.post_json(
+            '/people?upsert=true',
+            {'data': [{
+                'type': 'people', 'id': '1', 'attributes': {},
+                'relationships': {'articles_by_assoc': {'data': [
+                    {'type': 'articles_by_assoc', 'id': '1'}
+                ]}}
+            }]},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=400
+        )
+
+    def test_orm_hooks(self):
+        '''Models with mapper events should refuse upserts.'''
+        def hook(mapper, connection, target):
+            pass
+
+        person = test_project.models.Person
+        sqlalchemy.event.listen(person, 'before_update', hook)
+        self.addCleanup(sqlalchemy.event.remove, person, 'before_update', hook)
+        self.test_app.post_json(
+            '/people?upsert=true',
+            {'data': {
+                'type': 'people', 'id': '1', 'attributes': {'name': 'x'}
+            }},
+            headers={'Content-Type': 'application/vnd.api+json'},
+            status=400
+        )
+
+
+class TestImport(DBTestBase):
+    '''Test the streaming @import endpoint.'''
+
+    def test_ndjson(self):
+        '''Should import good lines and report the bad ones.'''
+        body = '\n'.join([
+            json.dumps({
+                'type': 'people', 'id': '100', 'attributes': {'name': 'x'}
+            }),
+            'not json',
+            json.dumps({'type': 'people', 'id': '1'}),
+            '',
+            json.dumps({
+                'type': 'people', 'id': '101', 'attributes': {'nope': 'y'}
+            }),
+            json.dumps({
+                'type': 'people', 'id': '102', 'attributes': {'name': 'z'}
+            }),
+        ])
+        summary = self.test_app.post(
+            '/people/@import', body,
+            headers={'Content-Type': 'application/x-ndjson'}
+        ).json['meta']['import']
+        self.assertEqual(
+            {key: summary[key] for key in ('rows', 'imported', 'failed')},
+            {'rows': 5, 'imported': 2, 'failed': 3}
+        )
+        self.assertEqual(
+            [error['line'] for error in summary['errors']], [2, 5, 3]
+        )
+        self.assertEqual(
+            self.test_app.get('/people/102').json['data']['attributes']['name'],
+            'z'
+        )
+
+    def test_csv(self):
+        '''Should import the export's CSV shape, checking related items.'''
+        body = '\r\n'.join([
+            'id,title,published_at,author,blog',
+            '100,"new, post",2018-01-01,1,',
+            '101,bad author,2018-01-01,999,',
+            '102,no date,,1,1',
+            '',
+        ])
+        summary = self.test_app.post(
+            '/posts/@import?format=csv', body
+        ).json['meta']['import']
+        self.assertEqual(summary['imported'], 1)
+        self.assertEqual(
+            [error['line'] for error in summary['errors']], [3, 4]
+        )
+        post = self.test_app.get('/posts/100').json['data']
+        self.assertEqual(post['attributes']['title'], 'new, post')
+        self.assertEqual(post['relationships']['author']['data']['id'], '1')
+        self.assertIsNone(post['relationships']['blog']['data'])
+        self.test_app.post(
+            '/posts/@import?format=csv', 'id,nope\r\n', status=400
+        )
+
+    def import_people(self, *people):
+        '''Import (id, attributes) pairs into people, return the summary.'''
+        return self.test_app.post(
+            '/people/@import',
+            '\n'.join(
+                json.dumps({
+                    'type': 'people', 'id': item_id, 'attributes': atts
+                })
+                for item_id, atts in people
+            ),
+            headers={'Content-Type': 'application/x-ndjson'}
+        ).json['meta']['import']
+
+    def test_malformed(self):
+        '''Badly shaped resource objects should only fail their own line.'''
+        lines = [
+            {'type': 'posts', 'relationships': []},
+            {'type': 'posts', 'attributes': 'title'},
+            {'type': 'posts', 'relationships': {'author': ['people', '1']}},
+            {'type': 'posts', 'relationships': {'author': {'data': '1'}}},
+            {'type': 'posts', 'relationships': {'author': {'data': [
+                {'type': 'people', 'id': '1'}
+            ]}}},
+        ]
+        summary = self.test_app.post(
+            '/posts/@import',
+            '\n'.join(json.dumps(line) for line in lines),
+            headers={'Content-Type': 'application/x-ndjson'}
+        ).json['meta']['import']
+        self.assertEqual(summary['failed'], len(lines))
+        self.assertEqual(
+            [error['line'] for error in summary['errors']], [1, 2, 3, 4, 5]
+        )
+
+    def test_composite_relationship(self):
+        '''To-one relationships over several columns can't be imported.'''
+        view = pyramid_jsonapi.view_classes[test_project.models.Post]
+        author = view.relationships['author']
+        pairs = author.synchronize_pairs
+        self.addCleanup(setattr, author, 'synchronize_pairs', pairs)
+        author.synchronize_pairs = pairs * 2
+        summary = self.test_app.post(
+            '/posts/@import',
+            json.dumps({'type': 'posts', 'relationships': {
+                'author': {'data': {'type': 'people', 'id': '1'}}
+            }}),
+            headers={'Content-Type': 'application/x-ndjson'}
+        ).json['meta']['import']
+        self.assertEqual(
+            summary['errors'],
+            [{'line': 1, 'detail': 'Relationship author cannot be imported.'}]
+        )
+
+    def test_count_cache(self):
+        '''Imports should invalidate cached counts.'''
+        pyramid_jsonapi.count_cache.clear()
+        self.test_app.get('/people')
+        self.assertTrue(
+            self.test_app.get('/people').json['meta']['results']['cached']
+        )
+        self.import_people(('100', {'name': 'x'}))
+        results = self.test_app.get('/people').json['meta']['results']
+        self.assertFalse(results['cached'])
+        self.assertEqual(results['available'], 5)
+        # Without change tracking nothing about the rows is recorded.
+        for tracker in (pyramid_jsonapi.change_log,
+                        pyramid_jsonapi.subscriptions):
+            self.addCleanup(setattr, tracker, 'installed', tracker.installed)
+            tracker.installed = False
+        self.test_app.get('/people')
+        self.import_people((None, {'name': 'y'}))
+        results = self.test_app.get('/people').json['meta']['results']
+        self.assertFalse(results['cached'])
+        self.assertEqual(results['available'], 6)
+
+    def test_column_defaults(self):
+        '''Client side column defaults should apply however rows are loaded.
+        '''
+        name = test_project.models.Person.__table__.c.name
+        self.addCleanup(setattr, name, 'default', None)
+        # A plain value (COPY) and a callable (INSERT).
+        name.default = sqlalchemy.ColumnDefault('anon')
+        self.import_people(('100', {}))
+        name.default = sqlalchemy.ColumnDefault(lambda: 'anon2')
+        self.import_people(('101', {}))
+        for item_id, expected in (('100', 'anon'), ('101', 'anon2')):
+            self.assertEqual(
+                self.test_app.get(
+                    '/people/{}'.format(item_id)
+                ).json['data']['attributes']['name'],
+                expected
+            )
+
+    def test_callbacks(self):
+        '''Collections with before_collection_post callbacks refuse.'''
+        view = pyramid_jsonapi.view_classes[test_project.models.Comment]
+        view.callbacks['before_collection_post'].append(
+            lambda view, obj: obj
+        )
+        try:
+            self.test_app.post(
+                '/comments/@import', '{"type": "comments"}', status=403
+            )
+        finally:
+            view.callbacks['before_collection_post'].pop()
+
+
 class TestBugs(DBTestBase):
 
     def test_19_last_negative_offset(self):